@@ -0,0 +1,288 @@
+"""
+Inbound admission control for expensive endpoints.
+
+Each limited route gets a dependency from `admission_control(...)` that:
+  1. charges a token bucket keyed by the caller's JWT subject (falling back to
+     the client address), sized by the caller's role, answering 429 with
+     `Retry-After` when the bucket is empty;
+  2. takes one of a fixed number of per-route execution slots, waiting in a
+     bounded first-come, first-served queue for at most `max_wait` seconds,
+     answering 503 with `Retry-After` when the queue is full or the wait
+     times out.
+
+A route whose cost depends on the request (e.g. one Anvil lookup per template
+in a batch) takes the dependency's `Admission` as a parameter and charges the
+extra work through `Admission.charge`.
+
+Bucket state lives in process by default. Set ADMISSION_REDIS_URL (and install
+`redis`) to share buckets between workers; concurrency slots stay per worker.
+"""
+import asyncio
+import collections
+import math
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple, Union
+
+from fastapi import Depends, HTTPException, Request, status
+from fastapi.security import OAuth2PasswordBearer
+from jose import JWTError, jwt
+from starlette.concurrency import run_in_threadpool
+
+from . import security
+
+ADMISSION_REDIS_URL = os.getenv("ADMISSION_REDIS_URL")
+
+_optional_token = OAuth2PasswordBearer(tokenUrl="api/token", auto_error=False)
+
+
+@dataclass(frozen=True)
+class Rate:
+    """Sustained requests per second plus a burst allowance."""
+    per_second: float
+    burst: int
+
+
+class InMemoryBucketBackend:
+    """Token buckets in a dict guarded by a lock; state is per process."""
+
+    def __init__(self, max_keys: int = 100_000):
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+        self._max_keys = max_keys
+
+    def take(self, key: str, rate: Rate, now: Optional[float] = None) -> float:
+        """Takes one token. Returns 0 when admitted, otherwise seconds until a token is available."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (float(rate.burst), now))
+            tokens = min(float(rate.burst), tokens + (now - updated) * rate.per_second)
+            if tokens >= 1:
+                self._store(key, tokens - 1, now)
+                return 0.0
+            self._store(key, tokens, now)
+            return (1 - tokens) / rate.per_second
+
+    def take_up_to(self, key: str, rate: Rate, cost: int, now: Optional[float] = None) -> int:
+        """Takes as many of `cost` whole tokens as are available. Returns how many were taken."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (float(rate.burst), now))
+            tokens = min(float(rate.burst), tokens + (now - updated) * rate.per_second)
+            taken = min(max(cost, 0), int(tokens))
+            self._store(key, tokens - taken, now)
+            return taken
+
+    def _store(self, key: str, tokens: float, now: float):
+        if key not in self._buckets and len(self._buckets) >= self._max_keys:
+            # Buckets refill to full when idle, so dropping the oldest entry is harmless.
+            self._buckets.pop(next(iter(self._buckets)))
+        self._buckets[key] = (tokens, now)
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class RedisBucketBackend:
+    """Token buckets shared by every worker, updated atomically by a Lua script."""
+
+    _SCRIPT = """
+    local tokens = tonumber(redis.call('HGET', KEYS[1], 't') or ARGV[2])
+    local updated = tonumber(redis.call('HGET', KEYS[1], 'u') or ARGV[3])
+    local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+    tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+    local wait = 0
+    if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+    redis.call('HSET', KEYS[1], 't', tokens, 'u', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+    return tostring(wait)
+    """
+
+    _TAKE_UP_TO_SCRIPT = """
+    local tokens = tonumber(redis.call('HGET', KEYS[1], 't') or ARGV[2])
+    local updated = tonumber(redis.call('HGET', KEYS[1], 'u') or ARGV[3])
+    local rate, burst, now, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+    tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+    local taken = math.min(math.max(cost, 0), math.floor(tokens))
+    redis.call('HSET', KEYS[1], 't', tokens - taken, 'u', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+    return taken
+    """
+
+    def __init__(self, url: str):
+        import redis  # Optional dependency, only needed for a shared backend.
+
+        self._client = redis.Redis.from_url(url)
+        self._take = self._client.register_script(self._SCRIPT)
+        self._take_up_to = self._client.register_script(self._TAKE_UP_TO_SCRIPT)
+
+    def take(self, key: str, rate: Rate, now: Optional[float] = None) -> float:
+        now = time.time() if now is None else now
+        return float(self._take(keys=[f"admission:{key}"], args=[rate.per_second, rate.burst, now]))
+
+    def take_up_to(self, key: str, rate: Rate, cost: int, now: Optional[float] = None) -> int:
+        now = time.time() if now is None else now
+        return int(self._take_up_to(keys=[f"admission:{key}"], args=[rate.per_second, rate.burst, now, cost]))
+
+    def reset(self):
+        for key in self._client.scan_iter("admission:*"):
+            self._client.delete(key)
+
+
+def _create_backend():
+    if ADMISSION_REDIS_URL:
+        return RedisBucketBackend(ADMISSION_REDIS_URL)
+    return InMemoryBucketBackend()
+
+
+bucket_backend = _create_backend()
+
+
+class ConcurrencyLimiter:
+    """
+    At most `limit` requests run at once; at most `max_queue` wait for a slot.
+    A released slot is handed straight to the longest waiter, so a new arrival
+    never overtakes the queue.
+    """
+
+    def __init__(self, limit: int, max_queue: int, max_wait: float):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._running = 0
+        self._waiters: collections.deque = collections.deque()
+        self._loop = None
+
+    def _get_waiters(self) -> collections.deque:
+        # Waiters are futures of the serving event loop; a new loop cannot inherit them.
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._waiters = collections.deque()
+            self._loop = loop
+        return self._waiters
+
+    async def acquire(self) -> bool:
+        waiters = self._get_waiters()
+        if self._running < self.limit and not waiters:
+            self._running += 1
+            return True
+        if len(waiters) >= self.max_queue:
+            return False
+        slot = self._loop.create_future()
+        waiters.append(slot)
+        try:
+            await asyncio.wait([slot], timeout=self.max_wait)
+        finally:
+            if not slot.done():
+                # Timed out (or cancelled): give up the place in the queue.
+                slot.cancel()
+                waiters.remove(slot)
+            elif not slot.cancelled() and asyncio.current_task().cancelling():
+                # Cancelled just after a slot was handed over; pass it on.
+                self._hand_off()
+        return slot.done() and not slot.cancelled()
+
+    def _hand_off(self):
+        """Gives a freed slot to the first live waiter, or returns it to the pool."""
+        while self._waiters:
+            slot = self._waiters.popleft()
+            if not slot.done():
+                slot.set_result(True)
+                return
+        self._running -= 1
+
+    async def release(self):
+        self._get_waiters()
+        self._hand_off()
+
+
+@dataclass
+class Admission:
+    """What a limited route was admitted as; yielded by the `admission_control` dependency."""
+    key: str
+    rate: Optional[Rate]
+    backend: object
+
+    async def charge(self, cost: int) -> int:
+        """
+        Charges up to `cost` more tokens for work beyond the request itself and
+        returns how many were granted; the caller should only do that much.
+        Without a rate for the caller, everything is granted.
+        """
+        if cost <= 0 or self.rate is None:
+            return max(cost, 0)
+        if isinstance(self.backend, InMemoryBucketBackend):
+            return self.backend.take_up_to(self.key, self.rate, cost)
+        return await run_in_threadpool(self.backend.take_up_to, self.key, self.rate, cost)
+
+
+def _caller(request: Request, token: Optional[str]) -> Tuple[str, Optional[str]]:
+    """Identifies the caller from the JWT alone, without a database round-trip."""
+    if token:
+        try:
+            payload = jwt.decode(token, security.SECRET_KEY, algorithms=[security.ALGORITHM])
+            if payload.get("sub"):
+                return f"user:{payload['sub']}", payload.get("role")
+        except JWTError:
+            pass
+    host = request.client.host if request.client else "unknown"
+    return f"ip:{host}", None
+
+
+def _retry_after(seconds: float) -> Dict[str, str]:
+    return {"Retry-After": str(max(1, math.ceil(seconds)))}
+
+
+def admission_control(
+    name: str,
+    rates: Dict[Optional[str], Union[Rate, Tuple[float, int]]],
+    concurrency: Optional[int] = None,
+    max_queue: int = 0,
+    max_wait: float = 5.0,
+    backend=None,
+):
+    """
+    Builds a FastAPI dependency enforcing per-caller rates and, optionally, a
+    per-route concurrency limit. `rates` maps a role to its Rate; the `None`
+    entry applies to roles without their own entry and to anonymous callers.
+    """
+    rates = {role: rate if isinstance(rate, Rate) else Rate(*rate) for role, rate in rates.items()}
+    limiter = ConcurrencyLimiter(concurrency, max_queue, max_wait) if concurrency else None
+
+    async def dependency(request: Request, token: Optional[str] = Depends(_optional_token)):
+        key, role = _caller(request, token)
+        rate = rates.get(role, rates.get(None))
+        buckets = backend or bucket_backend
+        admitted = Admission(f"{name}:{key}", rate, buckets)
+        if rate is not None:
+            if isinstance(buckets, InMemoryBucketBackend):
+                wait = buckets.take(admitted.key, rate)
+            else:
+                wait = await run_in_threadpool(buckets.take, admitted.key, rate)
+            if wait > 0:
+                raise HTTPException(
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                    detail="Rate limit exceeded",
+                    headers=_retry_after(wait),
+                )
+
+        if limiter is None:
+            yield admitted
+            return
+
+        if not await limiter.acquire():
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server is busy, please retry",
+                headers=_retry_after(limiter.max_wait),
+            )
+        try:
+            yield admitted
+        finally:
+            await limiter.release()
+
+    dependency.limiter = limiter
+    return dependency
@@ -0,0 +1,24 @@
+"""
+Backfills the submission rollup tables from existing data.
+
+Usage:
+    python -m app.analytics
+"""
+from . import crud, models
+from .database import SessionLocal, create_tables, engine
+
+
+def main():
+    create_tables(engine)
+    db = SessionLocal()
+    try:
+        crud.rebuild_submission_rollups(db)
+        templates = db.query(models.TemplateSubmissionStats).count()
+        buyers = db.query(models.BuyerSubmissionStats).count()
+        print(f"Rebuilt submission rollups for {templates} templates and {buyers} buyers")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+# backend/app/async_crud.py
+# Async counterparts of the crud.py functions that touch the database, for use with
+# deps.get_async_db (pure helpers such as apply_merge_patch need none). Maintenance
+# jobs outside crud (search.rebuild_search_index, partitions.rollover, retention.sweep)
+# are sync only; they run from the CLI or in the threadpool.
+# Reads are native async queries. Writes that maintain rollups and the search index
+# delegate to the sync implementation through AsyncSession.run_sync, so that logic
+# lives in exactly one place while the I/O still goes through the async driver.
+from datetime import date, datetime
+from typing import Optional
+
+import anyio
+from sqlalchemy import func, insert, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+
+from . import crud, models, partitions, schemas
+from .crud import CollectionStamp
+from .security import get_password_hash
+
+# User Functions
+async def get_user_by_email(db: AsyncSession, email: str):
+    return await db.scalar(select(models.User).where(models.User.email == email).limit(1))
+
+async def create_user(db: AsyncSession, user: schemas.UserBase):
+    # Hashing is deliberately slow; keep it off the event loop.
+    hashed_password = await anyio.to_thread.run_sync(get_password_hash, user.password)
+    stmt = insert(models.User).values(email=user.email, role=user.role, hashed_password=hashed_password)
+    db_user = await db.scalar(stmt.returning(models.User))
+    await db.commit()
+    return db_user
+
+async def update_user_password_hash(db: AsyncSession, db_user: models.User, hashed_password: str):
+    db_user.hashed_password = hashed_password
+    await db.commit()
+    return db_user
+
+# Template Functions
+async def create_template(db: AsyncSession, title: str, owner_id: int, anvil_template_eid: str, field_info: Optional[dict] = None,
+                          content_hash: Optional[str] = None):
+    return await db.run_sync(crud.create_template, title, owner_id, anvil_template_eid, field_info, content_hash)
+
+async def bulk_create_templates(db: AsyncSession, templates):
+    return await db.run_sync(crud.bulk_create_templates, templates)
+
+async def get_template_by_content_hash(db: AsyncSession, content_hash: str, owner_id: Optional[int] = None):
+    stmt = select(models.PDFTemplate).where(models.PDFTemplate.content_hash == content_hash)
+    if owner_id is not None:
+        stmt = stmt.order_by((models.PDFTemplate.owner_id == owner_id).desc())
+    stmt = stmt.order_by(models.PDFTemplate.field_info.is_(None), models.PDFTemplate.id).limit(1)
+    return await db.scalar(stmt)
+
+async def update_template_field_info(db: AsyncSession, db_template, field_info: dict):
+    return await db.run_sync(crud.update_template_field_info, db_template, field_info)
+
+async def update_templates_field_info(db: AsyncSession, field_infos: dict):
+    return await db.run_sync(crud.update_templates_field_info, field_infos)
+
+async def get_templates(db: AsyncSession):
+    return (await db.scalars(select(models.PDFTemplate))).all()
+
+async def get_templates_by_user(db: AsyncSession, user_id: int):
+    return (await db.scalars(select(models.PDFTemplate).where(models.PDFTemplate.owner_id == user_id))).all()
+
+async def get_submissions_by_user(db: AsyncSession, user_id: int):
+    stmt = (
+        select(models.Submission)
+        .options(joinedload(models.Submission.template))
+        .where(models.Submission.buyer_id == user_id)
+    )
+    return (await db.scalars(stmt)).all()
+
+async def get_submission_by_id(db: AsyncSession, submission_id: str):
+    stmt = select(models.Submission).where(models.Submission.anvil_submission_eid == submission_id).limit(1)
+    submission = await db.scalar(stmt)
+    if submission is None:
+        stmt = select(models.ArchivedSubmission).where(models.ArchivedSubmission.anvil_submission_eid == submission_id).limit(1)
+        submission = await db.scalar(stmt)
+    return submission
+
+async def get_submission_history(db: AsyncSession, user_id: int, before_id: Optional[int] = None,
+                                 start: Optional[datetime] = None, end: Optional[datetime] = None, limit: int = 50):
+    return await db.run_sync(crud.get_submission_history, user_id, before_id, start, end, limit)
+
+async def get_downloadable_submission_eids(db: AsyncSession, user: models.User, template_id: Optional[str] = None,
+                                           start: Optional[datetime] = None, end: Optional[datetime] = None):
+    submissions = partitions.all_submissions()
+    stmt = (
+        select(submissions.c.anvil_submission_eid)
+        .join(models.PDFTemplate, models.PDFTemplate.anvil_template_eid == submissions.c.template_id)
+        .order_by(submissions.c.id)
+    )
+    if user.role != "Admin":
+        stmt = stmt.where(or_(submissions.c.buyer_id == user.id, models.PDFTemplate.owner_id == user.id))
+    if template_id is not None:
+        stmt = stmt.where(submissions.c.template_id == template_id)
+    if start is not None:
+        stmt = stmt.where(submissions.c.created_at >= start)
+    if end is not None:
+        stmt = stmt.where(submissions.c.created_at < end)
+    return (await db.scalars(stmt)).all()
+
+async def get_templates_by_eids(db: AsyncSession, template_ids):
+    stmt = select(models.PDFTemplate).where(models.PDFTemplate.anvil_template_eid.in_(template_ids))
+    return (await db.scalars(stmt)).all()
+
+async def get_template(db: AsyncSession, template_id: str):
+    stmt = select(models.PDFTemplate).where(models.PDFTemplate.anvil_template_eid == template_id).limit(1)
+    return await db.scalar(stmt)
+
+# Submission Functions
+async def create_submission(db: AsyncSession, template_id: str, buyer_id: int, anvil_submission_eid: str, filled_pdf_url: str):
+    return await db.run_sync(crud.create_submission, template_id, buyer_id, anvil_submission_eid, filled_pdf_url)
+
+async def bulk_create_submissions(db: AsyncSession, submissions):
+    return await db.run_sync(crud.bulk_create_submissions, submissions)
+
+async def get_latest_submission(db: AsyncSession, template_id: str):
+    stmt = (
+        select(models.Submission)
+        .where(models.Submission.template_id == template_id)
+        .order_by(models.Submission.id.desc())
+        .limit(1)
+    )
+    return await db.scalar(stmt)
+
+# Submission Rollups
+async def rebuild_submission_rollups(db: AsyncSession):
+    await db.run_sync(crud.rebuild_submission_rollups)
+
+async def get_template_submission_stats(db: AsyncSession):
+    stmt = (
+        select(models.PDFTemplate, models.TemplateSubmissionStats)
+        .outerjoin(models.TemplateSubmissionStats, models.TemplateSubmissionStats.template_id == models.PDFTemplate.anvil_template_eid)
+        .order_by(models.PDFTemplate.id)
+    )
+    return (await db.execute(stmt)).all()
+
+async def get_buyer_submission_stats(db: AsyncSession):
+    stmt = (
+        select(models.BuyerSubmissionStats, models.User.email)
+        .join(models.User, models.User.id == models.BuyerSubmissionStats.buyer_id)
+        .order_by(models.BuyerSubmissionStats.total.desc())
+    )
+    return (await db.execute(stmt)).all()
+
+async def get_daily_submission_counts(db: AsyncSession, since: date):
+    stmt = (
+        select(models.DailySubmissionCount)
+        .where(models.DailySubmissionCount.day >= since)
+        .order_by(models.DailySubmissionCount.day)
+    )
+    return (await db.scalars(stmt)).all()
+
+# Draft Functions
+async def get_draft(db: AsyncSession, buyer_id: int, template_id: str):
+    stmt = select(models.FormDraft).where(models.FormDraft.buyer_id == buyer_id, models.FormDraft.template_id == template_id)
+    return await db.scalar(stmt.limit(1))
+
+async def get_draft_by_id(db: AsyncSession, draft_id: int):
+    return await db.get(models.FormDraft, draft_id)
+
+async def get_or_create_draft(db: AsyncSession, buyer_id: int, template_id: str):
+    return await db.run_sync(crud.get_or_create_draft, buyer_id, template_id)
+
+async def append_draft_delta(db: AsyncSession, db_draft: models.FormDraft, patch: dict, expected_version: Optional[int] = None):
+    return await db.run_sync(crud.append_draft_delta, db_draft, patch, expected_version)
+
+async def materialize_draft(db: AsyncSession, db_draft: models.FormDraft) -> dict:
+    return await db.run_sync(crud.materialize_draft, db_draft)
+
+async def compact_draft(db: AsyncSession, db_draft: models.FormDraft):
+    return await db.run_sync(crud.compact_draft, db_draft)
+
+async def delete_draft(db: AsyncSession, db_draft: models.FormDraft):
+    await db.run_sync(crud.delete_draft, db_draft)
+
+# Collection Stamps
+async def get_collection_stamp(db: AsyncSession, model, *criteria):
+    changed_at = func.coalesce(model.updated_at, model.created_at)
+    stmt = select(func.count(model.id), func.max(model.id), func.max(changed_at))
+    if criteria:
+        stmt = stmt.where(*criteria)
+    count, max_id, last_modified = (await db.execute(stmt)).one()
+    return CollectionStamp(count, max_id, last_modified)
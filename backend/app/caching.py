@@ -0,0 +1,77 @@
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Optional, Sequence
+
+from fastapi import Request, Response, status
+
+from .crud import CollectionStamp
+
+
+def collection_etag(stamps: Sequence[CollectionStamp], scope: str = "") -> str:
+    """Builds a weak ETag from the stamps of every table a response is derived from."""
+    digest = hashlib.sha1(scope.encode("utf-8"))
+    for stamp in stamps:
+        digest.update(repr(tuple(stamp)).encode("utf-8"))
+    return f'W/"{digest.hexdigest()}"'
+
+
+def collection_last_modified(stamps: Sequence[CollectionStamp]) -> Optional[datetime]:
+    """Returns the most recent change time across the stamps, as an aware UTC datetime."""
+    timestamps = [s.last_modified for s in stamps if s.last_modified is not None]
+    if not timestamps:
+        return None
+    latest = max(t if t.tzinfo else t.replace(tzinfo=timezone.utc) for t in timestamps)
+    return latest.astimezone(timezone.utc).replace(microsecond=0)
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison function (RFC 9110, 13.1.2).
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
+
+def _not_modified_since(if_modified_since: str, last_modified: Optional[datetime]) -> bool:
+    if last_modified is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    return last_modified <= since
+
+
+def conditional_response(
+    request: Request,
+    response: Response,
+    stamps: Sequence[CollectionStamp],
+    cache_control: str,
+    scope: str = "",
+) -> Optional[Response]:
+    """
+    Sets the validators and Cache-Control policy on `response`.
+    Returns a ready 304 response when the client's copy is still current, so the
+    caller can skip loading and serializing the collection altogether.
+    """
+    etag = collection_etag(stamps, scope=scope)
+    last_modified = collection_last_modified(stamps)
+
+    headers = {"ETag": etag, "Cache-Control": cache_control, "Vary": "Authorization"}
+    if last_modified is not None:
+        headers["Last-Modified"] = format_datetime(last_modified, usegmt=True)
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        fresh = _etag_matches(if_none_match, etag)
+    else:
+        fresh = _not_modified_since(request.headers.get("if-modified-since", ""), last_modified)
+
+    if fresh:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    response.headers.update(headers)
+    return None
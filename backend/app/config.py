@@ -1,2 +1,131 @@
 # Config file to hold environment-specific settings
+import os
+
 SECRET_KEY = "your_secret_key"  # Store in environment variables in production
+
+# --- HTTP caching and compression ---
+
+# Responses smaller than this (in bytes) are sent uncompressed.
+GZIP_MINIMUM_SIZE = int(os.getenv("GZIP_MINIMUM_SIZE", "1024"))
+
+# Cache-Control policy per cached route. "no-cache" lets clients keep a copy
+# but forces them to revalidate with the ETag on every poll.
+CACHE_CONTROL = {
+    "agent_templates": os.getenv("CACHE_CONTROL_AGENT_TEMPLATES", "private, no-cache"),
+    "available_templates": os.getenv("CACHE_CONTROL_AVAILABLE_TEMPLATES", "private, no-cache"),
+    "dashboard": os.getenv("CACHE_CONTROL_DASHBOARD", "private, no-cache"),
+}
+
+# --- Form drafts ---
+
+# Autosave deltas are folded into the draft snapshot once this many have accumulated.
+DRAFT_COMPACTION_THRESHOLD = int(os.getenv("DRAFT_COMPACTION_THRESHOLD", "20"))
+
+# --- Admission control ---
+
+def _rate(name: str, default: str):
+    """Reads a "<requests per second>:<burst>" rate from the environment."""
+    per_second, burst = os.getenv(name, default).split(":")
+    return float(per_second), int(burst)
+
+# Per-caller token bucket rates by role; `None` covers every other caller.
+ADMISSION_RATES = {
+    "upload": {
+        "Agent": _rate("ADMISSION_UPLOAD_RATE_AGENT", "0.2:5"),
+        None: _rate("ADMISSION_UPLOAD_RATE", "0.1:2"),
+    },
+    "fields": {
+        "Buyer": _rate("ADMISSION_FIELDS_RATE_BUYER", "5:30"),
+        None: _rate("ADMISSION_FIELDS_RATE", "1:10"),
+    },
+    "preview": {
+        "Buyer": _rate("ADMISSION_PREVIEW_RATE_BUYER", "2:20"),
+        None: _rate("ADMISSION_PREVIEW_RATE", "1:5"),
+    },
+    "submit": {
+        "Buyer": _rate("ADMISSION_SUBMIT_RATE_BUYER", "0.5:10"),
+        None: _rate("ADMISSION_SUBMIT_RATE", "0.2:5"),
+    },
+}
+
+# Requests allowed to run at once per worker on the Anvil-backed routes.
+ADMISSION_CONCURRENCY = {
+    "upload": int(os.getenv("ADMISSION_UPLOAD_CONCURRENCY", "4")),
+    "fields": int(os.getenv("ADMISSION_FIELDS_CONCURRENCY", "16")),
+    "submit": int(os.getenv("ADMISSION_SUBMIT_CONCURRENCY", "8")),
+}
+# How many further requests may wait for a slot, and for how long (seconds).
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "16"))
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "10"))
+
+# --- Batch field schemas ---
+
+# Most template ids accepted by POST /api/templates/fields/batch.
+FIELDS_BATCH_MAX_TEMPLATES = int(os.getenv("FIELDS_BATCH_MAX_TEMPLATES", "100"))
+# Anvil get_cast calls made at once for schemas not cached yet.
+FIELDS_BATCH_CONCURRENCY = int(os.getenv("FIELDS_BATCH_CONCURRENCY", "8"))
+# From this many uncached schemas on, list every cast in one get_casts call instead.
+FIELDS_BATCH_BULK_THRESHOLD = int(os.getenv("FIELDS_BATCH_BULK_THRESHOLD", "10"))
+
+# --- Submission PDF retention ---
+
+def _template_policies(name: str):
+    """Reads "<template eid>:<days>|never,..." per-template packing ages from the environment."""
+    policies = {}
+    for entry in filter(None, (e.strip() for e in os.getenv(name, "").split(","))):
+        template_id, days = entry.rsplit(":", 1)
+        policies[template_id] = None if days == "never" else float(days)
+    return policies
+
+# Submission PDFs older than this many days are moved into compressed packs.
+RETENTION_PACK_AFTER_DAYS = float(os.getenv("RETENTION_PACK_AFTER_DAYS", "90"))
+# Per-template overrides of the above; "never" keeps a template's PDFs loose.
+RETENTION_TEMPLATE_POLICIES = _template_policies("RETENTION_TEMPLATE_POLICIES")
+# Stored PDFs without a submission are deleted once their file is this old, which
+# leaves time for the submission row to be committed after the file is written.
+RETENTION_ORPHAN_GRACE_HOURS = float(os.getenv("RETENTION_ORPHAN_GRACE_HOURS", "24"))
+# Upper bound on the uncompressed size of one pack file.
+RETENTION_PACK_MAX_BYTES = int(os.getenv("RETENTION_PACK_MAX_BYTES", str(256 * 1024 * 1024)))
+# Disk throughput (read plus write) a sweep may use, so it does not starve requests.
+RETENTION_IO_BYTES_PER_SECOND = int(os.getenv("RETENTION_IO_BYTES_PER_SECOND", str(8 * 1024 * 1024)))
+# Run a sweep in the background every this many hours; unset to only sweep on demand.
+RETENTION_INTERVAL_HOURS = os.getenv("RETENTION_INTERVAL_HOURS")
+
+# --- Server-sent events ---
+
+# Recent events kept in memory so reconnecting clients can resume with Last-Event-ID.
+EVENTS_HISTORY_SIZE = int(os.getenv("EVENTS_HISTORY_SIZE", "1000"))
+# Seconds between keepalive comments on an idle stream (keeps proxies from closing it).
+EVENTS_HEARTBEAT_SECONDS = float(os.getenv("EVENTS_HEARTBEAT_SECONDS", "15"))
+# Events buffered per connected client; a client that falls further behind is disconnected and resumes.
+EVENTS_SUBSCRIBER_QUEUE_SIZE = int(os.getenv("EVENTS_SUBSCRIBER_QUEUE_SIZE", "100"))
+
+# --- PDF downloads ---
+
+# Lifetime of URLs from /api/submissions/{id}/download-url.
+DOWNLOAD_URL_TTL_SECONDS = int(os.getenv("DOWNLOAD_URL_TTL_SECONDS", "300"))
+# "x-accel": answer authorised downloads with X-Accel-Redirect and let nginx send
+# the file; anything else streams it from Python.
+DOWNLOAD_OFFLOAD = os.getenv("DOWNLOAD_OFFLOAD", "")
+# nginx `internal` location aliased to PDF_STORAGE_PATH.
+DOWNLOAD_ACCEL_PREFIX = os.getenv("DOWNLOAD_ACCEL_PREFIX", "/protected-pdfs/")
+
+# --- Template metadata cache ---
+
+# Templates kept in each worker's in-process cache (least recently used are evicted).
+TEMPLATE_CACHE_SIZE = int(os.getenv("TEMPLATE_CACHE_SIZE", "1000"))
+# Seconds between checks of the shared change counter; bounds how long a change
+# made by another worker can go unseen.
+TEMPLATE_CACHE_CHECK_SECONDS = float(os.getenv("TEMPLATE_CACHE_CHECK_SECONDS", "2"))
+
+# --- Submission archive ---
+
+# Whole months kept in the hot `submissions` table before the current one; older
+# months are moved to `submissions_archive` by the rollover job (app.partitions).
+SUBMISSIONS_HOT_MONTHS = int(os.getenv("SUBMISSIONS_HOT_MONTHS", "3"))
+# Submissions moved per transaction by the rollover job.
+SUBMISSIONS_ROLLOVER_BATCH_SIZE = int(os.getenv("SUBMISSIONS_ROLLOVER_BATCH_SIZE", "5000"))
+# Run the rollover in the background every this many hours; unset to only run it on demand.
+SUBMISSIONS_ROLLOVER_INTERVAL_HOURS = os.getenv("SUBMISSIONS_ROLLOVER_INTERVAL_HOURS")
+# Largest page served by /api/submissions/history.
+SUBMISSION_HISTORY_MAX_LIMIT = int(os.getenv("SUBMISSION_HISTORY_MAX_LIMIT", "200"))
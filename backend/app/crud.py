@@ -1,55 +1,461 @@
 # backend/app/crud.py
+from collections import Counter
+from datetime import date, datetime
+from typing import List, NamedTuple, Optional, Sequence
+
+from sqlalchemy import case, func, insert, lambda_stmt, or_, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session, joinedload
-from . import models, schemas
+from . import config, events, models, partitions, schemas, search, template_cache
 from .security import get_password_hash
 
+# Hot lookups use lambda statements: the statement is built and its cache key
+# computed once per call site, rather than on every call.
+
+def _commit_keeping(db: Session, *instances):
+    """
+    Commits without expiring `instances`, whose state was just loaded by
+    INSERT ... RETURNING, so reading them afterwards needs no refresh SELECT.
+    """
+    for instance in instances:
+        db.expunge(instance)
+    db.commit()
+    for instance in instances:
+        db.add(instance)
+
 # User Functions
 def get_user_by_email(db: Session, email: str):
-    return db.query(models.User).filter(models.User.email == email).first()
+    return db.scalar(lambda_stmt(lambda: select(models.User).where(models.User.email == email).limit(1)))
 
 def create_user(db: Session, user: schemas.UserBase):
     hashed_password = get_password_hash(user.password)
-    db_user = models.User(email=user.email, role=user.role, hashed_password=hashed_password)
-    db.add(db_user)
+    stmt = insert(models.User).values(email=user.email, role=user.role, hashed_password=hashed_password)
+    db_user = db.scalar(stmt.returning(models.User))
+    _commit_keeping(db, db_user)
+    return db_user
+
+def update_user_password_hash(db: Session, db_user: models.User, hashed_password: str):
+    db_user.hashed_password = hashed_password
     db.commit()
-    db.refresh(db_user)
     return db_user
 
 # Template Functions
-def create_template(db: Session, title: str, owner_id: int, anvil_template_eid: str):
-    db_template = models.PDFTemplate(title=title, owner_id=owner_id, anvil_template_eid=anvil_template_eid)
-    db.add(db_template)
-    db.commit()
-    db.refresh(db_template)
+def create_template(db: Session, title: str, owner_id: int, anvil_template_eid: str, field_info: Optional[dict] = None,
+                    content_hash: Optional[str] = None):
+    stmt = insert(models.PDFTemplate).values(
+        title=title, owner_id=owner_id, anvil_template_eid=anvil_template_eid, field_info=field_info, content_hash=content_hash
+    )
+    db_template = db.scalar(stmt.returning(models.PDFTemplate))
+    search.index_template(db, db_template)
+    version = _bump_template_version(db)
+    _commit_keeping(db, db_template)
+    template_cache.templates.put(db_template, version)
+    events.publish_template_created(db_template)
     return db_template
 
+def bulk_create_templates(db: Session, templates: Sequence[dict]) -> List:
+    """
+    Inserts many templates (dicts of create_template's arguments) with one
+    multi-row INSERT ... RETURNING and indexes them in one statement.
+    Returns the inserted rows in the order given.
+    """
+    if not templates:
+        return []
+    table = models.PDFTemplate.__table__
+    values = [{"field_info": None, "content_hash": None, **t} for t in templates]
+    rows = db.execute(insert(table).returning(*table.c, sort_by_parameter_order=True), values).all()
+    search.index_templates(db, [row.id for row in rows])
+    version = _bump_template_version(db)
+    db.commit()
+    for row in rows:
+        template_cache.templates.put(row, version)
+        events.publish_template_created(row)
+    return rows
+
+def get_template_by_content_hash(db: Session, content_hash: str, owner_id: Optional[int] = None):
+    """Earliest template cast from identical bytes, preferring the owner's own and ones with cached fields."""
+    stmt = select(models.PDFTemplate).where(models.PDFTemplate.content_hash == content_hash)
+    if owner_id is not None:
+        stmt = stmt.order_by((models.PDFTemplate.owner_id == owner_id).desc())
+    stmt = stmt.order_by(models.PDFTemplate.field_info.is_(None), models.PDFTemplate.id).limit(1)
+    return db.scalar(stmt)
+
+def update_template_field_info(db: Session, db_template, field_info: dict):
+    """`db_template` may be a PDFTemplate or a template_cache.CachedTemplate."""
+    return update_templates_field_info(db, {db_template: field_info})[0]
+
+def update_templates_field_info(db: Session, field_infos: dict):
+    """Caches `fieldInfo` on several templates, keyed by PDFTemplate or CachedTemplate, in one commit."""
+    db_templates = []
+    for template, field_info in field_infos.items():
+        db_template = db.get(models.PDFTemplate, template.id)
+        db_template.field_info = field_info
+        db_templates.append(db_template)
+    version = _bump_template_version(db)
+    db.commit()
+    for db_template in db_templates:
+        template_cache.templates.put(db_template, version)
+    return db_templates
+
+def _bump_template_version(db: Session) -> int:
+    """Advances the `templates` change counter in the current transaction and returns its new value."""
+    model = models.CacheVersion
+    key = {"name": template_cache.VERSION_NAME}
+    dialect = _UPSERT_DIALECTS.get(db.get_bind().dialect.name)
+    if dialect is None:
+        if not db.query(model).filter_by(**key).update({model.version: model.version + 1}):
+            db.add(model(**key, version=1))
+    else:
+        stmt = dialect.insert(model).values(**key, version=1)
+        db.execute(stmt.on_conflict_do_update(index_elements=list(key), set_={"version": model.version + 1}))
+    return db.scalar(template_cache.version_query())
+
 def get_templates(db: Session):
-    return db.query(models.PDFTemplate).all()
+    return db.scalars(lambda_stmt(lambda: select(models.PDFTemplate))).all()
 
 def get_templates_by_user(db: Session, user_id: int):
-    return db.query(models.PDFTemplate).filter(models.PDFTemplate.owner_id == user_id).all()
+    return db.scalars(lambda_stmt(lambda: select(models.PDFTemplate).where(models.PDFTemplate.owner_id == user_id))).all()
 
 def get_submissions_by_user(db: Session, user_id: int):
-    return db.query(models.Submission).options(joinedload(models.Submission.template)).filter(models.Submission.buyer_id == user_id).all()
+    """The buyer's recent submissions, from the hot table only; see get_submission_history."""
+    stmt = lambda_stmt(
+        lambda: select(models.Submission)
+        .options(joinedload(models.Submission.template))
+        .where(models.Submission.buyer_id == user_id)
+    )
+    return db.scalars(stmt).all()
 
 def get_submission_by_id(db: Session, submission_id: str):
-    return db.query(models.Submission).filter(models.Submission.anvil_submission_eid == submission_id).first()
+    stmt = lambda_stmt(
+        lambda: select(models.Submission).where(models.Submission.anvil_submission_eid == submission_id).limit(1)
+    )
+    submission = db.scalar(stmt)
+    if submission is None:
+        # Older submissions have been rolled over into the archive.
+        stmt = lambda_stmt(
+            lambda: select(models.ArchivedSubmission)
+            .where(models.ArchivedSubmission.anvil_submission_eid == submission_id)
+            .limit(1)
+        )
+        submission = db.scalar(stmt)
+    return submission
+
+def get_submission_history(db: Session, user_id: int, before_id: Optional[int] = None,
+                           start: Optional[datetime] = None, end: Optional[datetime] = None, limit: int = 50):
+    """
+    The buyer's submissions from both the hot table and the archive, newest first.
+    Pass the last id of a page as `before_id` to get the next one.
+    """
+    submissions = []
+    for model in (models.Submission, models.ArchivedSubmission):
+        stmt = select(model).options(joinedload(model.template)).where(model.buyer_id == user_id)
+        if before_id is not None:
+            stmt = stmt.where(model.id < before_id)
+        if start is not None:
+            stmt = stmt.where(model.created_at >= start)
+        if end is not None:
+            stmt = stmt.where(model.created_at < end)
+        submissions += db.scalars(stmt.order_by(model.id.desc()).limit(limit)).all()
+    return sorted(submissions, key=lambda s: s.id, reverse=True)[:limit]
+
+def get_downloadable_submission_eids(db: Session, user: models.User, template_id: Optional[str] = None,
+                                     start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """
+    Eids of every submission `user` may download, authorised in a single query with the
+    same rules as a single download: the buyer, the owner of the template, or any admin.
+    """
+    submissions = partitions.all_submissions()
+    query = (
+        db.query(submissions.c.anvil_submission_eid)
+        .join(models.PDFTemplate, models.PDFTemplate.anvil_template_eid == submissions.c.template_id)
+    )
+    if user.role != "Admin":
+        query = query.filter(or_(submissions.c.buyer_id == user.id, models.PDFTemplate.owner_id == user.id))
+    if template_id is not None:
+        query = query.filter(submissions.c.template_id == template_id)
+    if start is not None:
+        query = query.filter(submissions.c.created_at >= start)
+    if end is not None:
+        query = query.filter(submissions.c.created_at < end)
+    return [eid for (eid,) in query.order_by(submissions.c.id)]
+
+def get_templates_by_eids(db: Session, template_ids):
+    stmt = select(models.PDFTemplate).where(models.PDFTemplate.anvil_template_eid.in_(template_ids))
+    return db.scalars(stmt).all()
 
 def get_template(db: Session, template_id: int):
-    return db.query(models.PDFTemplate).filter(models.PDFTemplate.anvil_template_eid == template_id).first()
+    stmt = lambda_stmt(
+        lambda: select(models.PDFTemplate).where(models.PDFTemplate.anvil_template_eid == template_id).limit(1)
+    )
+    return db.scalar(stmt)
 
 # Submission Functions
 def create_submission(db: Session, template_id: int, buyer_id: int, anvil_submission_eid: str, filled_pdf_url: str):
-    db_submission = models.Submission(
+    stmt = insert(models.Submission).values(
         template_id=template_id,
         buyer_id=buyer_id,
         anvil_submission_eid=anvil_submission_eid,
         filled_pdf_url=filled_pdf_url
     )
-    db.add(db_submission)
-    db.commit()
-    db.refresh(db_submission)
+    db_submission = db.scalar(stmt.returning(models.Submission))
+    _record_submission_rollups(db, db_submission)
+    search.index_submission(db, db_submission)
+    _commit_keeping(db, db_submission)
+    _publish_submissions_created(db, [db_submission])
     return db_submission
 
+def bulk_create_submissions(db: Session, submissions: Sequence[dict]) -> List:
+    """
+    Inserts many submissions (dicts of create_submission's arguments) with one
+    multi-row INSERT ... RETURNING, folding the rollup updates per key and
+    indexing them in one statement. Returns the inserted rows in the order given.
+    """
+    if not submissions:
+        return []
+    table = models.Submission.__table__
+    values = [{"filled_pdf_url": None, **s} for s in submissions]
+    rows = db.execute(insert(table).returning(*table.c, sort_by_parameter_order=True), values).all()
+
+    by_template, by_buyer = Counter(r.template_id for r in rows), Counter(r.buyer_id for r in rows)
+    by_day = Counter((r.template_id, r.created_at.date()) for r in rows)
+    last_by_template = {r.template_id: r.id for r in sorted(rows, key=lambda r: r.id)}
+    last_by_buyer = {r.buyer_id: r.id for r in sorted(rows, key=lambda r: r.id)}
+    for template_id, count in by_template.items():
+        _increment_rollup(db, models.TemplateSubmissionStats, {"template_id": template_id}, amount=count,
+                          last_submission_id=last_by_template[template_id])
+    for (template_id, day), count in by_day.items():
+        _increment_rollup(db, models.DailySubmissionCount, {"template_id": template_id, "day": day}, amount=count)
+    for buyer_id, count in by_buyer.items():
+        _increment_rollup(db, models.BuyerSubmissionStats, {"buyer_id": buyer_id}, amount=count,
+                          last_submission_id=last_by_buyer[buyer_id])
+    search.index_submissions(db, [row.id for row in rows])
+    db.commit()
+    _publish_submissions_created(db, rows)
+    return rows
+
+def _publish_submissions_created(db: Session, submissions):
+    for submission in submissions:
+        # Usually a cache hit, so announcing the submission costs no query.
+        template = template_cache.templates.get_by_eid(db, submission.template_id)
+        events.publish_submission_created(submission, template.owner_id if template else None)
+
 def get_latest_submission(db: Session, template_id: str):
-    return db.query(models.Submission).filter(models.Submission.template_id == template_id).order_by(models.Submission.id.desc()).first()
\ No newline at end of file
+    # The rollover keeps each template's latest submission hot.
+    stmt = lambda_stmt(
+        lambda: select(models.Submission)
+        .where(models.Submission.template_id == template_id)
+        .order_by(models.Submission.id.desc())
+        .limit(1)
+    )
+    return db.scalar(stmt)
+
+# Submission Rollups
+_UPSERT_DIALECTS = {"sqlite": sqlite, "postgresql": postgresql}
+
+def _increment_rollup(db: Session, model, key: dict, amount: int = 1, last_submission_id: Optional[int] = None):
+    """
+    Atomically adds `amount` to `model.total` for the row at `key`, creating it if needed,
+    and raises `last_submission_id` to the given id unless it already points at a later one.
+    """
+    values, updates = {}, {"total": model.total + amount}
+    if last_submission_id is not None:
+        values["last_submission_id"] = last_submission_id
+        # NULL >= id is not true either, so an unset column takes the id.
+        updates["last_submission_id"] = case(
+            (model.last_submission_id >= last_submission_id, model.last_submission_id), else_=last_submission_id
+        )
+    dialect = _UPSERT_DIALECTS.get(db.get_bind().dialect.name)
+    if dialect is None:
+        updated = db.query(model).filter_by(**key).update(updates, synchronize_session=False)
+        if not updated:
+            db.add(model(**key, total=amount, **values))
+        return
+    stmt = dialect.insert(model).values(**key, total=amount, **values)
+    stmt = stmt.on_conflict_do_update(index_elements=list(key), set_=updates)
+    db.execute(stmt)
+
+def _record_submission_rollups(db: Session, submission: models.Submission):
+    # The day as the database sees created_at, matching rebuild_submission_rollups.
+    day = submission.created_at.date()
+    _increment_rollup(db, models.TemplateSubmissionStats, {"template_id": submission.template_id}, last_submission_id=submission.id)
+    _increment_rollup(db, models.BuyerSubmissionStats, {"buyer_id": submission.buyer_id}, last_submission_id=submission.id)
+    _increment_rollup(db, models.DailySubmissionCount, {"template_id": submission.template_id, "day": day})
+
+def rebuild_submission_rollups(db: Session):
+    """
+    Recomputes every rollup table from `submissions` and its archive. Used to backfill existing data.
+    Totals and daily counts cover both; last_submission_id is a foreign key to `submissions`, so it
+    only ever names a hot row (None when all of a template's or buyer's submissions are archived).
+    """
+    S = partitions.all_submissions().c
+    H = models.Submission
+    day = func.date(S.created_at, type_=models.DailySubmissionCount.day.type)
+    for model in (models.TemplateSubmissionStats, models.BuyerSubmissionStats, models.DailySubmissionCount):
+        db.query(model).delete()
+    latest_for_template = select(func.max(H.id)).where(H.template_id == S.template_id).scalar_subquery()
+    db.execute(insert(models.TemplateSubmissionStats).from_select(
+        ["template_id", "total", "last_submission_id"],
+        select(S.template_id, func.count(S.id), latest_for_template).group_by(S.template_id),
+    ))
+    latest_for_buyer = select(func.max(H.id)).where(H.buyer_id == S.buyer_id).scalar_subquery()
+    db.execute(insert(models.BuyerSubmissionStats).from_select(
+        ["buyer_id", "total", "last_submission_id"],
+        select(S.buyer_id, func.count(S.id), latest_for_buyer).group_by(S.buyer_id),
+    ))
+    db.execute(insert(models.DailySubmissionCount).from_select(
+        ["template_id", "day", "total"],
+        select(S.template_id, day, func.count(S.id)).group_by(S.template_id, day),
+    ))
+    db.commit()
+
+def get_template_submission_stats(db: Session):
+    """Every template with its rollup row (None when it has no submissions yet)."""
+    return (
+        db.query(models.PDFTemplate, models.TemplateSubmissionStats)
+        .outerjoin(models.TemplateSubmissionStats, models.TemplateSubmissionStats.template_id == models.PDFTemplate.anvil_template_eid)
+        .order_by(models.PDFTemplate.id)
+        .all()
+    )
+
+def get_dashboard_rows(db: Session):
+    """
+    Every template (with its owner loaded) and its latest submission, in one query:
+    the rollup's last_submission_id, which always names a hot row, joined to `submissions`.
+    """
+    return (
+        db.query(models.PDFTemplate, models.Submission)
+        .options(joinedload(models.PDFTemplate.owner))
+        .outerjoin(models.TemplateSubmissionStats, models.TemplateSubmissionStats.template_id == models.PDFTemplate.anvil_template_eid)
+        .outerjoin(models.Submission, models.Submission.id == models.TemplateSubmissionStats.last_submission_id)
+        .order_by(models.PDFTemplate.id)
+        .all()
+    )
+
+def get_buyer_submission_stats(db: Session):
+    return (
+        db.query(models.BuyerSubmissionStats, models.User.email)
+        .join(models.User, models.User.id == models.BuyerSubmissionStats.buyer_id)
+        .order_by(models.BuyerSubmissionStats.total.desc())
+        .all()
+    )
+
+def get_daily_submission_counts(db: Session, since: date):
+    return (
+        db.query(models.DailySubmissionCount)
+        .filter(models.DailySubmissionCount.day >= since)
+        .order_by(models.DailySubmissionCount.day)
+        .all()
+    )
+
+# Draft Functions
+def apply_merge_patch(target, patch):
+    """Applies an RFC 7386 JSON merge patch and returns the result; `target` is not modified."""
+    if not isinstance(patch, dict):
+        return patch
+    result = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = apply_merge_patch(result.get(key), value)
+    return result
+
+def get_draft(db: Session, buyer_id: int, template_id: str):
+    return db.query(models.FormDraft).filter(
+        models.FormDraft.buyer_id == buyer_id, models.FormDraft.template_id == template_id
+    ).first()
+
+def get_draft_by_id(db: Session, draft_id: int):
+    return db.query(models.FormDraft).filter(models.FormDraft.id == draft_id).first()
+
+def get_or_create_draft(db: Session, buyer_id: int, template_id: str):
+    """
+    Concurrent first autosaves (two tabs, a retry) race to insert the draft; the
+    loser hits the (buyer_id, template_id) unique constraint and returns the winner's.
+    """
+    db_draft = get_draft(db, buyer_id, template_id)
+    if db_draft is not None:
+        return db_draft
+    db_draft = models.FormDraft(buyer_id=buyer_id, template_id=template_id, data={}, version=0, compacted_version=0)
+    db.add(db_draft)
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        existing = get_draft(db, buyer_id, template_id)
+        if existing is None:
+            raise
+        return existing
+    db.refresh(db_draft)
+    return db_draft
+
+def append_draft_delta(db: Session, db_draft: models.FormDraft, patch: dict, expected_version: Optional[int] = None):
+    """
+    Appends one autosave delta. The version bump is a conditional UPDATE, so concurrent
+    writers (or a stale `expected_version`) lose cleanly: returns None instead of the new version.
+    """
+    current = db_draft.version if expected_version is None else expected_version
+    bumped = db.query(models.FormDraft).filter(
+        models.FormDraft.id == db_draft.id, models.FormDraft.version == current
+    ).update({models.FormDraft.version: current + 1}, synchronize_session=False)
+    if not bumped:
+        db.rollback()
+        return None
+    db.add(models.FormDraftDelta(draft_id=db_draft.id, version=current + 1, patch=patch))
+    db.commit()
+    db.refresh(db_draft)
+    if db_draft.version - db_draft.compacted_version >= config.DRAFT_COMPACTION_THRESHOLD:
+        compact_draft(db, db_draft)
+    return db_draft.version
+
+def _pending_deltas(db: Session, db_draft: models.FormDraft):
+    return db.query(models.FormDraftDelta).filter(
+        models.FormDraftDelta.draft_id == db_draft.id,
+        models.FormDraftDelta.version > db_draft.compacted_version,
+    ).order_by(models.FormDraftDelta.version).all()
+
+def materialize_draft(db: Session, db_draft: models.FormDraft) -> dict:
+    """The current document: the compacted snapshot with pending deltas applied in order."""
+    data = db_draft.data or {}
+    for delta in _pending_deltas(db, db_draft):
+        data = apply_merge_patch(data, delta.patch)
+    return data
+
+def compact_draft(db: Session, db_draft: models.FormDraft):
+    """Folds pending deltas into the snapshot and drops them from the log."""
+    deltas = _pending_deltas(db, db_draft)
+    if not deltas:
+        return db_draft
+    data = db_draft.data or {}
+    for delta in deltas:
+        data = apply_merge_patch(data, delta.patch)
+    db_draft.data = data
+    db_draft.compacted_version = deltas[-1].version
+    db.query(models.FormDraftDelta).filter(
+        models.FormDraftDelta.draft_id == db_draft.id,
+        models.FormDraftDelta.version <= db_draft.compacted_version,
+    ).delete(synchronize_session=False)
+    db.commit()
+    db.refresh(db_draft)
+    return db_draft
+
+def delete_draft(db: Session, db_draft: models.FormDraft):
+    db.query(models.FormDraftDelta).filter(models.FormDraftDelta.draft_id == db_draft.id).delete(synchronize_session=False)
+    db.delete(db_draft)
+    db.commit()
+
+# Collection Stamps
+class CollectionStamp(NamedTuple):
+    """Cheap fingerprint of a table (or a filtered slice of it) used for HTTP validators."""
+    count: int
+    max_id: Optional[int]
+    last_modified: Optional[datetime]
+
+def get_collection_stamp(db: Session, model, *criteria):
+    changed_at = func.coalesce(model.updated_at, model.created_at)
+    query = db.query(func.count(model.id), func.max(model.id), func.max(changed_at))
+    if criteria:
+        query = query.filter(*criteria)
+    count, max_id, last_modified = query.one()
+    return CollectionStamp(count, max_id, last_modified)
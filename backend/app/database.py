@@ -1,4 +1,6 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, DeclarativeBase
 from dotenv import load_dotenv
@@ -14,7 +16,48 @@ DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./test.db")
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async drivers used for the same database: aiosqlite locally, asyncpg on Postgres.
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg"}
+
+def get_async_database_url(url: str) -> str:
+    """Maps a sync database URL onto the async driver for the same backend."""
+    sync_url = make_url(url)
+    backend = sync_url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for '{backend}' databases")
+    return sync_url.set(drivername=ASYNC_DRIVERS[backend]).render_as_string(hide_password=False)
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", get_async_database_url(DATABASE_URL))
+
+# Async SQLAlchemy setup. Objects stay usable after commit so handlers don't
+# trigger implicit (and, under asyncio, illegal) lazy refreshes.
+async_engine = create_async_engine(ASYNC_DATABASE_URL)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 # Base model for declarative class definitions
 class Base(DeclarativeBase):
     pass
 
+def create_tables(bind):
+    """
+    Creates missing tables, then adds nullable columns (and their indexes)
+    introduced since an existing table was created, which create_all leaves out.
+    """
+    Base.metadata.create_all(bind=bind)
+    inspector = inspect(bind)
+    preparer = bind.dialect.identifier_preparer
+    with bind.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            missing = [column for column in table.columns if column.name not in existing]
+            for column in missing:
+                if not column.nullable:
+                    raise RuntimeError(f"Cannot add NOT NULL column {table.name}.{column.name} to an existing table")
+                connection.execute(text(
+                    f"ALTER TABLE {preparer.format_table(table)} "
+                    f"ADD COLUMN {preparer.format_column(column)} {column.type.compile(dialect=bind.dialect)}"
+                ))
+                print(f"Added column {table.name}.{column.name}")
+            if missing:
+                for index in table.indexes:
+                    index.create(connection, checkfirst=True)
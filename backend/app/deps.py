@@ -1,13 +1,17 @@
-from fastapi import Depends, HTTPException, status
+from typing import Optional
+
+from fastapi import Depends, HTTPException, Query, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
-from . import crud, models, schemas, security
-from .database import SessionLocal
+from . import async_crud, crud, models, schemas, security
+from .database import AsyncSessionLocal, SessionLocal
 
 # This tells FastAPI where to look for the token
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/token")
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/token", auto_error=False)
 
 def get_db():
     db = SessionLocal()
@@ -16,39 +20,81 @@ def get_db():
     finally:
         db.close()
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    """
-    Decodes the JWT token to get the current user.
-    """
-    credentials_exception = HTTPException(
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+def _credentials_exception():
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+def _decode_token(token: str) -> schemas.TokenData:
     try:
         payload = jwt.decode(token, security.SECRET_KEY, algorithms=[security.ALGORITHM])
         email: str = payload.get("sub")
         if email is None:
-            raise credentials_exception
-        token_data = schemas.TokenData(email=email)
+            raise _credentials_exception()
+        return schemas.TokenData(email=email, role=payload.get("role"))
     except JWTError:
-        raise credentials_exception
-    
+        raise _credentials_exception()
+
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    """
+    Decodes the JWT token to get the current user.
+    """
+    token_data = _decode_token(token)
     user = crud.get_user_by_email(db, email=token_data.email)
     if user is None:
-        raise credentials_exception
+        raise _credentials_exception()
     return user
 
+async def get_current_user_async(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)):
+    """
+    Same as get_current_user, for `async def` endpoints running on the async session.
+    """
+    token_data = _decode_token(token)
+    user = await async_crud.get_user_by_email(db, email=token_data.email)
+    if user is None:
+        raise _credentials_exception()
+    return user
+
+async def get_event_stream_user(
+    token: Optional[str] = Depends(optional_oauth2_scheme),
+    access_token: Optional[str] = Query(None, description="Bearer token, for EventSource clients that cannot send headers"),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    Same as get_current_user_async, but also accepts the token as a query
+    parameter because the browser EventSource API cannot set headers.
+    """
+    token = token or access_token
+    if not token:
+        raise _credentials_exception()
+    return await get_current_user_async(token, db)
+
 def agent_only(current_user: models.User = Depends(get_current_user)):
     if current_user.role != "Agent":
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Operation not permitted")
     return current_user
 
+async def agent_only_async(current_user: models.User = Depends(get_current_user_async)):
+    if current_user.role != "Agent":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Operation not permitted")
+    return current_user
+
 def buyer_only(current_user: models.User = Depends(get_current_user)):
     if current_user.role != "Buyer":
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Operation not permitted")
     return current_user
 
+async def buyer_only_async(current_user: models.User = Depends(get_current_user_async)):
+    if current_user.role != "Buyer":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Operation not permitted")
+    return current_user
+
 def admin_only(current_user: models.User = Depends(get_current_user)):
     if current_user.role != "Admin":
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Operation not permitted")
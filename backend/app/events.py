@@ -0,0 +1,157 @@
+"""
+In-process pub/sub for server-sent events.
+
+crud publishes an event after each template or submission is committed; every
+connected /api/events stream receives the ones its user may see:
+  * Admin: everything;
+  * Agent: templates they own and submissions against them;
+  * Buyer: new templates and their own submissions.
+
+Event ids are "<boot>-<sequence>". The last EVENTS_HISTORY_SIZE events are kept
+so a client reconnecting with Last-Event-ID gets what it missed; if that is no
+longer possible (the id is too old or from before a restart) it receives a
+`reset` event and should refetch. The bus lives in one process: with several
+workers, a client only sees events published by the worker it is connected to.
+"""
+import asyncio
+import json
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from . import config, models, schemas
+
+# How long browsers wait before reconnecting a dropped stream.
+RECONNECT_DELAY_MS = 3000
+
+
+@dataclass(frozen=True)
+class Event:
+    seq: int
+    id: str
+    type: str
+    data: dict
+    owner_id: Optional[int] = None  # Owner of the template the event concerns
+    buyer_id: Optional[int] = None
+
+    def visible_to(self, user_id: int, role: str) -> bool:
+        if role == "Admin":
+            return True
+        if role == "Agent":
+            return self.owner_id == user_id
+        if role == "Buyer":
+            return self.type == "template.created" or self.buyer_id == user_id
+        return False
+
+    def encode(self) -> str:
+        return f"id: {self.id}\nevent: {self.type}\ndata: {json.dumps(self.data)}\n\n"
+
+
+class Subscription:
+    """One connected stream: a bounded queue fed from whichever thread publishes."""
+
+    def __init__(self, queue_size: int):
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+
+    def _put(self, event: Event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Too far behind: end the stream; the client resumes from history.
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+    def deliver(self, event: Event):
+        self.loop.call_soon_threadsafe(self._put, event)
+
+
+class EventBus:
+    def __init__(self, history_size: int):
+        self.boot = format(int(time.time() * 1000), "x")
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._history: deque = deque(maxlen=history_size)
+        self._subscribers: set = set()
+
+    def publish(self, type: str, data: dict, owner_id: Optional[int] = None, buyer_id: Optional[int] = None) -> Event:
+        with self._lock:
+            self._seq += 1
+            event = Event(self._seq, f"{self.boot}-{self._seq}", type, data, owner_id, buyer_id)
+            self._history.append(event)
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            try:
+                subscription.deliver(event)
+            except RuntimeError:
+                # Its event loop has been closed.
+                self.unsubscribe(subscription)
+        return event
+
+    def subscribe(self, last_event_id: Optional[str] = None,
+                  queue_size: int = config.EVENTS_SUBSCRIBER_QUEUE_SIZE) -> Tuple[Subscription, List[Event], Optional[str]]:
+        """
+        Registers a stream. Returns it with the events after `last_event_id` to
+        replay and, when the client missed events that can no longer be replayed,
+        the id to send with the `reset` event.
+        """
+        subscription = Subscription(queue_size)
+        with self._lock:
+            # Registering under the lock means nothing falls between replay and live events.
+            self._subscribers.add(subscription)
+            if last_event_id is None:
+                return subscription, [], None
+            reset_id = f"{self.boot}-{self._seq}"
+            boot, _, seq = last_event_id.partition("-")
+            if boot != self.boot or not seq.isdigit() or int(seq) > self._seq:
+                return subscription, [], reset_id
+            oldest = self._history[0].seq if self._history else self._seq + 1
+            if int(seq) < oldest - 1:
+                return subscription, [], reset_id
+            return subscription, [e for e in self._history if e.seq > int(seq)], None
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+
+bus = EventBus(config.EVENTS_HISTORY_SIZE)
+
+
+def publish_template_created(template: models.PDFTemplate):
+    data = schemas.PDFTemplate.model_validate(template).model_dump(mode="json")
+    bus.publish("template.created", data, owner_id=template.owner_id)
+
+
+def publish_submission_created(submission: models.Submission, template_owner_id: Optional[int]):
+    data = schemas.Submission.model_validate(submission).model_dump(mode="json")
+    bus.publish("submission.created", data, owner_id=template_owner_id, buyer_id=submission.buyer_id)
+
+
+async def event_stream(user: models.User, last_event_id: Optional[str] = None,
+                       heartbeat: float = config.EVENTS_HEARTBEAT_SECONDS, event_bus: EventBus = bus):
+    """Yields the SSE wire format for `user` until the client disconnects or falls too far behind."""
+    user_id, role = user.id, user.role
+    subscription, replay, reset_id = event_bus.subscribe(last_event_id)
+    try:
+        yield f"retry: {RECONNECT_DELAY_MS}\n\n"
+        if reset_id is not None:
+            yield f"id: {reset_id}\nevent: reset\ndata: {{}}\n\n"
+        for event in replay:
+            if event.visible_to(user_id, role):
+                yield event.encode()
+        while True:
+            try:
+                event = await asyncio.wait_for(subscription.queue.get(), heartbeat)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            if event is None:
+                return
+            if event.visible_to(user_id, role):
+                yield event.encode()
+    finally:
+        event_bus.unsubscribe(subscription)
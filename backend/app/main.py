@@ -1,32 +1,44 @@
-from datetime import timedelta
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, status
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from fastapi import FastAPI, Body, Depends, Header, HTTPException, UploadFile, File, Query, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.security import OAuth2PasswordRequestForm
-from fastapi.responses import FileResponse
-from sqlalchemy.orm import Session
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, sessionmaker
+from starlette.concurrency import run_in_threadpool
 from dotenv import load_dotenv
-from typing import List
+from typing import List, Literal, Optional
+from urllib.parse import quote
 from contextlib import asynccontextmanager
 
+import asyncio
 import io
+import os
+import requests
 
-from . import crud, models, schemas, deps, security
-from .database import engine, SessionLocal
+from . import admission, async_crud, crud, events, models, schemas, deps, security, caching, config, partitions, profiling, retention, search, template_cache
+from .database import create_tables, engine, SessionLocal
 from .service.anvil_service import *
 from .service.graphql_service import *
 from .service.file_service import *
+from .service.export_service import *
+from .service.pdf_fill_service import *
 
 # --- FastAPI App Initialization ---
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Create database tables based on SQLAlchemy models
-models.Base.metadata.create_all(bind=engine)
+# Create database tables (and columns added since) based on SQLAlchemy models
+create_tables(engine)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Seed the database with default users on application startup."""
+    # Fail now rather than on the first signed download.
+    security.require_download_url_secret()
     db = SessionLocal()
     try:
         # A default password for all seeded users for easy testing.
@@ -43,9 +55,20 @@ async def lifespan(app: FastAPI):
             if not user:
                 crud.create_user(db, user_in)
                 print(f"Created user: {user_in.email} with password: {default_password}")
+        template_cache.templates.warm(db)
     finally:
         db.close()
+
+    tasks = []
+    if config.RETENTION_INTERVAL_HOURS:
+        tasks.append(asyncio.create_task(retention.run_periodically(float(config.RETENTION_INTERVAL_HOURS) * 3600)))
+    if config.SUBMISSIONS_ROLLOVER_INTERVAL_HOURS:
+        tasks.append(asyncio.create_task(
+            partitions.run_periodically(float(config.SUBMISSIONS_ROLLOVER_INTERVAL_HOURS) * 3600)
+        ))
     yield
+    for task in tasks:
+        task.cancel()
 
 app = FastAPI(
     title="Reeble Smart PDF Workflow API",
@@ -62,26 +85,51 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "Last-Modified"],
 )
 
+# Compress JSON payloads above the configured size threshold.
+app.add_middleware(GZipMiddleware, minimum_size=config.GZIP_MINIMUM_SIZE)
+# PDFs (and archives of them) are already compressed; responses carrying them
+# send this header so GZipMiddleware passes them through untouched.
+NO_COMPRESSION = {"Content-Encoding": "identity"}
+
+# Request tracing for the admin profiler; a no-op unless slow-request capture is on.
+app.add_middleware(profiling.ProfilingMiddleware)
+
+# Admission control for the expensive (mostly Anvil-backed) endpoints.
+def _admission(name: str):
+    return Depends(admission.admission_control(
+        name,
+        rates=config.ADMISSION_RATES[name],
+        concurrency=config.ADMISSION_CONCURRENCY.get(name),
+        max_queue=config.ADMISSION_MAX_QUEUE,
+        max_wait=config.ADMISSION_MAX_WAIT,
+    ))
+
 # --- Authentication Endpoints ---
 
 @app.post("/api/token", response_model=schemas.Token, tags=["Authentication"])
 async def login_for_access_token(
-    db: Session = Depends(deps.get_db), 
+    db: AsyncSession = Depends(deps.get_async_db), 
     form_data: OAuth2PasswordRequestForm = Depends()
 ):
     """
     Authenticate user and return a JWT access token.
     FastAPI's OAuth2PasswordRequestForm requires the client to send a form with `username` and `password`.
     """
-    user = crud.get_user_by_email(db, email=form_data.username)
-    if not user or not security.verify_password(form_data.password, user.hashed_password):
+    user = await async_crud.get_user_by_email(db, email=form_data.username)
+    # bcrypt is CPU-bound by design, so verify in the threadpool rather than on the event loop.
+    if not user or not await run_in_threadpool(security.verify_password, form_data.password, user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    # Transparently upgrade hashes made under an older scheme or cost policy.
+    if security.password_needs_rehash(user.hashed_password):
+        new_hash = await run_in_threadpool(security.get_password_hash, form_data.password)
+        await async_crud.update_user_password_hash(db, user, new_hash)
     access_token_expires = timedelta(minutes=security.ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = security.create_access_token(
         data={"sub": user.email, "role": user.role}, expires_delta=access_token_expires
@@ -95,31 +143,103 @@ async def read_users_me(current_user: models.User = Depends(deps.get_current_use
     return current_user
 
 
+# --- Search ---
+
+@app.get("/api/search", response_model=schemas.SearchResults, tags=["Search"])
+def search_documents(
+    q: str = Query(..., min_length=1, max_length=200),
+    kind: Optional[Literal["template", "submission"]] = None,
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    current_user: models.User = Depends(deps.get_current_user),
+    db: Session = Depends(deps.get_db)
+):
+    """
+    Ranked prefix search over template titles, owner and buyer emails and
+    submission eids, limited to what the current user is allowed to see.
+    """
+    results, has_more = search.search(db, q, current_user, kind=kind, limit=limit, offset=offset)
+    return {"results": results, "limit": limit, "offset": offset, "has_more": has_more}
+
+
+@app.get("/api/events", tags=["Events"])
+async def stream_events(
+    current_user: models.User = Depends(deps.get_event_stream_user),
+    last_event_id: Optional[str] = Header(None),
+):
+    """
+    Server-sent events for new templates and submissions the current user can
+    see, so dashboards can stop polling. Reconnecting with `Last-Event-ID`
+    replays missed events; a `reset` event means the client should refetch.
+    """
+    return StreamingResponse(
+        events.event_stream(current_user, last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 # --- Agent Flow ---
 
-@app.post("/api/templates", response_model=schemas.PDFTemplate, status_code=201, tags=["Agent"])
+@app.post("/api/templates", response_model=schemas.PDFTemplate, status_code=201, tags=["Agent"], dependencies=[_admission("upload")])
 async def upload_template(
-    current_user: models.User = Depends(deps.agent_only),
+    response: Response,
+    current_user: models.User = Depends(deps.agent_only_async),
     file: UploadFile = File(...),
-    db: Session = Depends(deps.get_db)
+    force_detection: bool = Query(False, description="Re-run Anvil field detection even if this exact PDF was uploaded before"),
+    db: AsyncSession = Depends(deps.get_async_db)
 ):
     """
     Agent-only endpoint to upload a PDF, convert it to an Anvil template,
     and save its metadata to the database.
-    """
-    file_content = await file.read()
-
-    response = create_cast(file_content=file_content, filename=file.filename)
-    castEid = response["data"]["createCast"]["eid"]
-
-    return crud.create_template(db, file.filename, current_user.id, castEid)
 
-@app.get("/api/templates", tags=["Agent"])
+    Field detection is slow, so identical PDFs are recognised by content hash:
+    re-uploading your own file returns the existing template, and a file
+    another agent already cast is copied instead of detected again.
+    Anvil calls and the file write run in the threadpool, so detection never
+    blocks the event loop.
+    """
+    file_content, content_hash = await read_upload_with_hash(file)
+
+    existing = None if force_detection else await async_crud.get_template_by_content_hash(db, content_hash, current_user.id)
+    if existing is not None and existing.owner_id == current_user.id:
+        response.status_code = status.HTTP_200_OK
+        return existing
+
+    castEid = fieldInfo = None
+    if existing is not None:
+        try:
+            duplicate = await run_in_threadpool(duplicate_cast, existing.anvil_template_eid, file.filename)
+        except requests.RequestException:
+            duplicate = None
+        if duplicate:
+            castEid = duplicate["eid"]
+            fieldInfo = existing.field_info or duplicate.get("fieldInfo")
+
+    if castEid is None:
+        cast = await run_in_threadpool(create_cast, file_content=file_content, filename=file.filename)
+        castEid = cast["data"]["createCast"]["eid"]
+        fieldInfo = cast["data"]["createCast"].get("fieldInfo")
+
+    # Keep the original so previews can be filled locally without Anvil.
+    await run_in_threadpool(upload_template_pdf, template_eid=castEid, file_content=file_content)
+
+    return await async_crud.create_template(db, file.filename, current_user.id, castEid, field_info=fieldInfo, content_hash=content_hash)
+
+@app.get("/api/templates", response_model=List[schemas.PDFTemplate], tags=["Agent"])
 def list_available_templates(
+    request: Request,
+    response: Response,
     current_user: models.User = Depends(deps.agent_only),
     db: Session = Depends(deps.get_db)
 ):
     """Agent-only endpoint to get a list of their templates."""
+    stamp = crud.get_collection_stamp(db, models.PDFTemplate, models.PDFTemplate.owner_id == current_user.id)
+    not_modified = caching.conditional_response(
+        request, response, [stamp], config.CACHE_CONTROL["agent_templates"], scope=f"templates:{current_user.id}"
+    )
+    if not_modified:
+        return not_modified
     return crud.get_templates_by_user(db, current_user.id)
 
 
@@ -127,13 +247,21 @@ def list_available_templates(
 
 @app.get("/api/templates/available", response_model=List[schemas.PDFTemplate], tags=["Buyer"])
 def list_available_templates(
+    request: Request,
+    response: Response,
     _: models.User = Depends(deps.buyer_only),
     db: Session = Depends(deps.get_db)
 ):
     """Buyer-only endpoint to get a list of all available templates."""
+    stamp = crud.get_collection_stamp(db, models.PDFTemplate)
+    not_modified = caching.conditional_response(
+        request, response, [stamp], config.CACHE_CONTROL["available_templates"], scope="templates:available"
+    )
+    if not_modified:
+        return not_modified
     return crud.get_templates(db=db)
 
-@app.get("/api/templates/{template_id}/fields", tags=["Buyer"])
+@app.get("/api/templates/{template_id}/fields", tags=["Buyer"], dependencies=[_admission("fields")])
 def get_template_form_fields(
     template_id: str,
     _: models.User = Depends(deps.buyer_only),
@@ -142,34 +270,154 @@ def get_template_form_fields(
     """
     Buyer-only endpoint to get the dynamic form fields for a specific template.
     """
-    db_template = crud.get_template(db, template_id)
+    db_template = template_cache.templates.get_by_eid(db, template_id)
     if not db_template:
         raise HTTPException(status_code=404, detail="Template not found")
 
+    fields = get_field_info(db, db_template).get("fields", [])
+
+    return { "fields": fields }
+
+@app.post("/api/templates/fields/batch", response_model=schemas.TemplateFieldsBatch, tags=["Buyer"])
+async def get_templates_form_fields(
+    batch: schemas.TemplateFieldsBatchRequest,
+    admitted: admission.Admission = _admission("fields"),
+    _: models.User = Depends(deps.buyer_only_async),
+    db: AsyncSession = Depends(deps.get_async_db)
+):
+    """
+    Buyer-only endpoint returning the form fields of several templates at once,
+    keyed by template id. Templates that are unknown or whose schema could not
+    be fetched from Anvil are listed under `errors` instead of failing the batch.
+
+    Every schema fetched from Anvil costs one `fields` rate-limit token, as a
+    /fields call would; lookups beyond the caller's remaining tokens are listed
+    under `errors` with status 429.
+    """
+    template_ids = list(dict.fromkeys(batch.template_ids))
+    if len(template_ids) > config.FIELDS_BATCH_MAX_TEMPLATES:
+        raise HTTPException(status_code=422, detail=f"At most {config.FIELDS_BATCH_MAX_TEMPLATES} templates per batch")
+
+    db_templates = {t.anvil_template_eid: t for t in await async_crud.get_templates_by_eids(db, template_ids)}
+    uncached = [t.anvil_template_eid for t in db_templates.values() if t.field_info is None]
+    # Admission already charged the request itself, which covers the first lookup.
+    allowed = 1 + await admitted.charge(len(uncached) - 1) if uncached else 0
+    uncached, throttled = uncached[:allowed], set(uncached[allowed:])
+    fetched, failed = await fetch_field_infos(uncached)
+    if fetched:
+        await async_crud.update_templates_field_info(db, {db_templates[eid]: info for eid, info in fetched.items()})
+
+    fields, errors = {}, {}
+    for template_id in template_ids:
+        if template_id not in db_templates:
+            errors[template_id] = {"status_code": 404, "detail": "Template not found"}
+        elif template_id in throttled:
+            errors[template_id] = {"status_code": 429, "detail": "Rate limit exceeded"}
+        elif template_id in failed:
+            errors[template_id] = {"status_code": 502, "detail": f"Failed to fetch data from Anvil: {failed[template_id]}"}
+        else:
+            fields[template_id] = (db_templates[template_id].field_info or {}).get("fields", [])
+    return {"fields": fields, "errors": errors}
+
+async def fetch_field_infos(template_eids: List[str]):
+    """
+    Fetches cast `fieldInfo` from Anvil for `template_eids`: through one
+    get_casts listing for large batches, otherwise (and for casts the listing
+    lacks) through concurrent get_cast calls. Returns ({eid: fieldInfo}, {eid: error}).
+    """
+    fetched, failed = {}, {}
+    remaining = list(template_eids)
+    if len(remaining) >= config.FIELDS_BATCH_BULK_THRESHOLD:
+        try:
+            casts = {cast.get("eid"): cast for cast in await run_in_threadpool(get_casts) or []}
+            fetched.update({eid: casts[eid].get("fieldInfo") or {} for eid in remaining if eid in casts})
+            remaining = [eid for eid in remaining if eid not in fetched]
+        except Exception:
+            pass  # Fall back to fetching each cast.
+
+    semaphore = asyncio.Semaphore(config.FIELDS_BATCH_CONCURRENCY)
+
+    async def fetch(eid: str):
+        async with semaphore:
+            try:
+                cast_data = await run_in_threadpool(get_cast, anvil_template_eid=eid)
+                fetched[eid] = cast_data.get("fieldInfo") or {}
+            except Exception as e:
+                failed[eid] = str(e)
+
+    await asyncio.gather(*(fetch(eid) for eid in remaining))
+    return fetched, failed
+
+def get_field_info(db: Session, db_template: template_cache.CachedTemplate) -> dict:
+    """Returns the template's cast `fieldInfo`, fetching it from Anvil once and caching it on the row."""
+    if db_template.field_info is not None:
+        return db_template.field_info
+
     try:
         # Retrieve cast data from Anvil
         cast_data = get_cast(anvil_template_eid=db_template.anvil_template_eid)
-        fields = cast_data.get("fieldInfo", {}).get("fields", [])
+        field_info = cast_data.get("fieldInfo") or {}
     except Exception as e:
         raise HTTPException(status_code=502, detail=f"Failed to fetch data from Anvil: {str(e)}")
 
-    return { "fields": fields }
+    crud.update_template_field_info(db, db_template, field_info)
+    return field_info
 
-@app.post("/api/templates/{template_id}/submissions", status_code=201, tags=["Buyer"])
-def submit_filled_form(
+@app.post("/api/templates/{template_id}/preview", tags=["Buyer"], dependencies=[_admission("preview")])
+def preview_filled_form(
     template_id: str,
     submission_data: dict,
+    _: models.User = Depends(deps.buyer_only),
+    db: Session = Depends(deps.get_db)
+):
+    """
+    Buyer-only endpoint that fills the stored template PDF locally and returns it,
+    for quick previews while the form is being filled. Nothing is sent to Anvil
+    except, once per template, the cast's field layout.
+    """
+    db_template = template_cache.templates.get_by_eid(db, template_id)
+    if not db_template:
+        raise HTTPException(status_code=404, detail="Template not found")
+
+    template_path = get_template_pdf_path(template_eid=db_template.anvil_template_eid)
+    if not os.path.exists(template_path):
+        raise HTTPException(status_code=404, detail="Template PDF is not available for preview")
+
+    field_info = get_field_info(db, db_template)
+    try:
+        pdf_bytes = fill_pdf_locally(template_path, field_info, submission_data)
+    except Exception as e:
+        raise HTTPException(status_code=422, detail=f"Could not fill the template locally: {str(e)}")
+
+    return Response(content=pdf_bytes, media_type="application/pdf", headers=NO_COMPRESSION)
+
+@app.post("/api/templates/{template_id}/submissions", status_code=201, tags=["Buyer"], dependencies=[_admission("submit")])
+def submit_filled_form(
+    template_id: str,
+    submission_data: Optional[dict] = Body(None),
+    draft_id: Optional[int] = None,
     current_user: models.User = Depends(deps.buyer_only),
     db: Session = Depends(deps.get_db)
 ):
     """
     Buyer-only endpoint to submit data for a form, fill the PDF via Anvil,
     and record the submission.
+    With `draft_id`, the payload is assembled server-side from the saved draft;
+    a body, if also sent, is applied on top of it as a final merge patch.
     """
-    db_template = crud.get_template(db, template_id)
+    db_template = template_cache.templates.get_by_eid(db, template_id)
     if not db_template:
         raise HTTPException(status_code=404, detail="Template not found")
 
+    db_draft = None
+    if draft_id is not None:
+        db_draft = crud.get_draft_by_id(db, draft_id)
+        if not db_draft or db_draft.buyer_id != current_user.id or db_draft.template_id != template_id:
+            raise HTTPException(status_code=404, detail="Draft not found")
+        submission_data = crud.apply_merge_patch(crud.materialize_draft(db, db_draft), submission_data or {})
+    elif submission_data is None:
+        raise HTTPException(status_code=422, detail="Submission data or a draft_id is required")
+
     fill_response = submit_filled_pdf(submission_data, db_template)
     
     response = create_etch_packet(file_content=fill_response, current_user=current_user)
@@ -177,26 +425,107 @@ def submit_filled_form(
     filename = f"{response['createEtchPacket']['eid']}.pdf"
     upload_pdf(filename=filename, file_content=fill_response)
     submission = crud.create_submission(db=db, template_id=template_id, buyer_id=current_user.id, anvil_submission_eid=response["createEtchPacket"]["eid"], filled_pdf_url=response["createEtchPacket"]["detailsURL"])
+    if db_draft is not None:
+        crud.delete_draft(db, db_draft)
     
     return {"message": "Submission successful!", "submission": submission }
 
     # except Exception as e:
     #     raise HTTPException(status_code=500, detail=f"Anvil API error: {str(e)}")
 
+@app.get("/api/templates/{template_id}/draft", response_model=schemas.FormDraft, tags=["Buyer"])
+def get_form_draft(
+    template_id: str,
+    current_user: models.User = Depends(deps.buyer_only),
+    db: Session = Depends(deps.get_db)
+):
+    """Buyer-only endpoint to resume the saved draft for a template."""
+    db_draft = crud.get_draft(db, current_user.id, template_id)
+    if not db_draft:
+        raise HTTPException(status_code=404, detail="Draft not found")
+    return {
+        "id": db_draft.id,
+        "template_id": db_draft.template_id,
+        "version": db_draft.version,
+        "data": crud.materialize_draft(db, db_draft),
+        "updated_at": db_draft.updated_at,
+    }
+
+@app.patch("/api/templates/{template_id}/draft", response_model=schemas.FormDraftSaved, tags=["Buyer"])
+def autosave_form_draft(
+    template_id: str,
+    patch: dict,
+    if_match: Optional[str] = Header(None),
+    current_user: models.User = Depends(deps.buyer_only),
+    db: Session = Depends(deps.get_db)
+):
+    """
+    Buyer-only autosave. The body is a JSON merge patch (RFC 7386) with only the
+    fields changed since the last save; `null` removes a field. Send the last
+    returned version in `If-Match` to reject writes based on a stale copy.
+    """
+    if not template_cache.templates.get_by_eid(db, template_id):
+        raise HTTPException(status_code=404, detail="Template not found")
+
+    expected_version = None
+    if if_match is not None:
+        try:
+            expected_version = int(if_match.strip().strip('"'))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="If-Match must be a draft version")
+
+    db_draft = crud.get_or_create_draft(db, current_user.id, template_id)
+    version = crud.append_draft_delta(db, db_draft, patch, expected_version=expected_version)
+    if version is None:
+        raise HTTPException(status_code=412, detail="Draft was modified since the given version")
+    return {"id": db_draft.id, "version": version}
+
+@app.delete("/api/templates/{template_id}/draft", status_code=204, tags=["Buyer"])
+def discard_form_draft(
+    template_id: str,
+    current_user: models.User = Depends(deps.buyer_only),
+    db: Session = Depends(deps.get_db)
+):
+    """Buyer-only endpoint to discard the saved draft for a template."""
+    db_draft = crud.get_draft(db, current_user.id, template_id)
+    if not db_draft:
+        raise HTTPException(status_code=404, detail="Draft not found")
+    crud.delete_draft(db, db_draft)
+    return Response(status_code=204)
+
 @app.get("/api/submissions", tags=["Buyer"])
 def list_available_templates(
     current_user: models.User = Depends(deps.buyer_only),
     db: Session = Depends(deps.get_db)
 ):
-    """Buyer-only endpoint to get a list of their submissions."""
+    """Buyer-only endpoint to get a list of their recent submissions (see /api/submissions/history for older ones)."""
     return crud.get_submissions_by_user(db, current_user.id)
 
+@app.get("/api/submissions/history", response_model=schemas.SubmissionHistory, tags=["Buyer"])
+def get_submission_history(
+    before_id: Optional[int] = Query(None, description="next_before_id from the previous page"),
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    limit: int = Query(50, ge=1, le=config.SUBMISSION_HISTORY_MAX_LIMIT),
+    current_user: models.User = Depends(deps.buyer_only),
+    db: Session = Depends(deps.get_db)
+):
+    """
+    Buyer-only endpoint to page through all of their submissions, newest first,
+    including those the rollover has moved to the archive.
+    """
+    submissions = crud.get_submission_history(db, current_user.id, before_id=before_id, start=start, end=end, limit=limit)
+    next_before_id = submissions[-1].id if len(submissions) == limit else None
+    return {"submissions": submissions, "next_before_id": next_before_id}
+
 
 
 # --- Admin Flow ---
 
-@app.get("/api/dashboard", tags=["Admin"])
+@app.get("/api/dashboard", response_model=List[schemas.AdminDashboardRow], tags=["Admin"])
 def get_admin_dashboard(
+    request: Request,
+    response: Response,
     _: models.User = Depends(deps.admin_only),
     db: Session = Depends(deps.get_db)
 ):
@@ -204,34 +533,217 @@ def get_admin_dashboard(
     Admin-only endpoint to view a dashboard listing every template, its owner,
     the latest buyer submission, and a download link for the filled PDF.
     """
-    templates = crud.get_templates(db)
+    stamps = [
+        crud.get_collection_stamp(db, models.PDFTemplate),
+        crud.get_collection_stamp(db, models.Submission),
+        crud.get_collection_stamp(db, models.User),
+    ]
+    not_modified = caching.conditional_response(
+        request, response, stamps, config.CACHE_CONTROL["dashboard"], scope="dashboard"
+    )
+    if not_modified:
+        return not_modified
+
+    # One query over the rollups instead of a latest-submission lookup per template.
     dashboard_data = []
-    for t in templates:
-        latest_submission = crud.get_latest_submission(db, t.anvil_template_eid)
+    for t, latest_submission in crud.get_dashboard_rows(db):
         template_data = { "owner": t.owner, "template": t, "latest_submission": latest_submission }
         dashboard_data.append(template_data)
     return dashboard_data
 
-@app.get("/api/submissions/{submission_id}/download")
-async def download_submission_pdf(
-    submission_id: str,
+@app.get("/api/dashboard/analytics", response_model=schemas.SubmissionAnalytics, tags=["Admin"])
+def get_submission_analytics(
+    days: int = 30,
+    _: models.User = Depends(deps.admin_only),
+    db: Session = Depends(deps.get_db)
+):
+    """
+    Admin-only endpoint with submission counts per template, per buyer and per day
+    over the last `days` days. Served from the rollup tables, never from `submissions`.
+    """
+    since = datetime.now(timezone.utc).date() - timedelta(days=max(days, 1) - 1)
+
+    daily = defaultdict(list)
+    for row in crud.get_daily_submission_counts(db, since=since):
+        daily[row.template_id].append(row)
+
+    templates = [
+        {
+            "template_id": t.anvil_template_eid,
+            "title": t.title,
+            "owner_id": t.owner_id,
+            "total": stats.total if stats else 0,
+            "last_submission_id": stats.last_submission_id if stats else None,
+            "daily": daily.get(t.anvil_template_eid, []),
+        }
+        for t, stats in crud.get_template_submission_stats(db)
+    ]
+    buyers = [
+        {"buyer_id": stats.buyer_id, "email": email, "total": stats.total, "last_submission_id": stats.last_submission_id}
+        for stats, email in crud.get_buyer_submission_stats(db)
+    ]
+    return {"since": since, "templates": templates, "buyers": buyers}
+
+@app.get("/api/admin/exports/submissions", tags=["Admin"])
+def export_submissions(
+    format: Literal["csv", "ndjson"] = "csv",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    template_id: Optional[str] = None,
+    _: models.User = Depends(deps.admin_only),
+    db: Session = Depends(deps.get_db)
+):
+    """
+    Admin-only audit export of every submission joined with its template and buyer,
+    streamed as CSV or NDJSON. Optional `start` (inclusive) / `end` (exclusive)
+    bound the submission time.
+    """
+    rows = iter_submission_export(
+        sessionmaker(bind=db.get_bind(), autoflush=False),
+        export_format=format,
+        start=start,
+        end=end,
+        template_id=template_id,
+    )
+    filename = f"submissions.{format}"
+    return StreamingResponse(
+        rows,
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+@app.post("/api/admin/profiler/sample", response_class=PlainTextResponse, tags=["Admin"])
+async def sample_profile(
+    seconds: float = Query(10, gt=0, le=60),
+    _: models.User = Depends(deps.admin_only),
+):
+    """
+    Admin-only endpoint that samples every thread's stack for `seconds` and returns
+    the folded stacks (one `frame;frame;frame count` line each), ready for
+    flamegraph.pl or speedscope.
+    """
+    session = profiling.sampler.start_session()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiling.sampler.stop_session(session)
+    return profiling.folded_output(session)
+
+@app.get("/api/admin/cache/templates", response_model=schemas.TemplateCacheStats, tags=["Admin"])
+def get_template_cache_stats(_: models.User = Depends(deps.admin_only)):
+    """Admin-only endpoint reporting this worker's template metadata cache size and hit rate."""
+    return template_cache.templates.stats()
+
+@app.post("/api/admin/retention/sweep", response_model=schemas.RetentionReport, tags=["Admin"])
+def run_retention_sweep(
+    dry_run: bool = Query(False, description="Report what would change without touching storage"),
+    _: models.User = Depends(deps.admin_only),
+    db: Session = Depends(deps.get_db)
+):
+    """
+    Admin-only endpoint to run a retention sweep over stored submission PDFs now:
+    cold PDFs are packed, orphans deleted, and the reclaimed bytes reported.
+    """
+    try:
+        report = retention.sweep(db, dry_run=dry_run)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return report.as_dict()
+
+@app.post("/api/admin/submissions/rollover", response_model=schemas.RolloverReport, tags=["Admin"])
+def run_submissions_rollover(
+    dry_run: bool = Query(False, description="Report what would move without changing anything"),
+    _: models.User = Depends(deps.admin_only),
+    db: Session = Depends(deps.get_db)
+):
+    """
+    Admin-only endpoint to move submissions older than the hot months into the
+    archive now, reporting how many moved per month.
+    """
+    try:
+        report = partitions.rollover(db, dry_run=dry_run)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return report.as_dict()
+
+@app.get("/api/admin/profiler/slow-requests/capture", response_model=schemas.SlowRequestCapture, tags=["Admin"])
+def get_slow_request_capture(_: models.User = Depends(deps.admin_only)):
+    """Admin-only endpoint showing whether slow-request capture is on, and its threshold."""
+    threshold = profiling.slow_threshold_ms
+    return {"enabled": threshold is not None, "threshold_ms": threshold}
+
+@app.put("/api/admin/profiler/slow-requests/capture", response_model=schemas.SlowRequestCapture, tags=["Admin"])
+def set_slow_request_capture(
+    capture: schemas.SlowRequestCapture,
+    _: models.User = Depends(deps.admin_only),
+):
+    """
+    Admin-only endpoint to turn slow-request capture on (for requests taking at
+    least `threshold_ms`) or off. Reconfiguring clears the captured requests.
+    """
+    if capture.enabled and capture.threshold_ms is None:
+        raise HTTPException(status_code=422, detail="threshold_ms is required to enable capture")
+    profiling.configure_slow_capture(capture.threshold_ms if capture.enabled else None)
+    return get_slow_request_capture(_)
+
+@app.get("/api/admin/profiler/slow-requests", tags=["Admin"])
+def list_slow_requests(_: models.User = Depends(deps.admin_only)):
+    """Admin-only endpoint listing the most recent requests over the capture threshold, newest first."""
+    return [trace.summary() for trace in profiling.slow_requests.all()]
+
+@app.get("/api/admin/profiler/slow-requests/{trace_id}", tags=["Admin"])
+def get_slow_request(trace_id: int, _: models.User = Depends(deps.admin_only)):
+    """Admin-only endpoint with the statements and Anvil calls of one captured request."""
+    trace = profiling.slow_requests.get(trace_id)
+    if not trace:
+        raise HTTPException(status_code=404, detail="Captured request not found")
+    return trace.detail()
+
+@app.get("/api/admin/profiler/slow-requests/{trace_id}/flamegraph", response_class=PlainTextResponse, tags=["Admin"])
+def get_slow_request_flamegraph(trace_id: int, _: models.User = Depends(deps.admin_only)):
+    """Admin-only endpoint with the stacks sampled during one captured request, in folded format."""
+    trace = profiling.slow_requests.get(trace_id)
+    if not trace:
+        raise HTTPException(status_code=404, detail="Captured request not found")
+    return profiling.folded_output(trace.stacks)
+
+@app.get("/api/submissions/archive", tags=["Download"])
+def download_submissions_archive(
+    template_id: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
     current_user: models.User = Depends(deps.get_current_user),
     db: Session = Depends(deps.get_db)
 ):
     """
-    Download the filled PDF for a given submission.
-    
-    This endpoint is accessible by:
+    Download every filled PDF the current user may access as one ZIP archive,
+    optionally filtered by template and submission time. The archive is streamed
+    while it is built, so large sets start downloading immediately.
+    """
+    submission_eids = crud.get_downloadable_submission_eids(
+        db, current_user, template_id=template_id, start=start, end=end
+    )
+    if not submission_eids:
+        raise HTTPException(status_code=404, detail="No submissions found")
+
+    return StreamingResponse(
+        iter_pdf_archive(submission_eids),
+        media_type="application/zip",
+        headers={"Content-Disposition": 'attachment; filename="submissions.zip"', **NO_COMPRESSION},
+    )
+
+async def _authorize_submission_download(db: AsyncSession, submission_id: str, current_user: models.User):
+    """
+    Returns the submission if the current user may download its PDF:
     1. The Buyer who created the submission.
     2. The Agent who owns the parent template.
     3. Any user with the Admin role.
     """
-
-    submission = crud.get_submission_by_id(db=db, submission_id=submission_id)
+    submission = await async_crud.get_submission_by_id(db=db, submission_id=submission_id)
     if not submission:
         raise HTTPException(status_code=404, detail="Submission not found")
     
-    template = crud.get_template(db, template_id=submission.template_id)
+    template = await template_cache.templates.get_by_eid_async(db, submission.template_id)
     if not template:
         raise HTTPException(status_code=404, detail="Associated template not found")
     
@@ -241,7 +753,71 @@ async def download_submission_pdf(
 
     if not (is_buyer or is_owner or is_admin):
         raise HTTPException(status_code=403, detail="You are not authorized to download this file")
+    return submission
+
+async def _submission_pdf_response(submission_eid: str):
+    """Sends a stored submission PDF, or hands it to nginx to send in X-Accel-Redirect mode."""
+    filename = f"{submission_eid}.pdf"
+    if config.DOWNLOAD_OFFLOAD == "x-accel":
+        # nginx needs a real file, so a PDF the retention sweep packed is restored first.
+        if not await run_in_threadpool(restore_packed_pdf, submission_eid):
+            raise HTTPException(status_code=404, detail="File not found")
+        return Response(
+            media_type="application/pdf",
+            headers={
+                "X-Accel-Redirect": f"{config.DOWNLOAD_ACCEL_PREFIX}{quote(filename)}",
+                "Content-Disposition": f'attachment; filename="{filename}"',
+            },
+        )
+    pdf_path = get_pdf_path(submission_eid)
+    if os.path.exists(pdf_path):
+        return FileResponse(path=pdf_path, media_type='application/pdf', filename=filename, headers=NO_COMPRESSION)
+    # A packed PDF is streamed from its pack member, never extracted to disk.
+    try:
+        source, size = await run_in_threadpool(open_pdf, submission_eid)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+    return StreamingResponse(
+        iter_file(source),
+        media_type="application/pdf",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"', "Content-Length": str(size), **NO_COMPRESSION},
+    )
 
-    pdf_path = get_pdf_path(submission_eid=submission.anvil_submission_eid)
+@app.get("/api/submissions/{submission_id}/download")
+async def download_submission_pdf(
+    submission_id: str,
+    current_user: models.User = Depends(deps.get_current_user_async),
+    db: AsyncSession = Depends(deps.get_async_db)
+):
+    """
+    Download the filled PDF for a given submission, if the current user is its
+    buyer, the owner of its template, or an Admin.
+    """
+    submission = await _authorize_submission_download(db, submission_id, current_user)
+    return await _submission_pdf_response(submission.anvil_submission_eid)
 
-    return FileResponse(path=pdf_path, media_type='application/pdf', filename=f"{submission.anvil_submission_eid}.pdf")
\ No newline at end of file
+@app.post("/api/submissions/{submission_id}/download-url", response_model=schemas.DownloadUrl, tags=["Download"])
+async def create_submission_download_url(
+    submission_id: str,
+    current_user: models.User = Depends(deps.get_current_user_async),
+    db: AsyncSession = Depends(deps.get_async_db)
+):
+    """
+    Authorises a download once and returns a short-lived signed URL for it. The
+    URL needs no token, so it can be opened directly by the browser.
+    """
+    submission = await _authorize_submission_download(db, submission_id, current_user)
+    eid = submission.anvil_submission_eid
+    expires = int(datetime.now(timezone.utc).timestamp()) + config.DOWNLOAD_URL_TTL_SECONDS
+    signature = security.sign_download(eid, expires)
+    return {
+        "url": f"/api/files/submissions/{quote(eid)}.pdf?expires={expires}&signature={signature}",
+        "expires_at": datetime.fromtimestamp(expires, timezone.utc),
+    }
+
+@app.get("/api/files/submissions/{submission_eid}.pdf", tags=["Download"])
+async def download_signed_submission_pdf(submission_eid: str, expires: int, signature: str):
+    """Serves a PDF for a URL from /download-url; checks the signature only, without touching the database."""
+    if not security.verify_download_signature(submission_eid, expires, signature):
+        raise HTTPException(status_code=403, detail="Invalid or expired download link")
+    return await _submission_pdf_response(submission_eid)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime
+from sqlalchemy import DDL, Column, Integer, String, ForeignKey, DateTime, Date, Index, JSON, UniqueConstraint, event
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from .database import Base
@@ -20,6 +20,8 @@ class PDFTemplate(Base):
     title = Column(String, index=True)
     owner_id = Column(Integer, ForeignKey("users.id"))
     anvil_template_eid = Column(String, unique=True)
+    field_info = Column(JSON, nullable=True) # Cached cast `fieldInfo` from Anvil
+    content_hash = Column(String(64), index=True, nullable=True) # SHA-256 of the uploaded PDF
 
     # Timestamps
     created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -42,4 +44,97 @@ class Submission(Base):
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
     template = relationship("PDFTemplate", back_populates="submissions")
-    buyer = relationship("User")
\ No newline at end of file
+    buyer = relationship("User")
+
+
+# --- Submission archive ---
+# app.partitions moves submissions from months older than SUBMISSIONS_HOT_MONTHS
+# here, so `submissions` only holds recent rows. Rows keep their ids. On Postgres
+# the table is partitioned by month; rows outside every month partition land in
+# the default one.
+
+class ArchivedSubmission(Base):
+    __tablename__ = "submissions_archive"
+    __table_args__ = (
+        Index("ix_submissions_archive_buyer_id", "buyer_id", "id"),
+        Index("ix_submissions_archive_template_id", "template_id", "id"),
+        # Postgres requires the partition key in the primary key.
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    template_id = Column(String, ForeignKey("templates.anvil_template_eid"))
+    buyer_id = Column(Integer, ForeignKey("users.id"))
+    anvil_submission_eid = Column(String, index=True)
+    filled_pdf_url = Column(String, nullable=True)
+
+    # Timestamps
+    created_at = Column(DateTime(timezone=True), primary_key=True)
+    updated_at = Column(DateTime(timezone=True))
+
+    template = relationship("PDFTemplate", viewonly=True)
+
+event.listen(
+    ArchivedSubmission.__table__,
+    "after_create",
+    DDL("CREATE TABLE IF NOT EXISTS submissions_archive_default PARTITION OF submissions_archive DEFAULT")
+    .execute_if(dialect="postgresql"),
+)
+
+
+# --- Submission rollups ---
+# Maintained by crud.create_submission in the same transaction as the insert,
+# so the admin analytics never have to aggregate over `submissions`.
+
+class TemplateSubmissionStats(Base):
+    __tablename__ = "template_submission_stats"
+    template_id = Column(String, ForeignKey("templates.anvil_template_eid"), primary_key=True)
+    total = Column(Integer, nullable=False, default=0)
+    last_submission_id = Column(Integer, ForeignKey("submissions.id"), nullable=True)
+
+class BuyerSubmissionStats(Base):
+    __tablename__ = "buyer_submission_stats"
+    buyer_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    total = Column(Integer, nullable=False, default=0)
+    last_submission_id = Column(Integer, ForeignKey("submissions.id"), nullable=True)
+
+class DailySubmissionCount(Base):
+    __tablename__ = "daily_submission_counts"
+    template_id = Column(String, ForeignKey("templates.anvil_template_eid"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    total = Column(Integer, nullable=False, default=0)
+
+
+
+# --- Form drafts ---
+# A draft is a compacted snapshot plus an append-only log of JSON merge-patch
+# deltas written by autosave; crud.compact_draft folds the log into the snapshot.
+
+class FormDraft(Base):
+    __tablename__ = "form_drafts"
+    __table_args__ = (UniqueConstraint("buyer_id", "template_id"),)
+    id = Column(Integer, primary_key=True, index=True)
+    buyer_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    template_id = Column(String, ForeignKey("templates.anvil_template_eid"), nullable=False)
+    data = Column(JSON, nullable=False, default=dict)
+    version = Column(Integer, nullable=False, default=0)
+    compacted_version = Column(Integer, nullable=False, default=0)
+
+    # Timestamps
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+class FormDraftDelta(Base):
+    __tablename__ = "form_draft_deltas"
+    __table_args__ = (UniqueConstraint("draft_id", "version"),)
+    id = Column(Integer, primary_key=True, index=True)
+    draft_id = Column(Integer, ForeignKey("form_drafts.id"), nullable=False)
+    version = Column(Integer, nullable=False)
+    patch = Column(JSON, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class CacheVersion(Base):
+    """Change counter per cached table, bumped in the same transaction as every write to it."""
+    __tablename__ = "cache_versions"
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
@@ -0,0 +1,196 @@
+"""
+Hot/archive split of the submissions table.
+
+`submissions` holds the current month and the SUBMISSIONS_HOT_MONTHS before it.
+The rollover job moves older submissions, in id order and a batch per
+transaction, into `submissions_archive`; on Postgres that table is partitioned
+by month and the job creates each month's partition before filling it.
+
+Recent-data lookups (crud.get_submissions_by_user, crud.get_latest_submission)
+read only `submissions`. History goes through crud.get_submission_history, and
+anything that must see every submission selects from `all_submissions()`.
+The latest submission of each template and of each buyer always stays hot, as
+do the rollups' last_submission_id rows, so get_latest_submission stays exact
+and the rollups never point into the archive.
+
+Usage:
+    python -m app.partitions [--dry-run]
+"""
+import argparse
+import asyncio
+import time
+from collections import Counter
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from sqlalchemy import delete, false, func, insert, select, text, true, union_all
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from . import config, models
+from .database import SessionLocal, create_tables, engine
+from .service import file_service
+
+# Columns shared by `submissions` and `submissions_archive`, in table order.
+SUBMISSION_COLUMNS = ("id", "template_id", "buyer_id", "anvil_submission_eid", "filled_pdf_url", "created_at", "updated_at")
+
+
+def all_submissions():
+    """Hot and archived submissions as one subquery, with an extra `archived` column."""
+    hot = models.Submission.__table__
+    archive = models.ArchivedSubmission.__table__
+    return union_all(
+        select(*(hot.c[name] for name in SUBMISSION_COLUMNS), false().label("archived")),
+        select(*(archive.c[name] for name in SUBMISSION_COLUMNS), true().label("archived")),
+    ).subquery("all_submissions")
+
+
+def _month_start(value: datetime) -> datetime:
+    # SQLite hands back naive datetimes; they are UTC.
+    value = value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+    return datetime(value.year, value.month, 1, tzinfo=timezone.utc)
+
+
+def _add_months(month: datetime, months: int) -> datetime:
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def hot_cutoff(now: datetime) -> datetime:
+    """Start of the oldest month kept in `submissions`."""
+    return _add_months(_month_start(now), -config.SUBMISSIONS_HOT_MONTHS)
+
+
+def partition_name(month: datetime) -> str:
+    return f"submissions_archive_y{month.year}m{month.month:02d}"
+
+
+def _ensure_month_partition(db: Session, month: datetime):
+    if db.get_bind().dialect.name != "postgresql":
+        return
+    db.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF submissions_archive "
+        f"FOR VALUES FROM ('{month.isoformat()}') TO ('{_add_months(month, 1).isoformat()}')"
+    ))
+
+
+def _submissions_to_keep(db: Session) -> set:
+    """
+    Ids that must stay hot: each template's and buyer's latest submission, taken
+    from `submissions` itself so this holds before the rollups are backfilled,
+    plus whatever the rollups point at. A submission only stops being the latest
+    when a newer one arrives, so the set can be read once per rollover.
+    """
+    S = models.Submission
+    keep = set()
+    for stmt in (
+        select(func.max(S.id)).group_by(S.template_id),
+        select(func.max(S.id)).group_by(S.buyer_id),
+        select(models.TemplateSubmissionStats.last_submission_id),
+        select(models.BuyerSubmissionStats.last_submission_id),
+    ):
+        keep.update(db.scalars(stmt))
+    keep.discard(None)
+    return keep
+
+
+@dataclass
+class RolloverReport:
+    dry_run: bool = False
+    cutoff: Optional[datetime] = None
+    moved: int = 0
+    kept_latest: int = 0
+    batches: int = 0
+    months: Dict[str, int] = field(default_factory=dict)
+    duration_ms: float = 0.0
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+
+def rollover(db: Session, now: Optional[datetime] = None, dry_run: bool = False,
+             batch_size: Optional[int] = None) -> RolloverReport:
+    """Moves cold submissions into the archive. Only one rollover runs at a time across all workers."""
+    with file_service.storage_lock("rollover", blocking=False) as acquired:
+        if not acquired:
+            raise RuntimeError("A submissions rollover is already running")
+        return _rollover(db, now or datetime.now(timezone.utc), dry_run, batch_size or config.SUBMISSIONS_ROLLOVER_BATCH_SIZE)
+
+
+def _rollover(db: Session, now: datetime, dry_run: bool, batch_size: int) -> RolloverReport:
+    started = time.monotonic()
+    cutoff = hot_cutoff(now)
+    report = RolloverReport(dry_run=dry_run, cutoff=cutoff)
+    hot = models.Submission.__table__
+    archive = models.ArchivedSubmission.__table__
+    keep = _submissions_to_keep(db)
+    months = Counter()
+    last_id = 0
+    while True:
+        rows = db.execute(
+            select(hot.c.id, hot.c.created_at)
+            .where(hot.c.created_at < cutoff, hot.c.id > last_id)
+            .order_by(hot.c.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        batch = [row for row in rows if row.id not in keep]
+        report.kept_latest += len(rows) - len(batch)
+        if not batch:
+            continue
+        ids = [row.id for row in batch]
+        batch_months = Counter(_month_start(row.created_at) for row in batch)
+        if not dry_run:
+            for month in batch_months:
+                _ensure_month_partition(db, month)
+            # Explicit ids, so nothing outside the partitions just created is copied.
+            db.execute(insert(archive).from_select(
+                list(SUBMISSION_COLUMNS), select(*(hot.c[name] for name in SUBMISSION_COLUMNS)).where(hot.c.id.in_(ids))
+            ))
+            # Only delete what was copied: a row removed concurrently is simply not archived.
+            db.execute(delete(hot).where(hot.c.id.in_(select(archive.c.id).where(archive.c.id.in_(ids)))))
+            db.commit()
+        months.update(batch_months)
+        report.moved += len(batch)
+        report.batches += 1
+
+    report.months = {month.strftime("%Y-%m"): count for month, count in sorted(months.items())}
+    report.duration_ms = round((time.monotonic() - started) * 1000, 2)
+    return report
+
+
+def run_rollover(dry_run: bool = False) -> RolloverReport:
+    db = SessionLocal()
+    try:
+        return rollover(db, dry_run=dry_run)
+    finally:
+        db.close()
+
+
+async def run_periodically(interval_seconds: float):
+    """Background task started from the app lifespan when SUBMISSIONS_ROLLOVER_INTERVAL_HOURS is set."""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            report = await run_in_threadpool(run_rollover)
+            print(f"Submissions rollover archived {report.moved} submissions: {report.as_dict()}")
+        except Exception as e:
+            print(f"Submissions rollover failed: {e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Moves submissions older than the hot months into the archive.")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would move without changing anything")
+    args = parser.parse_args()
+
+    create_tables(engine)
+    report = run_rollover(dry_run=args.dry_run)
+    for key, value in report.as_dict().items():
+        print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
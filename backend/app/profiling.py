@@ -0,0 +1,294 @@
+"""
+Opt-in, admin-only profiling.
+
+Two modes, both off by default:
+  * a sampling session: every thread's stack is sampled for N seconds and the
+    result is returned in the folded format read by flamegraph.pl / speedscope;
+  * slow-request capture: while enabled, every request records its database
+    statements and outbound Anvil calls with timings, and the sampler keeps a
+    short per-thread stack history. Requests slower than the threshold keep
+    their trace, with the stacks sampled on the threads that did their work,
+    in a bounded ring of the most recent such requests.
+"""
+import contextvars
+import functools
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from typing import Dict, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PROFILER_INTERVAL_MS = float(os.getenv("PROFILER_INTERVAL_MS", "10"))
+PROFILER_SLOW_THRESHOLD_MS = os.getenv("PROFILER_SLOW_THRESHOLD_MS")  # Unset: capture disabled
+PROFILER_SLOW_REQUESTS_KEPT = int(os.getenv("PROFILER_SLOW_REQUESTS_KEPT", "50"))
+
+MAX_STATEMENTS_PER_TRACE = 200
+MAX_STATEMENT_LENGTH = 500
+# Per-thread stack history kept for slow-request attribution (~5s at 10ms).
+THREAD_HISTORY_SAMPLES = 500
+
+_current_trace: contextvars.ContextVar[Optional["RequestTrace"]] = contextvars.ContextVar("request_trace", default=None)
+_trace_ids = itertools.count(1)
+
+
+def _fold(frame) -> str:
+    """Renders a stack root-first as `module:function;module:function;...`."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def folded_output(stacks: Counter) -> str:
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+class RequestTrace:
+    def __init__(self, method: str, path: str):
+        self.id = next(_trace_ids)
+        self.method = method
+        self.path = path
+        self.started_at = time.time()
+        self.started = time.monotonic()
+        self.duration_ms = 0.0
+        self.status_code: Optional[int] = None
+        self.statements: List[dict] = []
+        self.external_calls: List[dict] = []
+        self.threads = set()
+        self.stacks: Counter = Counter()
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status_code": self.status_code,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration_ms, 2),
+            "statement_count": len(self.statements),
+            "statement_ms": round(sum(s["duration_ms"] for s in self.statements), 2),
+            "external_call_count": len(self.external_calls),
+            "external_ms": round(sum(c["duration_ms"] for c in self.external_calls), 2),
+            "samples": sum(self.stacks.values()),
+        }
+
+    def detail(self) -> dict:
+        return {**self.summary(), "statements": self.statements, "external_calls": self.external_calls}
+
+
+class Sampler:
+    """Background thread sampling `sys._current_frames()` at a fixed interval."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.interval = PROFILER_INTERVAL_MS / 1000
+        self._sessions: List[Counter] = []
+        self._history: Dict[int, deque] = {}
+        self.keep_history = False
+
+    def _ensure_running(self):
+        # Called with the lock held. The thread clears `_thread` (under the same
+        # lock) when it exits, so there is never a stopping thread to race with.
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="profiler-sampler", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        own = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            now = time.monotonic()
+            frames = sys._current_frames()
+            with self._lock:
+                if not self._sessions and not self.keep_history:
+                    self._thread = None
+                    return
+                live = set()
+                for ident, frame in frames.items():
+                    if ident == own:
+                        continue
+                    live.add(ident)
+                    stack = _fold(frame)
+                    for session in self._sessions:
+                        session[stack] += 1
+                    if self.keep_history:
+                        self._history.setdefault(ident, deque(maxlen=THREAD_HISTORY_SAMPLES)).append((now, stack))
+                for ident in list(self._history):
+                    if ident not in live:
+                        del self._history[ident]
+            del frames
+
+    def start_session(self) -> Counter:
+        session = Counter()
+        with self._lock:
+            self._sessions.append(session)
+            self._ensure_running()
+        return session
+
+    def stop_session(self, session: Counter):
+        with self._lock:
+            self._sessions.remove(session)
+
+    def set_history(self, enabled: bool):
+        with self._lock:
+            self.keep_history = enabled
+            if enabled:
+                self._ensure_running()
+            else:
+                self._history.clear()
+
+    def stacks_between(self, threads, start: float, end: float) -> Counter:
+        stacks = Counter()
+        with self._lock:
+            for ident in threads:
+                for sampled_at, stack in self._history.get(ident, ()):
+                    if start <= sampled_at <= end:
+                        stacks[stack] += 1
+        return stacks
+
+
+class SlowRequestLog:
+    """
+    Keeps the last `size` traces over the threshold, so the log always shows
+    current behaviour rather than the worst requests since capture began.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._traces: deque = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, trace: RequestTrace):
+        with self._lock:
+            self._traces.append(trace)
+
+    def all(self) -> List[RequestTrace]:
+        """Most recent first."""
+        with self._lock:
+            return list(reversed(self._traces))
+
+    def get(self, trace_id: int) -> Optional[RequestTrace]:
+        return next((t for t in self.all() if t.id == trace_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._traces.clear()
+
+
+sampler = Sampler()
+slow_requests = SlowRequestLog(PROFILER_SLOW_REQUESTS_KEPT)
+slow_threshold_ms: Optional[float] = None
+
+
+def configure_slow_capture(threshold_ms: Optional[float]):
+    """Enables capture for requests slower than `threshold_ms`, or disables it with None."""
+    global slow_threshold_ms
+    slow_threshold_ms = threshold_ms
+    slow_requests.clear()
+    sampler.set_history(threshold_ms is not None)
+
+
+# --- Instrumentation ---
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current_trace.get() is not None:
+        conn.info.setdefault("profiler_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    trace = _current_trace.get()
+    started = conn.info.get("profiler_started")
+    if trace is None or not started:
+        return
+    duration_ms = (time.perf_counter() - started.pop()) * 1000
+    trace.threads.add(threading.get_ident())
+    if len(trace.statements) < MAX_STATEMENTS_PER_TRACE:
+        trace.statements.append({"sql": statement[:MAX_STATEMENT_LENGTH], "duration_ms": round(duration_ms, 3)})
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    # after_cursor_execute never fires for a failed statement; pop its start time here.
+    trace = _current_trace.get()
+    started = context.connection.info.get("profiler_started") if context.connection is not None else None
+    if trace is None or not started:
+        return
+    duration_ms = (time.perf_counter() - started.pop()) * 1000
+    trace.threads.add(threading.get_ident())
+    if len(trace.statements) < MAX_STATEMENTS_PER_TRACE:
+        trace.statements.append({
+            "sql": (context.statement or "")[:MAX_STATEMENT_LENGTH],
+            "duration_ms": round(duration_ms, 3),
+            "error": type(context.original_exception).__name__,
+        })
+
+
+def traced(name: str):
+    """Decorator recording calls to an outbound service on the current request trace."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            trace = _current_trace.get()
+            if trace is None:
+                return func(*args, **kwargs)
+            trace.threads.add(threading.get_ident())
+            started = time.perf_counter()
+            error = None
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                error = type(e).__name__
+                raise
+            finally:
+                trace.external_calls.append({
+                    "name": name,
+                    "duration_ms": round((time.perf_counter() - started) * 1000, 3),
+                    "error": error,
+                })
+        return wrapper
+    return decorator
+
+
+class ProfilingMiddleware:
+    """ASGI middleware tracing requests while slow-request capture is enabled."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        threshold = slow_threshold_ms
+        if scope["type"] != "http" or threshold is None:
+            await self.app(scope, receive, send)
+            return
+
+        trace = RequestTrace(scope["method"], scope["path"])
+        token = _current_trace.set(trace)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                trace.status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current_trace.reset(token)
+            ended = time.monotonic()
+            trace.duration_ms = (ended - trace.started) * 1000
+            if trace.duration_ms >= threshold:
+                trace.stacks = sampler.stacks_between(trace.threads, trace.started, ended)
+                slow_requests.add(trace)
+
+
+if PROFILER_SLOW_THRESHOLD_MS:
+    configure_slow_capture(float(PROFILER_SLOW_THRESHOLD_MS))
@@ -0,0 +1,231 @@
+"""
+Retention for stored submission PDFs.
+
+A sweep walks PDF_STORAGE_PATH once and:
+  * moves PDFs of submissions older than their template's packing age into
+    compressed packs (file_service.open_pdf reads them straight from the pack);
+  * removes loose copies restored from packs for X-Accel-Redirect once they
+    have gone unused;
+  * deletes PDFs that have no submission, and pack index entries and packs
+    whose submissions are gone.
+Disk reads and writes are throttled to RETENTION_IO_BYTES_PER_SECOND.
+
+Usage:
+    python -m app.retention [--dry-run]
+"""
+import argparse
+import asyncio
+import os
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from . import config, models, partitions
+from .database import SessionLocal, create_tables, engine
+from .service import file_service
+
+# Submission eids looked up per query.
+LOOKUP_BATCH_SIZE = 500
+
+
+class IoThrottle:
+    """Sleeps as needed to keep the bytes reported to it under `bytes_per_second`."""
+
+    def __init__(self, bytes_per_second: Optional[int]):
+        self.bytes_per_second = bytes_per_second
+        self._started = time.monotonic()
+        self._bytes = 0
+
+    def __call__(self, n: int):
+        if not self.bytes_per_second:
+            return
+        self._bytes += n
+        ahead = self._bytes / self.bytes_per_second - (time.monotonic() - self._started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+@dataclass
+class RetentionReport:
+    dry_run: bool = False
+    scanned_files: int = 0
+    packs_written: int = 0
+    packed_files: int = 0
+    packed_bytes: int = 0
+    pack_bytes: int = 0
+    restored_copies_removed: int = 0
+    restored_copy_bytes: int = 0
+    orphans_deleted: int = 0
+    orphan_bytes: int = 0
+    stale_index_entries: int = 0
+    packs_deleted: int = 0
+    deleted_pack_bytes: int = 0
+    duration_ms: float = 0.0
+
+    @property
+    def reclaimed_bytes(self) -> int:
+        return (
+            self.packed_bytes - self.pack_bytes
+            + self.restored_copy_bytes + self.orphan_bytes + self.deleted_pack_bytes
+        )
+
+    def as_dict(self) -> dict:
+        return {**asdict(self), "reclaimed_bytes": self.reclaimed_bytes}
+
+
+def _as_utc(value: datetime) -> datetime:
+    # SQLite hands back naive datetimes; they are UTC.
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+
+
+def _pack_cutoff(template_id: str, now: datetime) -> Optional[datetime]:
+    days = config.RETENTION_TEMPLATE_POLICIES.get(template_id, config.RETENTION_PACK_AFTER_DAYS)
+    return None if days is None else now - timedelta(days=days)
+
+
+def _submission_created_at(db: Session, eids):
+    """Maps each eid that has a submission to (template_id, created_at)."""
+    eids = list(eids)
+    found = {}
+    # Archived submissions still own their PDFs.
+    S = partitions.all_submissions().c
+    for start in range(0, len(eids), LOOKUP_BATCH_SIZE):
+        stmt = select(S.anvil_submission_eid, S.template_id, S.created_at).where(
+            S.anvil_submission_eid.in_(eids[start:start + LOOKUP_BATCH_SIZE])
+        )
+        for eid, template_id, created_at in db.execute(stmt):
+            found[eid] = (template_id, _as_utc(created_at))
+    return found
+
+
+def _remove(path: str, dry_run: bool):
+    if not dry_run:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def sweep(db: Session, now: Optional[datetime] = None, dry_run: bool = False,
+          bytes_per_second: Optional[int] = None) -> RetentionReport:
+    """Runs one retention pass over submission PDF storage. Only one pass runs at a time across all workers."""
+    with file_service.storage_lock("retention", blocking=False) as acquired:
+        if not acquired:
+            raise RuntimeError("A retention sweep is already running")
+        return _sweep(db, now or datetime.now(timezone.utc), dry_run, bytes_per_second)
+
+
+def _sweep(db: Session, now: datetime, dry_run: bool, bytes_per_second: Optional[int]) -> RetentionReport:
+    started = time.monotonic()
+    report = RetentionReport(dry_run=dry_run)
+    throttle = IoThrottle(config.RETENTION_IO_BYTES_PER_SECOND if bytes_per_second is None else bytes_per_second)
+    grace_cutoff = (now - timedelta(hours=config.RETENTION_ORPHAN_GRACE_HOURS)).timestamp()
+
+    with os.scandir(file_service.STORAGE_PATH) as entries:
+        loose = {e.name[:-4]: e.stat() for e in entries if e.is_file() and e.name.endswith(".pdf")}
+    report.scanned_files = len(loose)
+    index = file_service.read_pack_index()
+    submissions = _submission_created_at(db, set(loose) | set(index))
+
+    to_pack, batch_bytes = [], 0
+    for eid, stat in loose.items():
+        path = os.path.join(file_service.STORAGE_PATH, f"{eid}.pdf")
+        if eid not in submissions:
+            if stat.st_mtime < grace_cutoff:
+                report.orphans_deleted += 1
+                report.orphan_bytes += stat.st_size
+                _remove(path, dry_run)
+            continue
+
+        template_id, created_at = submissions[eid]
+        cutoff = _pack_cutoff(template_id, now)
+        if cutoff is None or created_at >= cutoff:
+            continue
+        if eid in index:
+            # A copy restored for a download; the pack still holds the original.
+            if stat.st_mtime < grace_cutoff:
+                report.restored_copies_removed += 1
+                report.restored_copy_bytes += stat.st_size
+                _remove(path, dry_run)
+            continue
+
+        to_pack.append(eid)
+        batch_bytes += stat.st_size
+        if batch_bytes >= config.RETENTION_PACK_MAX_BYTES:
+            _pack(to_pack, loose, report, throttle, dry_run)
+            to_pack, batch_bytes = [], 0
+    if to_pack:
+        _pack(to_pack, loose, report, throttle, dry_run)
+
+    # Re-read to include the packs written above.
+    index = file_service.read_pack_index()
+    stale = [eid for eid in index if eid not in submissions]
+    report.stale_index_entries = len(stale)
+    if stale and not dry_run:
+        file_service.drop_from_pack_index(stale)
+    live_packs = {pack for eid, pack in index.items() if eid in submissions}
+    for name, stat in file_service.list_packs().items():
+        # Recent unindexed packs may still be getting their index entries.
+        if name not in live_packs and (name in index.values() or stat.st_mtime < grace_cutoff):
+            report.packs_deleted += 1
+            report.deleted_pack_bytes += stat.st_size
+            _remove(os.path.join(file_service.PACK_STORAGE_PATH, name), dry_run)
+
+    report.duration_ms = round((time.monotonic() - started) * 1000, 2)
+    return report
+
+
+def _pack(eids, loose, report: RetentionReport, throttle: IoThrottle, dry_run: bool):
+    if dry_run:
+        # Compressed sizes are unknown without writing the pack; count none saved.
+        size = sum(loose[eid].st_size for eid in eids)
+        report.packs_written += 1
+        report.packed_files += len(eids)
+        report.packed_bytes += size
+        report.pack_bytes += size
+        return
+    name, packed, pack_size = file_service.write_pack(eids, throttle)
+    if name:
+        report.packs_written += 1
+        report.packed_files += len(packed)
+        report.packed_bytes += sum(packed.values())
+        report.pack_bytes += pack_size
+
+
+def run_sweep(dry_run: bool = False) -> RetentionReport:
+    db = SessionLocal()
+    try:
+        return sweep(db, dry_run=dry_run)
+    finally:
+        db.close()
+
+
+async def run_periodically(interval_seconds: float):
+    """Background task started from the app lifespan when RETENTION_INTERVAL_HOURS is set."""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            report = await run_in_threadpool(run_sweep)
+            print(f"Retention sweep reclaimed {report.reclaimed_bytes} bytes: {report.as_dict()}")
+        except Exception as e:
+            print(f"Retention sweep failed: {e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Packs cold submission PDFs and deletes orphaned ones.")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would change without touching storage")
+    args = parser.parse_args()
+
+    create_tables(engine)
+    report = run_sweep(dry_run=args.dry_run)
+    for key, value in report.as_dict().items():
+        print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
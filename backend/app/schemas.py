@@ -1,6 +1,6 @@
 from pydantic import BaseModel, ConfigDict
-from typing import Optional
-from datetime import datetime
+from typing import Dict, List, Optional
+from datetime import date, datetime
 
 class UserBase(BaseModel):
     email: str
@@ -46,6 +46,122 @@ class Submission(SubmissionBase):
     updated_at: Optional[datetime] = None
     model_config = ConfigDict(from_attributes=True)
 
+class SubmissionHistoryItem(Submission):
+    template: Optional[PDFTemplate] = None
+
+class SubmissionHistory(BaseModel):
+    submissions: List[SubmissionHistoryItem]
+    next_before_id: Optional[int] = None  # Pass as before_id for the next page; None on the last page
+
 class AdminDashboardTemplate(PDFTemplate):
     owner: User
     latest_submission: Optional[Submission] = None
+
+class AdminDashboardRow(BaseModel):
+    owner: User
+    template: PDFTemplate
+    latest_submission: Optional[Submission] = None
+
+class DailySubmissionCount(BaseModel):
+    day: date
+    total: int
+    model_config = ConfigDict(from_attributes=True)
+
+class TemplateAnalytics(BaseModel):
+    template_id: str
+    title: str
+    owner_id: int
+    total: int
+    last_submission_id: Optional[int] = None
+    daily: List[DailySubmissionCount] = []
+
+class BuyerAnalytics(BaseModel):
+    buyer_id: int
+    email: str
+    total: int
+    last_submission_id: Optional[int] = None
+
+class SubmissionAnalytics(BaseModel):
+    since: date
+    templates: List[TemplateAnalytics]
+    buyers: List[BuyerAnalytics]
+
+class SearchResult(BaseModel):
+    kind: str
+    ref: str
+    title: Optional[str] = None
+    owner_email: Optional[str] = None
+    buyer_email: Optional[str] = None
+    score: float
+
+class SearchResults(BaseModel):
+    results: List[SearchResult]
+    limit: int
+    offset: int
+    has_more: bool
+
+class FormDraft(BaseModel):
+    id: int
+    template_id: str
+    version: int
+    data: dict
+    updated_at: Optional[datetime] = None
+
+class FormDraftSaved(BaseModel):
+    id: int
+    version: int
+
+class SlowRequestCapture(BaseModel):
+    enabled: bool
+    threshold_ms: Optional[float] = None
+
+class RetentionReport(BaseModel):
+    dry_run: bool
+    scanned_files: int
+    packs_written: int
+    packed_files: int
+    packed_bytes: int
+    pack_bytes: int
+    restored_copies_removed: int
+    restored_copy_bytes: int
+    orphans_deleted: int
+    orphan_bytes: int
+    stale_index_entries: int
+    packs_deleted: int
+    deleted_pack_bytes: int
+    reclaimed_bytes: int
+    duration_ms: float
+
+class RolloverReport(BaseModel):
+    dry_run: bool
+    cutoff: datetime
+    moved: int
+    kept_latest: int
+    batches: int
+    months: Dict[str, int]
+    duration_ms: float
+
+class DownloadUrl(BaseModel):
+    url: str
+    expires_at: datetime
+
+class TemplateFieldsBatchRequest(BaseModel):
+    template_ids: List[str]
+
+class TemplateFieldsError(BaseModel):
+    status_code: int
+    detail: str
+
+class TemplateFieldsBatch(BaseModel):
+    fields: Dict[str, List[dict]]
+    errors: Dict[str, TemplateFieldsError]
+
+class TemplateCacheStats(BaseModel):
+    size: int
+    max_size: int
+    version: Optional[int] = None
+    hits: int
+    misses: int
+    hit_rate: Optional[float] = None
+    evictions: int
+    invalidations: int
@@ -0,0 +1,260 @@
+"""
+Full-text search index over templates and submissions.
+
+SQLite uses an FTS5 virtual table, Postgres a table with a generated tsvector
+column and a GIN index. Both hold one row per template and per submission and
+are kept in sync by crud.create_template / crud.create_submission and their
+bulk variants. Other databases have no index; search falls back to unranked
+LIKE matching over the tables themselves.
+
+Rebuild the index for existing data with:
+    python -m app.search
+"""
+import re
+from typing import Optional
+
+from sqlalchemy import bindparam, event, text
+from sqlalchemy.orm import Session
+
+from . import models
+from .database import Base
+
+SEARCH_TABLE = "search_index"
+SUPPORTED_DIALECTS = ("sqlite", "postgresql")
+
+_SQLITE_DDL = [
+    f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5(
+        kind UNINDEXED,
+        ref UNINDEXED,
+        owner_id UNINDEXED,
+        buyer_id UNINDEXED,
+        title,
+        owner_email,
+        buyer_email,
+        eid,
+        tokenize = 'unicode61',
+        prefix = '2 3 4'
+    )
+    """,
+]
+
+_POSTGRES_DDL = [
+    f"""
+    CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} (
+        id BIGSERIAL PRIMARY KEY,
+        kind TEXT NOT NULL,
+        ref TEXT NOT NULL,
+        owner_id INTEGER,
+        buyer_id INTEGER,
+        title TEXT,
+        owner_email TEXT,
+        buyer_email TEXT,
+        eid TEXT,
+        document TSVECTOR GENERATED ALWAYS AS (
+            to_tsvector('simple', regexp_replace(
+                coalesce(title, '') || ' ' || coalesce(owner_email, '') || ' ' ||
+                coalesce(buyer_email, '') || ' ' || coalesce(eid, ''),
+                '[^[:alnum:]]+', ' ', 'g'
+            ))
+        ) STORED
+    )
+    """,
+    f"CREATE INDEX IF NOT EXISTS ix_{SEARCH_TABLE}_document ON {SEARCH_TABLE} USING GIN (document)",
+    f"CREATE INDEX IF NOT EXISTS ix_{SEARCH_TABLE}_kind_ref ON {SEARCH_TABLE} (kind, ref)",
+]
+
+_COLUMNS = "kind, ref, owner_id, buyer_id, title, owner_email, buyer_email, eid"
+
+
+@event.listens_for(Base.metadata, "after_create")
+def create_search_index(target, connection, **kw):
+    ddl = {"sqlite": _SQLITE_DDL, "postgresql": _POSTGRES_DDL}.get(connection.dialect.name, [])
+    for statement in ddl:
+        connection.execute(text(statement))
+
+
+@event.listens_for(Base.metadata, "before_drop")
+def drop_search_index(target, connection, **kw):
+    if connection.dialect.name in SUPPORTED_DIALECTS:
+        connection.execute(text(f"DROP TABLE IF EXISTS {SEARCH_TABLE}"))
+
+
+def _dialect(db: Session) -> str:
+    return db.get_bind().dialect.name
+
+
+def _insert(db: Session, **document):
+    if _dialect(db) not in SUPPORTED_DIALECTS:
+        return
+    db.execute(
+        text(f"INSERT INTO {SEARCH_TABLE} ({_COLUMNS}) VALUES "
+             "(:kind, :ref, :owner_id, :buyer_id, :title, :owner_email, :buyer_email, :eid)"),
+        document,
+    )
+
+
+def index_template(db: Session, template: models.PDFTemplate):
+    """Adds a template to the index. Runs inside the caller's transaction."""
+    owner = db.get(models.User, template.owner_id)
+    _insert(
+        db,
+        kind="template",
+        ref=template.anvil_template_eid,
+        owner_id=template.owner_id,
+        buyer_id=None,
+        title=template.title,
+        owner_email=owner.email if owner else None,
+        buyer_email=None,
+        eid=template.anvil_template_eid,
+    )
+
+
+def index_submission(db: Session, submission: models.Submission):
+    """Adds a submission to the index. Runs inside the caller's transaction."""
+    template = (
+        db.query(models.PDFTemplate.title, models.PDFTemplate.owner_id, models.User.email)
+        .join(models.User, models.User.id == models.PDFTemplate.owner_id, isouter=True)
+        .filter(models.PDFTemplate.anvil_template_eid == submission.template_id)
+        .first()
+    )
+    buyer = db.get(models.User, submission.buyer_id)
+    _insert(
+        db,
+        kind="submission",
+        ref=submission.anvil_submission_eid,
+        owner_id=template.owner_id if template else None,
+        buyer_id=submission.buyer_id,
+        title=template.title if template else None,
+        owner_email=template.email if template else None,
+        buyer_email=buyer.email if buyer else None,
+        eid=submission.anvil_submission_eid,
+    )
+
+
+_TEMPLATE_DOCUMENTS = """
+    SELECT 'template' AS kind, t.anvil_template_eid AS ref, t.owner_id AS owner_id, NULL AS buyer_id,
+           t.title AS title, o.email AS owner_email, NULL AS buyer_email, t.anvil_template_eid AS eid
+    FROM templates t LEFT JOIN users o ON o.id = t.owner_id
+"""
+
+_SUBMISSION_DOCUMENTS = """
+    SELECT 'submission' AS kind, s.anvil_submission_eid AS ref, t.owner_id AS owner_id, s.buyer_id AS buyer_id,
+           t.title AS title, o.email AS owner_email, b.email AS buyer_email, s.anvil_submission_eid AS eid
+    FROM {submissions} s
+    LEFT JOIN templates t ON t.anvil_template_eid = s.template_id
+    LEFT JOIN users o ON o.id = t.owner_id
+    LEFT JOIN users b ON b.id = s.buyer_id
+"""
+
+
+def _insert_selected(db: Session, documents: str, where: str = "", ids=None):
+    stmt = text(f"INSERT INTO {SEARCH_TABLE} ({_COLUMNS}) {documents} {where}")
+    if ids is not None:
+        stmt = stmt.bindparams(bindparam("ids", expanding=True))
+    db.execute(stmt, {} if ids is None else {"ids": list(ids)})
+
+
+def index_templates(db: Session, template_ids):
+    """Adds the templates with these ids to the index in one statement. Runs inside the caller's transaction."""
+    if template_ids and _dialect(db) in SUPPORTED_DIALECTS:
+        _insert_selected(db, _TEMPLATE_DOCUMENTS, "WHERE t.id IN :ids", template_ids)
+
+
+def index_submissions(db: Session, submission_ids):
+    """Adds the submissions with these ids to the index in one statement. Runs inside the caller's transaction."""
+    if submission_ids and _dialect(db) in SUPPORTED_DIALECTS:
+        _insert_selected(db, _SUBMISSION_DOCUMENTS.format(submissions="submissions"), "WHERE s.id IN :ids", submission_ids)
+
+
+def rebuild_search_index(db: Session):
+    """Repopulates the index from the templates and submissions tables."""
+    if _dialect(db) not in SUPPORTED_DIALECTS:
+        return
+    db.execute(text(f"DELETE FROM {SEARCH_TABLE}"))
+    _insert_selected(db, _TEMPLATE_DOCUMENTS)
+    for table in ("submissions", "submissions_archive"):
+        _insert_selected(db, _SUBMISSION_DOCUMENTS.format(submissions=table))
+    db.commit()
+
+
+def _query_terms(query: str):
+    return re.findall(r"[^\W_]+", query.lower())
+
+
+def search(
+    db: Session,
+    query: str,
+    user: models.User,
+    kind: Optional[str] = None,
+    limit: int = 20,
+    offset: int = 0,
+):
+    """
+    Ranked prefix search, scoped to what `user` may see: admins see everything,
+    agents their own templates and the submissions made against them, buyers
+    every template and their own submissions.
+    Returns `(rows, has_more)`. Higher `score` is more relevant on every backend;
+    without a search index it is 0 and rows come in (kind, ref) order.
+    """
+    terms = _query_terms(query)
+    if not terms:
+        return [], False
+
+    dialect = _dialect(db)
+    params = {"limit": limit + 1, "offset": offset}
+    filters = []
+    if kind:
+        filters.append("kind = :kind")
+        params["kind"] = kind
+    if user.role == "Agent":
+        filters.append("owner_id = :user_id")
+        params["user_id"] = user.id
+    elif user.role == "Buyer":
+        filters.append("(kind = 'template' OR buyer_id = :user_id)")
+        params["user_id"] = user.id
+    elif user.role != "Admin":
+        return [], False
+
+    if dialect == "sqlite":
+        params["match"] = " ".join(f'"{term}"*' for term in terms)
+        where = " AND ".join([f"{SEARCH_TABLE} MATCH :match", *filters])
+        # FTS5's rank is bm25(), where lower is better; negate it to match ts_rank.
+        sql = f"SELECT {_COLUMNS}, -rank AS score FROM {SEARCH_TABLE} WHERE {where} ORDER BY rank"
+    elif dialect == "postgresql":
+        params["match"] = " & ".join(f"{term}:*" for term in terms)
+        where = " AND ".join(["document @@ to_tsquery('simple', :match)", *filters])
+        sql = (f"SELECT {_COLUMNS}, ts_rank(document, to_tsquery('simple', :match)) AS score "
+               f"FROM {SEARCH_TABLE} WHERE {where} ORDER BY score DESC")
+    else:
+        # Every term must appear in one of the searchable columns.
+        for n, term in enumerate(terms):
+            params[f"term_{n}"] = f"%{term}%"
+            filters.append("(" + " OR ".join(
+                f"lower({column}) LIKE :term_{n}" for column in ("title", "owner_email", "buyer_email", "eid")
+            ) + ")")
+        documents = " UNION ALL ".join([
+            _TEMPLATE_DOCUMENTS,
+            _SUBMISSION_DOCUMENTS.format(submissions="submissions"),
+            _SUBMISSION_DOCUMENTS.format(submissions="submissions_archive"),
+        ])
+        sql = f"SELECT {_COLUMNS}, 0 AS score FROM ({documents}) documents WHERE {' AND '.join(filters)} ORDER BY kind, ref"
+
+    rows = db.execute(text(f"{sql} LIMIT :limit OFFSET :offset"), params).mappings().all()
+    return rows[:limit], len(rows) > limit
+
+
+def main():
+    from .database import SessionLocal, create_tables, engine
+
+    create_tables(engine)
+    db = SessionLocal()
+    try:
+        rebuild_search_index(db)
+        print("Rebuilt the search index")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
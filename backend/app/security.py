@@ -1,21 +1,61 @@
+import base64
+import hashlib
+import hmac
+import os
+import time
 from datetime import datetime, timedelta, timezone
-from typing import Optional
+from typing import List, Optional
 from passlib.context import CryptContext
 from jose import jwt
 
 # Secret key to sign the JWT token.
 # In a production app, load this from environment variables and keep it secret!
-SECRET_KEY = "a_very_secret_key_for_jwt" 
+SECRET_KEY = os.getenv("SECRET_KEY") or "a_very_secret_key_for_jwt"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Key for signed download URLs; set separately to revoke every outstanding URL without logging users out.
+# Unset (or empty), it is derived from a configured SECRET_KEY. It is never derived from the
+# public fallback above: a signed URL is served without a database check, so with no real
+# secret configured nothing is signed or verified and the API refuses to start.
+_configured_secret_key = os.getenv("SECRET_KEY")
+DOWNLOAD_URL_SECRET = os.getenv("DOWNLOAD_URL_SECRET") or (hmac.new(
+    _configured_secret_key.encode("utf-8"), b"download-url", hashlib.sha256
+).hexdigest() if _configured_secret_key else None)
+
+# Password hashing policy.
+# The first scheme hashes new passwords; any others are still accepted for
+# verification and marked deprecated, so they are rehashed on the next login.
+PASSWORD_HASH_SCHEMES = [s.strip() for s in os.getenv("PASSWORD_HASH_SCHEMES", "bcrypt").split(",") if s.strip()]
+PASSWORD_HASH_PROFILE = os.getenv("PASSWORD_HASH_PROFILE", "default")
+
+# Cost settings per profile. "test" uses the minimum cost each scheme allows and
+# must never be used outside the test suite.
+PASSWORD_HASH_PROFILES = {
+    "default": {"bcrypt__rounds": 12, "pbkdf2_sha256__rounds": 600_000, "argon2__time_cost": 3},
+    "fast": {"bcrypt__rounds": 10, "pbkdf2_sha256__rounds": 200_000, "argon2__time_cost": 2},
+    "test": {"bcrypt__rounds": 4, "pbkdf2_sha256__rounds": 1_000, "argon2__time_cost": 1, "argon2__memory_cost": 8, "argon2__parallelism": 1},
+}
+
+def build_password_context(schemes: List[str], profile: str = "default", **overrides) -> CryptContext:
+    """Builds a CryptContext for `schemes` with the cost settings of `profile`."""
+    if profile not in PASSWORD_HASH_PROFILES:
+        raise ValueError(f"Unknown password hash profile '{profile}'")
+    settings = {**PASSWORD_HASH_PROFILES[profile], **overrides}
+    settings = {key: value for key, value in settings.items() if key.split("__")[0] in schemes}
+    return CryptContext(schemes=schemes, deprecated="auto", **settings)
+
+_cost_overrides = {"bcrypt__rounds": int(os.environ["BCRYPT_ROUNDS"])} if os.getenv("BCRYPT_ROUNDS") else {}
+pwd_context = build_password_context(PASSWORD_HASH_SCHEMES, PASSWORD_HASH_PROFILE, **_cost_overrides)
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verifies a plain password against a hashed one."""
     return pwd_context.verify(plain_password, hashed_password)
 
+def password_needs_rehash(hashed_password: str) -> bool:
+    """True when a stored hash uses a deprecated scheme or a cost the current policy no longer wants."""
+    return pwd_context.needs_update(hashed_password)
+
 def get_password_hash(password: str) -> str:
     """Hashes a plain password."""
     return pwd_context.hash(password)
@@ -29,4 +69,22 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
         expire = datetime.now(timezone.utc) + timedelta(minutes=15)
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
\ No newline at end of file
+    return encoded_jwt
+
+def require_download_url_secret() -> str:
+    if not DOWNLOAD_URL_SECRET:
+        raise RuntimeError("Signed download URLs need DOWNLOAD_URL_SECRET or SECRET_KEY to be set")
+    return DOWNLOAD_URL_SECRET
+
+def sign_download(submission_eid: str, expires: int) -> str:
+    """HMAC-SHA256 signature authorising a download of `submission_eid` until the unix time `expires`."""
+    secret = require_download_url_secret()
+    message = f"{submission_eid}:{expires}".encode("utf-8")
+    digest = hmac.new(secret.encode("utf-8"), message, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode("ascii")
+
+def verify_download_signature(submission_eid: str, expires: int, signature: str) -> bool:
+    require_download_url_secret()
+    if expires < time.time():
+        return False
+    return hmac.compare_digest(sign_download(submission_eid, expires), signature)
@@ -8,6 +8,8 @@ from python_anvil.api_resources.payload import (
 )
 import os, base64
 
+from .. import profiling
+
 # --- Anvil GraphQL Configuration ---
 ANVIL_GRAPHQL_URL = "https://graphql.useanvil.com"
 ANVIL_API_KEY = os.getenv("ANVIL_API_KEY")
@@ -22,6 +24,7 @@ else:
 
 anvil = Anvil(api_key=ANVIL_API_KEY)
 
+@profiling.traced("anvil.create_etch_packet")
 def create_etch_packet(file_content, current_user, file_name = None, file_type = None):
     packet = CreateEtchPacket(
         name="Packet Name"
@@ -67,6 +70,7 @@ def create_etch_packet(file_content, current_user, file_name = None, file_type =
 
     return response
 
+@profiling.traced("anvil.fill_pdf")
 def submit_filled_pdf(submission_data, db_template):
     payload = {
         "title": "Filled Document from WebForm",
@@ -81,14 +85,17 @@ def submit_filled_pdf(submission_data, db_template):
 
     return fill_response
 
+@profiling.traced("anvil.download_documents")
 def download_filled_pdf(weld_data_eid: str): 
     pdf_bytes = anvil.download_documents(weld_data_eid)
     return pdf_bytes
 
+@profiling.traced("anvil.get_cast")
 def get_cast(anvil_template_eid):
     cast_data = anvil.get_cast(eid=anvil_template_eid)
     return cast_data
 
+@profiling.traced("anvil.get_casts")
 def get_casts():
     cast_datas = anvil.get_casts()
     return cast_datas
\ No newline at end of file
@@ -1,4 +1,5 @@
-import os
+import fcntl, hashlib, io, json, os, shutil, sqlite3, time, uuid, zipfile
+from contextlib import closing, contextmanager
 from fastapi import HTTPException
 
 STORAGE_PATH = os.path.abspath(os.getenv("PDF_STORAGE_PATH"))
@@ -21,4 +22,253 @@ def upload_pdf(filename: str, file_content: str):
     return {"info": f"File '{filename}' saved successfully at '{file_location}'"}
 
 def get_pdf_path(submission_eid: str):
-    return os.path.join(STORAGE_PATH, f"{submission_eid}.pdf")
\ No newline at end of file
+    return os.path.join(STORAGE_PATH, f"{submission_eid}.pdf")
+
+def open_pdf(submission_eid: str):
+    """
+    Opens a stored submission PDF for reading, straight from its pack if the
+    retention sweep packed it; nothing is written to disk. Returns (file, size).
+    Raises FileNotFoundError if the PDF is neither loose nor packed.
+    """
+    try:
+        source = open(get_pdf_path(submission_eid), "rb")
+        return source, os.fstat(source.fileno()).st_size
+    except FileNotFoundError:
+        pass
+    pack = find_pack(submission_eid)
+    if pack is None:
+        raise FileNotFoundError(submission_eid)
+    try:
+        # The member keeps the pack open after the ZipFile is closed, even if a sweep deletes it.
+        with zipfile.ZipFile(os.path.join(PACK_STORAGE_PATH, pack)) as archive:
+            member = archive.getinfo(f"{submission_eid}.pdf")
+            return archive.open(member), member.file_size
+    except KeyError:
+        raise FileNotFoundError(submission_eid)
+
+# Original template PDFs, kept apart from the filled submission PDFs.
+TEMPLATE_STORAGE_PATH = os.path.join(STORAGE_PATH, "templates")
+os.makedirs(TEMPLATE_STORAGE_PATH, exist_ok=True)
+
+def get_template_pdf_path(template_eid: str):
+    return os.path.join(TEMPLATE_STORAGE_PATH, f"{template_eid}.pdf")
+
+def upload_template_pdf(template_eid: str, file_content: bytes):
+    file_location = get_template_pdf_path(template_eid)
+
+    if not os.path.abspath(file_location).startswith(TEMPLATE_STORAGE_PATH + os.sep):
+        raise HTTPException(status_code=400, detail="Invalid template id causing directory traversal.")
+
+    try:
+        with open(file_location, "wb") as file_object:
+            file_object.write(file_content)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred while saving the template: {e}")
+
+    return file_location
+
+# Cold submission PDFs are moved into compressed zip packs by the retention
+# sweep. index.sqlite3 maps each packed submission eid to the pack holding it,
+# so a lookup reads one key however many PDFs are packed.
+PACK_STORAGE_PATH = os.path.join(STORAGE_PATH, "packs")
+os.makedirs(PACK_STORAGE_PATH, exist_ok=True)
+
+@contextmanager
+def storage_lock(name: str, blocking: bool = True):
+    """
+    Exclusive lock shared by every worker process (and thread) using this
+    storage, held with flock on packs/<name>.lock. Yields whether it was
+    acquired, which is only False when `blocking` is False and it is held.
+    """
+    with open(os.path.join(PACK_STORAGE_PATH, f"{name}.lock"), "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _pack_index():
+    """A connection to the pack index, created (and filled from a legacy index.json) on first use."""
+    connection = sqlite3.connect(os.path.join(PACK_STORAGE_PATH, "index.sqlite3"), timeout=30)
+    connection.execute("CREATE TABLE IF NOT EXISTS packed (eid TEXT PRIMARY KEY, pack TEXT NOT NULL)")
+    legacy_path = os.path.join(PACK_STORAGE_PATH, "index.json")
+    if os.path.exists(legacy_path):
+        with storage_lock("index"):
+            try:
+                with open(legacy_path) as index_file:
+                    legacy = json.load(index_file)
+            except FileNotFoundError:
+                legacy = {}
+            with connection:
+                connection.executemany("INSERT OR IGNORE INTO packed VALUES (?, ?)", legacy.items())
+            if legacy:
+                os.remove(legacy_path)
+    return connection
+
+def find_pack(submission_eid: str):
+    """Name of the pack holding `submission_eid`, or None if it is not packed."""
+    with closing(_pack_index()) as connection:
+        row = connection.execute("SELECT pack FROM packed WHERE eid = ?", (submission_eid,)).fetchone()
+    return row[0] if row else None
+
+def read_pack_index() -> dict:
+    """The whole index as {eid: pack}; for the retention sweep, not per-request lookups."""
+    with closing(_pack_index()) as connection:
+        return dict(connection.execute("SELECT eid, pack FROM packed"))
+
+def list_packs():
+    """Pack file names with their size and modification time."""
+    with os.scandir(PACK_STORAGE_PATH) as entries:
+        return {e.name: e.stat() for e in entries if e.is_file() and e.name.endswith(".zip")}
+
+def restore_packed_pdf(submission_eid: str) -> bool:
+    """
+    Puts a loose copy of a packed PDF back in storage, for senders that need a
+    real file (X-Accel-Redirect). Returns False if it is not stored at all.
+    The copy is removed again by the retention sweep once it goes unused.
+    """
+    path = get_pdf_path(submission_eid)
+    if os.path.exists(path):
+        return True
+    try:
+        source, _ = open_pdf(submission_eid)
+    except FileNotFoundError:
+        return False
+    # Concurrent restores each write their own temp file; the last rename wins.
+    temp_path = f"{path}.{uuid.uuid4().hex}.restore"
+    try:
+        with source, open(temp_path, "wb") as target:
+            shutil.copyfileobj(source, target, ARCHIVE_CHUNK_SIZE)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return True
+
+def write_pack(submission_eids, throttle=None):
+    """
+    Moves the loose PDFs for `submission_eids` into a new deflated pack, adds
+    them to the index and deletes the loose files. `throttle(n)` is called for
+    every n bytes read or written. Returns (pack name, {eid: original size}, pack size).
+    """
+    name = f"pack-{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}.zip"
+    pack_path = os.path.join(PACK_STORAGE_PATH, name)
+    temp_path = f"{pack_path}.tmp"
+    packed = {}
+    with zipfile.ZipFile(temp_path, mode="w", compression=zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+        for eid in submission_eids:
+            path = os.path.join(STORAGE_PATH, f"{eid}.pdf")
+            try:
+                source = open(path, "rb")
+            except FileNotFoundError:
+                continue
+            with source:
+                info = zipfile.ZipInfo.from_file(path, arcname=f"{eid}.pdf")
+                info.compress_type = zipfile.ZIP_DEFLATED
+                with archive.open(info, mode="w", force_zip64=True) as entry:
+                    while chunk := source.read(ARCHIVE_CHUNK_SIZE):
+                        entry.write(chunk)
+                        if throttle:
+                            throttle(len(chunk))
+            packed[eid] = info.file_size
+    if not packed:
+        os.remove(temp_path)
+        return None, packed, 0
+    os.replace(temp_path, pack_path)
+    pack_size = os.path.getsize(pack_path)
+    if throttle:
+        throttle(pack_size)
+
+    with closing(_pack_index()) as connection, connection:
+        connection.executemany("INSERT OR REPLACE INTO packed VALUES (?, ?)", ((eid, name) for eid in packed))
+    for eid in packed:
+        os.remove(os.path.join(STORAGE_PATH, f"{eid}.pdf"))
+    return name, packed, pack_size
+
+def drop_from_pack_index(submission_eids):
+    with closing(_pack_index()) as connection, connection:
+        connection.executemany("DELETE FROM packed WHERE eid = ?", ((eid,) for eid in submission_eids))
+
+# Bytes read per step from an uploaded template while it is hashed.
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+async def read_upload_with_hash(file, chunk_size: int = UPLOAD_CHUNK_SIZE):
+    """Reads an UploadFile in chunks, returning its bytes and their SHA-256 hex digest."""
+    digest = hashlib.sha256()
+    content = bytearray()
+    while chunk := await file.read(chunk_size):
+        digest.update(chunk)
+        content += chunk
+    return bytes(content), digest.hexdigest()
+
+# Bytes read from disk per step when streaming archives; also bounds how much
+# archive data is buffered before it is handed to the client.
+ARCHIVE_CHUNK_SIZE = 64 * 1024
+
+def iter_file(source, chunk_size: int = ARCHIVE_CHUNK_SIZE):
+    """Yields an open file (e.g. from open_pdf) in chunks, closing it at the end."""
+    with source:
+        while chunk := source.read(chunk_size):
+            yield chunk
+
+class _ArchiveSink(io.RawIOBase):
+    """Write-only, unseekable buffer that zipfile writes into and the stream drains."""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def pending(self):
+        return len(self._buffer)
+
+    def drain(self):
+        chunk = bytes(self._buffer)
+        self._buffer.clear()
+        return chunk
+
+def iter_pdf_archive(submission_eids, chunk_size: int = ARCHIVE_CHUNK_SIZE):
+    """
+    Yields a ZIP archive of the stored PDFs for `submission_eids` as it is built.
+    Because the sink is unseekable, zipfile writes data descriptors after each
+    entry instead of seeking back, and packed PDFs are read straight from their
+    pack, so nothing touches a temp file and at most about `chunk_size` bytes
+    are held at a time. Files missing from storage are listed in MISSING.txt at
+    the end of the archive.
+    """
+    sink = _ArchiveSink()
+    missing = []
+    with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for eid in submission_eids:
+            try:
+                source, size = open_pdf(eid)
+            except FileNotFoundError:
+                missing.append(eid)
+                continue
+            with source:
+                info = zipfile.ZipInfo(f"{eid}.pdf", date_time=time.localtime()[:6])
+                info.file_size = size
+                info.external_attr = 0o644 << 16
+                with archive.open(info, mode="w", force_zip64=True) as entry:
+                    while chunk := source.read(chunk_size):
+                        entry.write(chunk)
+                        if sink.pending() >= chunk_size:
+                            yield sink.drain()
+            yield sink.drain()
+        if missing:
+            archive.writestr("MISSING.txt", "\n".join(missing) + "\n")
+    yield sink.drain()
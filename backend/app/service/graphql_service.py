@@ -1,5 +1,7 @@
 import os, base64, requests
 
+from .. import profiling
+
 # --- Anvil GraphQL Configuration ---
 ANVIL_GRAPHQL_URL = "https://graphql.useanvil.com"
 ANVIL_API_KEY = os.getenv("ANVIL_API_KEY")
@@ -27,6 +29,7 @@ def get_auth_header(api_key: str) -> dict:
         "Content-Type": "application/json",
     }
 
+@profiling.traced("anvil.graphql")
 def execute_graql_query(query, variables):
     payload = {
         "query": query,
@@ -122,6 +125,42 @@ def create_cast(file_content, filename: str):
 
     return cast_data
 
+
+def duplicate_cast(eid: str, title: str):
+    """
+    Copies an existing cast, detected fields included, under a new eid and
+    publishes it. Returns None if Anvil did not return a copy.
+    """
+    query = """
+        mutation duplicateCast(
+        $eid: String!,
+        $title: String
+        ) {
+        duplicateCast(
+            eid: $eid,
+            title: $title
+        ) {
+            eid
+            title
+            fieldInfo
+        }
+    }
+    """
+
+    variables = {
+        "eid": eid,
+        "title": title
+    }
+    cast_data = execute_graql_query(query=query, variables=variables)
+
+    duplicate = (cast_data.get("data") or {}).get("duplicateCast")
+    if not duplicate or not duplicate.get("eid"):
+        return None
+
+    publish_cast(duplicate["eid"], duplicate.get("title") or title)
+
+    return duplicate
+
   
 def publish_cast(eid: str, title: str, description: str = ""):
     query = """
@@ -0,0 +1,98 @@
+import io, os, threading
+from functools import lru_cache
+
+from pypdf import PdfReader, PdfWriter
+from pypdf.annotations import FreeText
+
+# Number of parsed template PDFs kept in memory for previews.
+PDF_TEMPLATE_CACHE_SIZE = int(os.getenv("PDF_TEMPLATE_CACHE_SIZE", "32"))
+
+PREVIEW_FONT_SIZE = 10
+
+
+class ParsedTemplate:
+    """A template PDF parsed once and shared between preview requests."""
+
+    def __init__(self, path: str):
+        self.reader = PdfReader(path)
+        self.field_names = set((self.reader.get_fields() or {}).keys())
+        self.page_heights = [float(page.mediabox.height) for page in self.reader.pages]
+        # PdfReader reads lazily from a shared stream; serialise clones.
+        self.lock = threading.Lock()
+
+    def clone(self) -> PdfWriter:
+        with self.lock:
+            return PdfWriter(clone_from=self.reader)
+
+
+@lru_cache(maxsize=PDF_TEMPLATE_CACHE_SIZE)
+def _load_template(path: str, modified_at: float) -> ParsedTemplate:
+    # `modified_at` is part of the cache key so a replaced file is re-parsed.
+    return ParsedTemplate(path)
+
+
+def load_template(path: str) -> ParsedTemplate:
+    return _load_template(path, os.path.getmtime(path))
+
+
+def _as_text(value) -> str:
+    """Flattens Anvil's compound values (names, addresses, ...) into display text."""
+    if isinstance(value, dict):
+        return " ".join(_as_text(v) for v in value.values() if v not in (None, ""))
+    if isinstance(value, (list, tuple)):
+        return ", ".join(_as_text(v) for v in value)
+    if isinstance(value, bool):
+        return "X" if value else ""
+    return "" if value is None else str(value)
+
+
+def _overlay_rect(field: dict, page_height: float):
+    # Anvil rects are in PDF points measured from the top-left corner of the page;
+    # PDF user space starts at the bottom-left.
+    rect = field["rect"]
+    x, y, width, height = (float(rect[k]) for k in ("x", "y", "width", "height"))
+    bottom = page_height - y - height
+    return (x, bottom, x + width, bottom + height)
+
+
+def fill_pdf_locally(template_path: str, field_info: dict, data: dict) -> bytes:
+    """
+    Writes `data` (keyed by Anvil field id, as sent to anvil.fill_pdf) into a copy of
+    the template PDF. Fields that exist as AcroForm fields in the original (matched
+    by id, then by name) are filled natively; the rest are drawn as text annotations
+    at the rect Anvil detected. Meant for previews, not for the final document.
+    """
+    template = load_template(template_path)
+    writer = template.clone()
+    fields_by_id = {f.get("id"): f for f in (field_info or {}).get("fields", [])}
+
+    form_values = {}
+    for key, value in data.items():
+        field = fields_by_id.get(key, {})
+        text = _as_text(value)
+        if not text:
+            continue
+
+        acro_name = next((n for n in (key, field.get("name")) if n in template.field_names), None)
+        if acro_name:
+            form_values[acro_name] = text
+            continue
+
+        page_number = field.get("pageNum")
+        if field.get("rect") and page_number is not None and 0 <= page_number < len(template.page_heights):
+            annotation = FreeText(
+                text=text,
+                rect=_overlay_rect(field, template.page_heights[page_number]),
+                font_size=f"{PREVIEW_FONT_SIZE}pt",
+                border_color=None,
+                background_color=None,
+            )
+            writer.add_annotation(page_number=page_number, annotation=annotation)
+
+    if form_values:
+        writer.update_page_form_field_values(None, form_values, auto_regenerate=False)
+        writer.set_need_appearances_writer(True)
+
+    output = io.BytesIO()
+    writer.write(output)
+    return output.getvalue()
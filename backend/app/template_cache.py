@@ -0,0 +1,192 @@
+"""
+In-process cache of template metadata for the per-request lookups by eid or id.
+
+Entries are immutable snapshots (CachedTemplate), not ORM objects, so they can
+be shared between requests and sessions; write through crud with the template
+id. Every write to `templates` bumps the "templates" row of `cache_versions` in
+the same transaction. A worker applies its own writes to the cache directly and,
+at most every TEMPLATE_CACHE_CHECK_SECONDS, compares the counter with the
+version its cache reflects, dropping everything when another worker has written.
+"""
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from . import config, models
+
+VERSION_NAME = "templates"
+
+
+@dataclass(frozen=True)
+class CachedTemplate:
+    id: int
+    title: str
+    owner_id: int
+    anvil_template_eid: str
+    field_info: Optional[dict]
+    content_hash: Optional[str]
+    created_at: Optional[datetime]
+    updated_at: Optional[datetime]
+
+    @classmethod
+    def from_model(cls, template: models.PDFTemplate) -> "CachedTemplate":
+        return cls(
+            id=template.id,
+            title=template.title,
+            owner_id=template.owner_id,
+            anvil_template_eid=template.anvil_template_eid,
+            field_info=template.field_info,
+            content_hash=template.content_hash,
+            created_at=template.created_at,
+            updated_at=template.updated_at,
+        )
+
+
+def version_query():
+    return select(models.CacheVersion.version).where(models.CacheVersion.name == VERSION_NAME)
+
+
+class TemplateCache:
+    def __init__(self, max_size: int, check_interval: float):
+        self.max_size = max_size
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._by_eid: "OrderedDict[str, CachedTemplate]" = OrderedDict()
+        self._eid_by_id = {}
+        self.version: Optional[int] = None
+        self._checked_at = float("-inf")
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    # --- Consistency ---
+
+    def _check_due(self) -> bool:
+        return time.monotonic() - self._checked_at >= self.check_interval
+
+    def _observe_version(self, version: Optional[int]):
+        version = version or 0
+        with self._lock:
+            self._checked_at = time.monotonic()
+            if version != self.version:
+                if self._by_eid:
+                    self.invalidations += 1
+                self._by_eid.clear()
+                self._eid_by_id.clear()
+                self.version = version
+
+    def sync(self, db: Session):
+        if self._check_due():
+            self._observe_version(db.scalar(version_query()))
+
+    async def sync_async(self, db: AsyncSession):
+        if self._check_due():
+            self._observe_version(await db.scalar(version_query()))
+
+    # --- Entries ---
+
+    def _lookup(self, eid: Optional[str]) -> Optional[CachedTemplate]:
+        with self._lock:
+            template = self._by_eid.get(eid)
+            if template is None:
+                self.misses += 1
+                return None
+            self._by_eid.move_to_end(eid)
+            self.hits += 1
+            return template
+
+    def _store(self, template: CachedTemplate):
+        # Called with the lock held.
+        self._by_eid[template.anvil_template_eid] = template
+        self._by_eid.move_to_end(template.anvil_template_eid)
+        self._eid_by_id[template.id] = template.anvil_template_eid
+        while len(self._by_eid) > self.max_size:
+            _, evicted = self._by_eid.popitem(last=False)
+            self._eid_by_id.pop(evicted.id, None)
+            self.evictions += 1
+
+    def _fill(self, template: Optional[models.PDFTemplate]) -> Optional[CachedTemplate]:
+        if template is None:
+            return None
+        cached = CachedTemplate.from_model(template)
+        with self._lock:
+            self._store(cached)
+        return cached
+
+    def put(self, template: models.PDFTemplate, version: int):
+        """Write-through from crud after committing `template` as change `version`."""
+        cached = CachedTemplate.from_model(template)
+        with self._lock:
+            # At `version` the row is current; one step ahead means no other write came in between.
+            if self.version is not None and version in (self.version, self.version + 1):
+                self._store(cached)
+                self.version = version
+            else:
+                # Another worker wrote in between; let the next check start over.
+                self._checked_at = float("-inf")
+
+    def get_by_eid(self, db: Session, anvil_template_eid: str) -> Optional[CachedTemplate]:
+        self.sync(db)
+        cached = self._lookup(anvil_template_eid)
+        if cached is not None:
+            return cached
+        stmt = select(models.PDFTemplate).where(models.PDFTemplate.anvil_template_eid == anvil_template_eid).limit(1)
+        return self._fill(db.scalar(stmt))
+
+    async def get_by_eid_async(self, db: AsyncSession, anvil_template_eid: str) -> Optional[CachedTemplate]:
+        await self.sync_async(db)
+        cached = self._lookup(anvil_template_eid)
+        if cached is not None:
+            return cached
+        stmt = select(models.PDFTemplate).where(models.PDFTemplate.anvil_template_eid == anvil_template_eid).limit(1)
+        return self._fill(await db.scalar(stmt))
+
+    def get_by_id(self, db: Session, template_id: int) -> Optional[CachedTemplate]:
+        self.sync(db)
+        cached = self._lookup(self._eid_by_id.get(template_id))
+        if cached is not None:
+            return cached
+        return self._fill(db.get(models.PDFTemplate, template_id))
+
+    def warm(self, db: Session):
+        """Loads the most recent templates, up to the cache size."""
+        version = db.scalar(version_query()) or 0
+        stmt = select(models.PDFTemplate).order_by(models.PDFTemplate.id.desc()).limit(self.max_size)
+        templates = [CachedTemplate.from_model(t) for t in db.scalars(stmt)]
+        with self._lock:
+            self._by_eid.clear()
+            self._eid_by_id.clear()
+            for template in reversed(templates):
+                self._store(template)
+            self.version = version
+            self._checked_at = time.monotonic()
+
+    def clear(self):
+        with self._lock:
+            self._by_eid.clear()
+            self._eid_by_id.clear()
+            self.version = None
+            self._checked_at = float("-inf")
+            self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._by_eid),
+                "max_size": self.max_size,
+                "version": self.version,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+templates = TemplateCache(config.TEMPLATE_CACHE_SIZE, config.TEMPLATE_CACHE_CHECK_SECONDS)
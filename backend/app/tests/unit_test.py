@@ -1,10 +1,17 @@
+import asyncio
+from datetime import date, datetime, timedelta, timezone
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event as sa_event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import StaticPool
+from sqlalchemy.pool import NullPool
 from unittest.mock import patch, Mock
+from pypdf import PdfReader, PdfWriter
 import io
+import json
+import tempfile
+import zipfile
 
 # --- FIX START: Robust Path Correction ---
 # This ensures that the 'backend' directory (the project root containing 'app')
@@ -16,23 +23,33 @@ PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..
 sys.path.insert(0, PROJECT_ROOT)
 # --- FIX END ---
 
+# Minimum-cost password hashing; every test seeds users.
+os.environ.setdefault("PASSWORD_HASH_PROFILE", "test")
+os.environ.setdefault("DOWNLOAD_URL_SECRET", "unit-test-download-secret")
+
 from app.main import app
-from app.database import Base
-from app.deps import get_db
-from app import models, security, crud, schemas
+from app.database import Base, create_tables
+from app.deps import get_db, get_async_db
+from app import admission, async_crud, config, events, models, partitions, profiling, retention, security, crud, schemas, search, template_cache
+from app.service import file_service
+from app.service.export_service import iter_submission_export
 
 # --- Test Database Setup ---
-SQLALCHEMY_DATABASE_URL = "sqlite:///:memory:"
+# A throwaway SQLite file rather than :memory:, so the sync engine and the async
+# (aiosqlite) engine used by the async endpoints see the same data.
+TEST_DB_PATH = os.path.join(tempfile.mkdtemp(), "unit_test.db")
+SQLALCHEMY_DATABASE_URL = f"sqlite:///{TEST_DB_PATH}"
 
-# --- FIX START: Use StaticPool for in-memory DB ---
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL,
     connect_args={"check_same_thread": False},
-    poolclass=StaticPool, # This ensures the same connection is used across the test
 )
-# --- FIX END ---
+# NullPool: TestClient runs every request on a fresh event loop, so async
+# connections must not be pooled across requests.
+async_engine = create_async_engine(f"sqlite+aiosqlite:///{TEST_DB_PATH}", poolclass=NullPool)
 
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+TestingAsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 
 # Apply the dependency override to the app instance
 def override_get_db():
@@ -43,6 +60,11 @@ def override_get_db():
         db.close()
 app.dependency_overrides[get_db] = override_get_db
 
+async def override_get_async_db():
+    async with TestingAsyncSessionLocal() as db:
+        yield db
+app.dependency_overrides[get_async_db] = override_get_async_db
+
 client = TestClient(app)
 
 # --- Test Fixtures ---
@@ -52,6 +74,8 @@ def db_session():
     Creates a new, clean database session with seeded users for each test function.
     """
     Base.metadata.create_all(bind=engine)  # Create tables
+    admission.bucket_backend.reset()
+    template_cache.templates.clear()
     db = TestingSessionLocal()
     try:
         # Manually seed the database for test isolation
@@ -112,6 +136,27 @@ def submission_fixture(db_session, template_fixture, buyer_user):
 # ===      TESTS START HERE      ===
 # ==================================
 
+class TestSchemaUpgrade:
+    def test_columns_added_since_a_table_was_created(self, tmp_path):
+        old_engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+        with old_engine.begin() as connection:
+            connection.exec_driver_sql(
+                "CREATE TABLE templates (id INTEGER PRIMARY KEY, title VARCHAR, owner_id INTEGER, "
+                "anvil_template_eid VARCHAR UNIQUE, created_at DATETIME, updated_at DATETIME)"
+            )
+            connection.exec_driver_sql("INSERT INTO templates (title, owner_id, anvil_template_eid) VALUES ('old', 1, 'old_eid')")
+        create_tables(old_engine)
+        create_tables(old_engine)  # A second run finds nothing to add.
+
+        db = sessionmaker(bind=old_engine)()
+        try:
+            template = crud.get_template(db, "old_eid")
+            assert (template.title, template.field_info, template.content_hash) == ("old", None, None)
+        finally:
+            db.close()
+            old_engine.dispose()
+
+
 class TestAuthentication:
     def test_login_for_access_token_success(self, test_client, db_session):
         response = test_client.post("/api/token", data={"username": "admin@test.io", "password": "password123"})
@@ -145,7 +190,12 @@ class TestAuthentication:
 class TestAgentFlow:
     @patch('app.main.create_cast')
     def test_upload_template_success(self, mock_create_cast, test_client, agent_user):
-        mock_create_cast.return_value = {"data": {"createCast": {"eid": "mockCastEid123"}}}
+        def create_cast(**kwargs):
+            # Anvil is called from the threadpool, never on the event loop.
+            with pytest.raises(RuntimeError):
+                asyncio.get_running_loop()
+            return {"data": {"createCast": {"eid": "mockCastEid123"}}}
+        mock_create_cast.side_effect = create_cast
         token = security.create_access_token(data={"sub": agent_user.email, "role": agent_user.role})
         
         # Create a BytesIO object with PDF-like content
@@ -192,6 +242,65 @@ class TestAgentFlow:
         assert len(response.json()) == 0
 
 
+
+class TestTemplateDeduplication:
+    PDF = b"%PDF-1.4\n%SAME BYTES"
+    CAST = {"data": {"createCast": {"eid": "castEid1", "fieldInfo": {"fields": [{"id": "f1"}]}}}}
+
+    def _upload(self, user, params=None, filename="same.pdf"):
+        token = security.create_access_token(data={"sub": user.email, "role": user.role})
+        return client.post(
+            "/api/templates",
+            params=params,
+            headers={"Authorization": f"Bearer {token}"},
+            files={"file": (filename, io.BytesIO(self.PDF), "application/pdf")},
+        )
+
+    @patch('app.main.create_cast')
+    def test_reupload_by_owner_returns_existing_template(self, mock_create_cast, test_client, agent_user):
+        mock_create_cast.return_value = self.CAST
+        first = self._upload(agent_user)
+        second = self._upload(agent_user)
+        assert first.status_code == 201
+        assert second.status_code == 200
+        assert second.json()["id"] == first.json()["id"]
+        mock_create_cast.assert_called_once()
+
+    @patch('app.main.create_cast')
+    def test_force_detection_creates_new_cast(self, mock_create_cast, test_client, agent_user):
+        mock_create_cast.side_effect = [self.CAST, {"data": {"createCast": {"eid": "castEid2"}}}]
+        self._upload(agent_user)
+        response = self._upload(agent_user, params={"force_detection": True})
+        assert response.status_code == 201
+        assert response.json()["anvil_template_eid"] == "castEid2"
+        assert mock_create_cast.call_count == 2
+
+    @patch('app.main.duplicate_cast')
+    @patch('app.main.create_cast')
+    def test_other_agent_reuses_detected_fields(self, mock_create_cast, mock_duplicate_cast, test_client, db_session, agent_user):
+        mock_create_cast.return_value = self.CAST
+        mock_duplicate_cast.return_value = {"eid": "copiedEid", "title": "mine.pdf"}
+        self._upload(agent_user)
+        other_agent = crud.create_user(db_session, schemas.UserCreate(email="agent2@test.io", role="Agent", password="password123"))
+
+        response = self._upload(other_agent, filename="mine.pdf")
+        assert response.status_code == 201
+        assert response.json()["anvil_template_eid"] == "copiedEid"
+        mock_create_cast.assert_called_once()
+        mock_duplicate_cast.assert_called_once_with("castEid1", "mine.pdf")
+        copied = crud.get_template(db_session, "copiedEid")
+        assert copied.owner_id == other_agent.id
+        assert copied.field_info == {"fields": [{"id": "f1"}]}
+
+    @patch('app.main.duplicate_cast', return_value=None)
+    @patch('app.main.create_cast')
+    def test_failed_copy_falls_back_to_detection(self, mock_create_cast, _, test_client, db_session, agent_user):
+        mock_create_cast.side_effect = [self.CAST, {"data": {"createCast": {"eid": "castEid2"}}}]
+        self._upload(agent_user)
+        other_agent = crud.create_user(db_session, schemas.UserCreate(email="agent2@test.io", role="Agent", password="password123"))
+        response = self._upload(other_agent)
+        assert response.json()["anvil_template_eid"] == "castEid2"
+
 class TestBuyerFlow:
     @patch('app.main.get_cast')
     def test_get_template_form_fields(self, mock_get_cast, test_client, buyer_user, template_fixture):
@@ -245,7 +354,9 @@ class TestBuyerFlow:
 
 
 class TestAdminAndDownloadFlow:
-    def test_get_admin_dashboard(self, test_client, admin_user, template_fixture, submission_fixture):
+    def test_get_admin_dashboard(self, test_client, db_session, admin_user, template_fixture, submission_fixture):
+        # The fixture inserts the submission directly, so backfill the rollups the dashboard reads.
+        crud.rebuild_submission_rollups(db_session)
         token = security.create_access_token(data={"sub": admin_user.email, "role": admin_user.role})
         response = test_client.get("/api/dashboard", headers={"Authorization": f"Bearer {token}"})
         assert response.status_code == 200
@@ -254,6 +365,30 @@ class TestAdminAndDownloadFlow:
         assert response.json()[0]["template"]["title"] == "test_template.pdf"
         assert response.json()[0]["latest_submission"]["anvil_submission_eid"] == "test_submission_eid"
 
+    def test_dashboard_is_one_query_over_the_rollups(self, test_client, db_session, admin_user, agent_user, buyer_user):
+        for i in range(5):
+            crud.create_template(db_session, f"dash_{i}.pdf", agent_user.id, f"dash_{i}")
+            crud.create_submission(db_session, f"dash_{i}", buyer_user.id, f"dash_sub_{i}_a", "url")
+            crud.create_submission(db_session, f"dash_{i}", buyer_user.id, f"dash_sub_{i}_b", "url")
+        crud.create_template(db_session, "dash_empty.pdf", agent_user.id, "dash_empty")
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            if "count(" not in statement and ("FROM templates" in statement or "FROM submissions" in statement):
+                statements.append(statement)
+
+        sa_event.listen(engine, "before_cursor_execute", record)
+        try:
+            token = security.create_access_token(data={"sub": admin_user.email, "role": admin_user.role})
+            response = test_client.get("/api/dashboard", headers={"Authorization": f"Bearer {token}"})
+        finally:
+            sa_event.remove(engine, "before_cursor_execute", record)
+        latest = {row["template"]["anvil_template_eid"]: row["latest_submission"] for row in response.json()}
+        assert latest["dash_3"]["anvil_submission_eid"] == "dash_sub_3_b"
+        assert latest["dash_empty"] is None
+        assert response.json()[0]["owner"]["email"] == agent_user.email
+        assert len(statements) == 1
+
     def test_get_admin_dashboard_unauthorized(self, test_client, buyer_user):
         token = security.create_access_token(data={"sub": buyer_user.email, "role": buyer_user.role})
         response = test_client.get("/api/dashboard", headers={"Authorization": f"Bearer {token}"})
@@ -318,3 +453,1087 @@ class TestAdminAndDownloadFlow:
         )
         assert response.status_code == 404
         assert response.json()["detail"] == "Submission not found"
+
+
+class TestHttpCaching:
+    def test_available_templates_not_modified(self, test_client, buyer_user, agent_user, db_session):
+        crud.create_template(db_session, "template1.pdf", agent_user.id, "eid1")
+        token = security.create_access_token(data={"sub": buyer_user.email, "role": buyer_user.role})
+        headers = {"Authorization": f"Bearer {token}"}
+        response = test_client.get("/api/templates/available", headers=headers)
+        assert response.status_code == 200
+        etag = response.headers["etag"]
+        assert response.headers["cache-control"] == "private, no-cache"
+        assert "last-modified" in response.headers
+
+        response = test_client.get("/api/templates/available", headers={**headers, "If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.content == b""
+
+        # A new template changes the collection stamp, so the old ETag no longer matches.
+        crud.create_template(db_session, "template2.pdf", agent_user.id, "eid2")
+        response = test_client.get("/api/templates/available", headers={**headers, "If-None-Match": etag})
+        assert response.status_code == 200
+        assert len(response.json()) == 2
+        assert response.headers["etag"] != etag
+
+    def test_agent_etag_is_scoped_to_user(self, test_client, agent_user, admin_user, db_session):
+        agent_token = security.create_access_token(data={"sub": agent_user.email, "role": agent_user.role})
+        response = test_client.get("/api/templates", headers={"Authorization": f"Bearer {agent_token}"})
+        admin_token = security.create_access_token(data={"sub": admin_user.email, "role": admin_user.role})
+        dashboard = test_client.get("/api/dashboard", headers={"Authorization": f"Bearer {admin_token}"})
+        assert response.headers["etag"] != dashboard.headers["etag"]
+
+        response = test_client.get(
+            "/api/dashboard",
+            headers={"Authorization": f"Bearer {admin_token}", "If-None-Match": dashboard.headers["etag"]},
+        )
+        assert response.status_code == 304
+
+    def test_large_responses_are_compressed(self, test_client, buyer_user, agent_user, db_session):
+        for i in range(50):
+            crud.create_template(db_session, f"template_{i}.pdf", agent_user.id, f"eid_{i}")
+        token = security.create_access_token(data={"sub": buyer_user.email, "role": buyer_user.role})
+        response = test_client.get(
+            "/api/templates/available",
+            headers={"Authorization": f"Bearer {token}", "Accept-Encoding": "gzip"},
+        )
+        assert response.status_code == 200
+        assert response.headers["content-encoding"] == "gzip"
+        assert len(response.json()) == 50
+
+    def test_pdfs_are_not_recompressed(self, test_client, admin_user, submission_fixture):
+        eid = submission_fixture.anvil_submission_eid
+        file_service.upload_pdf(f"{eid}.pdf", b"%PDF " * 2000)
+        try:
+            token = security.create_access_token(data={"sub": admin_user.email, "role": admin_user.role})
+            response = test_client.get(
+                f"/api/submissions/{eid}/download", headers={"Authorization": f"Bearer {token}", "Accept-Encoding": "gzip"}
+            )
+            assert response.status_code == 200
+            assert response.headers["content-encoding"] == "identity"
+            assert response.content == b"%PDF " * 2000
+        finally:
+            os.remove(file_service.get_pdf_path(eid))
+
+    def test_template_lists_leave_out_field_info(self, test_client, db_session, agent_user, admin_user, template_fixture):
+        crud.update_template_field_info(db_session, template_fixture, {"fields": [{"id": "f"}] * 100})
+        token = security.create_access_token(data={"sub": agent_user.email, "role": agent_user.role})
+        templates = test_client.get("/api/templates", headers={"Authorization": f"Bearer {token}"}).json()
+        assert templates[0]["anvil_template_eid"] == template_fixture.anvil_template_eid
+        assert "field_info" not in templates[0]
+
+        token = security.create_access_token(data={"sub": admin_user.email, "role": admin_user.role})
+        dashboard = test_client.get("/api/dashboard", headers={"Authorization": f"Bearer {token}"}).json()
+        assert "field_info" not in dashboard[0]["template"]
+        assert "hashed_password" not in dashboard[0]["owner"]
+
+
+class TestSubmissionAnalytics:
+    def test_create_submission_updates_rollups(self, db_session, template_fixture, buyer_user):
+        first = crud.create_submission(db_session, template_fixture.anvil_template_eid, buyer_user.id, "eid_a", "url")
+        second = crud.create_submission(db_session, template_fixture.anvil_template_eid, buyer_user.id, "eid_b", "url")
+
+        template_stats = db_session.get(models.TemplateSubmissionStats, template_fixture.anvil_template_eid)
+        assert template_stats.total == 2
+        assert template_stats.last_submission_id == second.id
+        buyer_stats = db_session.get(models.BuyerSubmissionStats, buyer_user.id)
+        assert buyer_stats.total == 2
+        daily = db_session.query(models.DailySubmissionCount).all()
+        assert len(daily) == 1
+        assert daily[0].total == 2
+        assert first.id < second.id
+
+    def test_incremental_rollups_match_rebuild(self, db_session, template_fixture, buyer_user):
+        eid = template_fixture.anvil_template_eid
+        crud.bulk_create_submissions(db_session, [
+            {"template_id": eid, "buyer_id": buyer_user.id, "anvil_submission_eid": "late", "created_at": datetime(2024, 3, 1, 23, 59)},
+            {"template_id": eid, "buyer_id": buyer_user.id, "anvil_submission_eid": "early", "created_at": datetime(2024, 3, 2, 0, 1)},
+        ])
+        # A stale id never moves last_submission_id backwards.
+        crud._increment_rollup(db_session, models.TemplateSubmissionStats, {"template_id": eid}, last_submission_id=1)
+        db_session.commit()
+
+        def snapshot():
+            db_session.expire_all()
+            daily = {(d.day, d.total) for d in db_session.query(models.DailySubmissionCount)}
+            return daily, db_session.get(models.TemplateSubmissionStats, eid).last_submission_id
+
+        incremental = snapshot()
+        crud.rebuild_submission_rollups(db_session)
+        assert incremental == snapshot()
+        assert incremental == ({(date(2024, 3, 1), 1), (date(2024, 3, 2), 1)}, crud.get_submission_by_id(db_session, "early").id)
+
+    def test_rebuild_rollups_backfills_existing_rows(self, db_session, submission_fixture, buyer_user):
+        # submission_fixture inserts directly, bypassing crud, so nothing is rolled up yet.
+        assert db_session.query(models.TemplateSubmissionStats).count() == 0
+        crud.rebuild_submission_rollups(db_session)
+        stats = db_session.get(models.TemplateSubmissionStats, submission_fixture.template_id)
+        assert stats.total == 1
+        assert stats.last_submission_id == submission_fixture.id
+        assert db_session.get(models.BuyerSubmissionStats, buyer_user.id).total == 1
+        assert db_session.query(models.DailySubmissionCount).one().total == 1
+
+    def test_analytics_endpoint(self, test_client, db_session, admin_user, buyer_user, agent_user, template_fixture):
+        crud.create_template(db_session, "unused.pdf", agent_user.id, "unused_eid")
+        crud.create_submission(db_session, template_fixture.anvil_template_eid, buyer_user.id, "eid_a", "url")
+        token = security.create_access_token(data={"sub": admin_user.email, "role": admin_user.role})
+        response = test_client.get("/api/dashboard/analytics", headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 200
+        body = response.json()
+        by_template = {t["template_id"]: t for t in body["templates"]}
+        assert by_template[template_fixture.anvil_template_eid]["total"] == 1
+        assert len(by_template[template_fixture.anvil_template_eid]["daily"]) == 1
+        assert by_template["unused_eid"]["total"] == 0
+        assert body["buyers"][0]["email"] == buyer_user.email
+
+
+class TestSearch:
+    def test_search_templates_by_prefix(self, test_client, db_session, buyer_user, agent_user):
+        crud.create_template(db_session, "Purchase Agreement.pdf", agent_user.id, "eid_purchase")
+        crud.create_template(db_session, "Lease.pdf", agent_user.id, "eid_lease")
+        token = security.create_access_token(data={"sub": buyer_user.email, "role": buyer_user.role})
+        response = test_client.get("/api/search", params={"q": "purch agr"}, headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert [r["ref"] for r in results] == ["eid_purchase"]
+        assert results[0]["owner_email"] == agent_user.email
+
+    def test_search_is_scoped_by_role(self, test_client, db_session, template_fixture, buyer_user, admin_user):
+        crud.create_submission(db_session, template_fixture.anvil_template_eid, buyer_user.id, "sub_eid_1", "url")
+        other_buyer = crud.create_user(db_session, schemas.UserCreate(email="other@test.io", role="Buyer", password="pw"))
+
+        admin_token = security.create_access_token(data={"sub": admin_user.email, "role": admin_user.role})
+        response = test_client.get(
+            "/api/search", params={"q": "buyer", "kind": "submission"}, headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert [r["ref"] for r in response.json()["results"]] == ["sub_eid_1"]
+
+        other_token = security.create_access_token(data={"sub": other_buyer.email, "role": other_buyer.role})
+        response = test_client.get(
+            "/api/search", params={"q": "sub_eid"}, headers={"Authorization": f"Bearer {other_token}"}
+        )
+        assert response.json()["results"] == []
+
+    def test_scores_rank_higher_is_better(self, db_session, agent_user, admin_user):
+        crud.create_template(db_session, "lease lease lease.pdf", agent_user.id, "eid_lease_3")
+        crud.create_template(db_session, "lease deed deed deed deed.pdf", agent_user.id, "eid_lease_1")
+        rows, _ = search.search(db_session, "lease", admin_user, kind="template")
+        assert [r["ref"] for r in rows] == ["eid_lease_3", "eid_lease_1"]
+        assert rows[0]["score"] > rows[1]["score"]
+
+    def test_like_fallback_without_a_search_index(self, db_session, template_fixture, buyer_user, admin_user, monkeypatch):
+        crud.create_submission(db_session, template_fixture.anvil_template_eid, buyer_user.id, "sub_eid_1", "url")
+        monkeypatch.setattr(search, "_dialect", lambda db: "mysql")
+        rows, has_more = search.search(db_session, "test templ", admin_user)
+        assert [(r["kind"], r["ref"], r["score"]) for r in rows] == [
+            ("submission", "sub_eid_1", 0), ("template", template_fixture.anvil_template_eid, 0),
+        ]
+        rows, _ = search.search(db_session, "sub_eid", buyer_user, kind="submission")
+        assert [r["ref"] for r in rows] == ["sub_eid_1"]
+
+    def test_search_pagination_and_rebuild(self, db_session, agent_user, admin_user):
+        for i in range(3):
+            crud.create_template(db_session, f"report {i}.pdf", agent_user.id, f"eid_report_{i}")
+        search.rebuild_search_index(db_session)
+        page, has_more = search.search(db_session, "report", admin_user, limit=2)
+        assert len(page) == 2
+        assert has_more
+        page, has_more = search.search(db_session, "report", admin_user, limit=2, offset=2)
+        assert len(page) == 1
+        assert not has_more
+
+
+class TestSubmissionExport:
+    def test_export_csv(self, test_client, admin_user, submission_fixture):
+        token = security.create_access_token(data={"sub": admin_user.email, "role": admin_user.role})
+        response = test_client.get("/api/admin/exports/submissions", headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/csv")
+        lines = response.text.strip().splitlines()
+        assert lines[0].startswith("submission_id,submission_eid")
+        assert len(lines) == 2
+        assert "test_submission_eid" in lines[1]
+        assert "agent@test.io" in lines[1]
+
+    def test_export_ndjson_with_filters(self, test_client, admin_user, db_session, template_fixture, buyer_user):
+        for i in range(5):
+            crud.create_submission(db_session, template_fixture.anvil_template_eid, buyer_user.id, f"eid_{i}", "url")
+        token = security.create_access_token(data={"sub": admin_user.email, "role": admin_user.role})
+        response = test_client.get(
+            "/api/admin/exports/submissions",
+            params={"format": "ndjson", "template_id": template_fixture.anvil_template_eid},
+            headers={"Authorization": f"Bearer {token}"},
+        )
+        rows = [json.loads(line) for line in response.text.splitlines()]
+        assert [r["submission_eid"] for r in rows] == [f"eid_{i}" for i in range(5)]
+        assert rows[0]["buyer_email"] == buyer_user.email
+
+        response = test_client.get(
+            "/api/admin/exports/submissions",
+            params={"format": "ndjson", "template_id": "other"},
+            headers={"Authorization": f"Bearer {token}"},
+        )
+        assert response.text == ""
+
+    def test_export_batches_rows(self, db_session, template_fixture, buyer_user):
+        for i in range(5):
+            crud.create_submission(db_session, template_fixture.anvil_template_eid, buyer_user.id, f"eid_{i}", "url")
+        factory = sessionmaker(bind=db_session.get_bind())
+        chunks = list(iter_submission_export(factory, "csv", batch_size=2))
+        assert len(chunks) == 3
+        assert sum(chunk.count(b"\n") for chunk in chunks) == 6
+
+    def test_export_admin_only(self, test_client, buyer_user):
+        token = security.create_access_token(data={"sub": buyer_user.email, "role": buyer_user.role})
+        response = test_client.get("/api/admin/exports/submissions", headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 403
+
+
+class TestSubmissionArchive:
+    def _get_archive(self, user, **params):
+        token = security.create_access_token(data={"sub": user.email, "role": user.role})
+        return client.get("/api/submissions/archive", params=params, headers={"Authorization": f"Bearer {token}"})
+
+    def test_archive_streams_authorised_pdfs(self, test_client, db_session, template_fixture, buyer_user, admin_user):
+        crud.create_submission(db_session, template_fixture.anvil_template_eid, buyer_user.id, "archive_a", "url")
+        crud.create_submission(db_session, template_fixture.anvil_template_eid, buyer_user.id, "archive_b", "url")
+        file_service.upload_pdf("archive_a.pdf", b"%PDF a" * 50000)
+        try:
+            response = self._get_archive(admin_user)
+            assert response.status_code == 200
+            assert response.headers["content-type"] == "application/zip"
+            with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
+                assert archive.namelist() == ["archive_a.pdf", "MISSING.txt"]
+                assert archive.read("archive_a.pdf") == b"%PDF a" * 50000
+                assert archive.read("MISSING.txt") == b"archive_b\n"
+        finally:
+            os.remove(file_service.get_pdf_path("archive_a"))
+
+    def test_archive_only_includes_accessible_submissions(self, test_client, db_session, template_fixture, buyer_user):
+        crud.create_submission(db_session, template_fixture.anvil_template_eid, buyer_user.id, "mine", "url")
+        other_buyer = crud.create_user(db_session, schemas.UserCreate(email="other@test.io", role="Buyer", password="pw"))
+        crud.create_submission(db_session, template_fixture.anvil_template_eid, other_buyer.id, "theirs", "url")
+
+        assert crud.get_downloadable_submission_eids(db_session, buyer_user) == ["mine"]
+        response = self._get_archive(other_buyer, template_id="missing_template")
+        assert response.status_code == 404
+
+
+class TestAsyncCrud:
+    def test_async_crud_matches_sync(self, db_session, template_fixture, buyer_user):
+        async def scenario():
+            async with TestingAsyncSessionLocal() as db:
+                submission = await async_crud.create_submission(
+                    db, template_fixture.anvil_template_eid, buyer_user.id, "async_eid", "url"
+                )
+                latest = await async_crud.get_latest_submission(db, template_fixture.anvil_template_eid)
+                by_user = await async_crud.get_submissions_by_user(db, buyer_user.id)
+                stamp = await async_crud.get_collection_stamp(db, models.Submission)
+                return submission, latest, by_user, stamp
+
+        submission, latest, by_user, stamp = asyncio.run(scenario())
+        assert latest.id == submission.id
+        assert [s.anvil_submission_eid for s in by_user] == ["async_eid"]
+        assert by_user[0].template.title == template_fixture.title
+        assert stamp == crud.get_collection_stamp(db_session, models.Submission)
+        # Writes go through the sync implementation, so rollups are maintained too.
+        assert db_session.get(models.TemplateSubmissionStats, template_fixture.anvil_template_eid).total == 1
+
+    def test_async_draft_functions(self, db_session, template_fixture, buyer_user):
+        async def scenario():
+            async with TestingAsyncSessionLocal() as db:
+                draft = await async_crud.get_or_create_draft(db, buyer_user.id, template_fixture.anvil_template_eid)
+                assert await async_crud.append_draft_delta(db, draft, {"name": "Ada", "age": 3}) == 1
+                assert await async_crud.append_draft_delta(db, draft, {"age": None}, expected_version=1) == 2
+                assert await async_crud.append_draft_delta(db, draft, {"age": 4}, expected_version=1) is None
+                found = await async_crud.get_draft(db, buyer_user.id, template_fixture.anvil_template_eid)
+                data = await async_crud.materialize_draft(db, found)
+                await async_crud.delete_draft(db, found)
+                return draft.id, data, await async_crud.get_draft_by_id(db, draft.id)
+
+        draft_id, data, deleted = asyncio.run(scenario())
+        assert data == {"name": "Ada"}
+        assert deleted is None
+
+
+class TestCrudFastPaths:
+    def test_bulk_create_matches_per_row_path(self, db_session, agent_user, buyer_user, admin_user):
+        templates = crud.bulk_create_templates(db_session, [
+            {"title": "Bulk Lease.pdf", "owner_id": agent_user.id, "anvil_template_eid": "bulk_a"},
+            {"title": "Bulk Deed.pdf", "owner_id": agent_user.id, "anvil_template_eid": "bulk_b"},
+        ])
+        submissions = crud.bulk_create_submissions(db_session, [
+            {"template_id": "bulk_a", "buyer_id": buyer_user.id, "anvil_submission_eid": f"bulk_sub_{n}"} for n in range(3)
+        ] + [{"template_id": "bulk_b", "buyer_id": buyer_user.id, "anvil_submission_eid": "bulk_sub_3", "filled_pdf_url": "url"}])
+
+        assert [t.anvil_template_eid for t in templates] == ["bulk_a", "bulk_b"]
+        assert all(s.created_at is not None for s in submissions)
+        stats = db_session.get(models.TemplateSubmissionStats, "bulk_a")
+        assert (stats.total, stats.last_submission_id) == (3, submissions[2].id)
+        assert db_session.get(models.BuyerSubmissionStats, buyer_user.id).total == 4
+        assert sum(d.total for d in db_session.query(models.DailySubmissionCount)) == 4
+        assert template_cache.templates.get_by_eid(db_session, "bulk_b").title == "Bulk Deed.pdf"
+
+        rows, _ = search.search(db_session, "bulk", admin_user, limit=10)
+        assert {r["ref"] for r in rows} == {"bulk_a", "bulk_b", "bulk_sub_0", "bulk_sub_1", "bulk_sub_2", "bulk_sub_3"}
+        published = list(events.bus._history)[-6:]
+        assert [e.type for e in published] == ["template.created"] * 2 + ["submission.created"] * 4
+        assert published[-1].owner_id == agent_user.id
+
+    def test_creates_do_not_reselect_the_new_row(self, db_session, template_fixture, buyer_user):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(" ".join(statement.split()))
+
+        sa_event.listen(engine, "before_cursor_execute", record)
+        try:
+            submission = crud.create_submission(db_session, template_fixture.anvil_template_eid, buyer_user.id, "fast_eid", "url")
+            assert (submission.anvil_submission_eid, submission.created_at is not None) == ("fast_eid", True)
+            user = crud.create_user(db_session, schemas.UserCreate(email="fast@test.io", role="Buyer", password="pw"))
+            assert (user.email, user.role) == ("fast@test.io", "Buyer")
+        finally:
+            sa_event.remove(engine, "before_cursor_execute", record)
+        assert not [s for s in statements if s.startswith("SELECT") and ("FROM submissions" in s or "FROM users WHERE users.id" in s)]
+
+
+class TestLocalPreview:
+    FIELD_INFO = {"fields": [{"id": "name1", "name": "Name", "type": "shortText", "pageNum": 0,
+                              "rect": {"x": 50, "y": 100, "width": 200, "height": 20}}]}
+
+    def _store_blank_template(self, eid):
+        writer = PdfWriter()
+        writer.add_blank_page(width=612, height=792)
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        return file_service.upload_template_pdf(eid, buffer.getvalue())
+
+    def test_preview_fills_locally(self, test_client, db_session, buyer_user, agent_user):
+        crud.create_template(db_session, "preview.pdf", agent_user.id, "preview_eid", field_info=self.FIELD_INFO)
+        path = self._store_blank_template("preview_eid")
+        token = security.create_access_token(data={"sub": buyer_user.email, "role": buyer_user.role})
+        try:
+            with patch('app.main.get_cast') as mock_get_cast, patch('app.main.submit_filled_pdf') as mock_fill:
+                response = test_client.post(
+                    "/api/templates/preview_eid/preview",
+                    headers={"Authorization": f"Bearer {token}"},
+                    json={"name1": {"firstName": "Jane", "lastName": "Doe"}},
+                )
+                mock_get_cast.assert_not_called()
+                mock_fill.assert_not_called()
+            assert response.status_code == 200
+            assert response.headers["content-type"] == "application/pdf"
+            annotations = PdfReader(io.BytesIO(response.content)).pages[0]["/Annots"]
+            annotation = annotations[0].get_object()
+            assert annotation["/Contents"] == "Jane Doe"
+            # Top-left based Anvil rect converted to PDF user space.
+            assert [float(v) for v in annotation["/Rect"]] == [50, 672, 250, 692]
+        finally:
+            os.remove(path)
+
+    def test_preview_requires_stored_template(self, test_client, buyer_user, template_fixture):
+        token = security.create_access_token(data={"sub": buyer_user.email, "role": buyer_user.role})
+        response = test_client.post(
+            f"/api/templates/{template_fixture.anvil_template_eid}/preview",
+            headers={"Authorization": f"Bearer {token}"},
+            json={},
+        )
+        assert response.status_code == 404
+
+    @patch('app.main.get_cast')
+    def test_field_info_is_cached_on_template(self, mock_get_cast, test_client, buyer_user, template_fixture, db_session):
+        mock_get_cast.return_value = {"fieldInfo": {"fields": [{"id": "field1", "type": "text"}]}}
+        token = security.create_access_token(data={"sub": buyer_user.email, "role": buyer_user.role})
+        for _ in range(2):
+            response = test_client.get(
+                f"/api/templates/{template_fixture.anvil_template_eid}/fields",
+                headers={"Authorization": f"Bearer {token}"},
+            )
+            assert response.json()["fields"][0]["id"] == "field1"
+        mock_get_cast.assert_called_once()
+
+
+class TestBatchFields:
+    def _post(self, user, template_ids):
+        token = security.create_access_token(data={"sub": user.email, "role": user.role})
+        return client.post(
+            "/api/templates/fields/batch", headers={"Authorization": f"Bearer {token}"}, json={"template_ids": template_ids}
+        )
+
+    @patch('app.main.get_cast')
+    def test_batch_returns_fields_and_errors(self, mock_get_cast, test_client, db_session, agent_user, buyer_user):
+        crud.create_template(db_session, "cached.pdf", agent_user.id, "cached_eid", field_info={"fields": [{"id": "c"}]})
+        crud.create_template(db_session, "fresh.pdf", agent_user.id, "fresh_eid")
+        crud.create_template(db_session, "broken.pdf", agent_user.id, "broken_eid")
+
+        def get_cast(anvil_template_eid):
+            if anvil_template_eid == "broken_eid":
+                raise RuntimeError("boom")
+            return {"fieldInfo": {"fields": [{"id": "f"}]}}
+        mock_get_cast.side_effect = get_cast
+
+        response = self._post(buyer_user, ["cached_eid", "fresh_eid", "broken_eid", "missing_eid", "fresh_eid"])
+        assert response.status_code == 200
+        body = response.json()
+        assert body["fields"] == {"cached_eid": [{"id": "c"}], "fresh_eid": [{"id": "f"}]}
+        assert body["errors"]["missing_eid"]["status_code"] == 404
+        assert body["errors"]["broken_eid"] == {"status_code": 502, "detail": "Failed to fetch data from Anvil: boom"}
+        assert sorted(c.kwargs["anvil_template_eid"] for c in mock_get_cast.call_args_list) == ["broken_eid", "fresh_eid"]
+
+        # Fetched schemas are cached on the row; failed ones are retried next time.
+        db_session.expire_all()
+        assert crud.get_template(db_session, "fresh_eid").field_info == {"fields": [{"id": "f"}]}
+        assert crud.get_template(db_session, "broken_eid").field_info is None
+
+    @patch('app.main.get_cast')
+    @patch('app.main.get_casts')
+    def test_large_batch_uses_bulk_listing(self, mock_get_casts, mock_get_cast, test_client, db_session, agent_user, buyer_user, monkeypatch):
+        monkeypatch.setattr(config, "FIELDS_BATCH_BULK_THRESHOLD", 2)
+        for eid in ("bulk_a", "bulk_b", "bulk_c"):
+            crud.create_template(db_session, f"{eid}.pdf", agent_user.id, eid)
+        mock_get_casts.return_value = [{"eid": "bulk_a", "fieldInfo": {"fields": [{"id": "a"}]}},
+                                       {"eid": "bulk_b", "fieldInfo": {"fields": [{"id": "b"}]}}]
+        mock_get_cast.return_value = {"fieldInfo": {"fields": [{"id": "c"}]}}
+
+        response = self._post(buyer_user, ["bulk_a", "bulk_b", "bulk_c"])
+        assert response.json()["fields"] == {"bulk_a": [{"id": "a"}], "bulk_b": [{"id": "b"}], "bulk_c": [{"id": "c"}]}
+        mock_get_casts.assert_called_once()
+        mock_get_cast.assert_called_once_with(anvil_template_eid="bulk_c")
+
+    @patch('app.main.get_cast')
+    def test_each_anvil_lookup_costs_a_token(self, mock_get_cast, test_client, db_session, agent_user, buyer_user):
+        for eid in ("rate_a", "rate_b", "rate_c"):
+            crud.create_template(db_session, f"{eid}.pdf", agent_user.id, eid)
+        rate = admission.Rate(*config.ADMISSION_RATES["fields"]["Buyer"])
+        key = f"fields:user:{buyer_user.email}"
+        # Leave two tokens: one for the request (and its first lookup), one more lookup.
+        assert admission.bucket_backend.take_up_to(key, rate, rate.burst - 2) == rate.burst - 2
+        mock_get_cast.return_value = {"fieldInfo": {"fields": []}}
+
+        body = self._post(buyer_user, ["rate_a", "rate_b", "rate_c"]).json()
+        assert sorted(body["fields"]) == ["rate_a", "rate_b"]
+        assert body["errors"] == {"rate_c": {"status_code": 429, "detail": "Rate limit exceeded"}}
+        assert mock_get_cast.call_count == 2
+        assert self._post(buyer_user, ["rate_a"]).status_code == 429
+
+    def test_batch_limits(self, test_client, buyer_user, agent_user, monkeypatch):
+        monkeypatch.setattr(config, "FIELDS_BATCH_MAX_TEMPLATES", 2)
+        assert self._post(buyer_user, ["a", "b", "c"]).status_code == 422
+        assert self._post(agent_user, ["a"]).status_code == 403
+
+
+class TestTemplateCache:
+    def test_write_through_and_hits(self, test_client, db_session, agent_user, admin_user):
+        cache = template_cache.templates
+        cache.warm(db_session)
+        created = crud.create_template(db_session, "cached.pdf", agent_user.id, "cache_eid")
+
+        for _ in range(3):
+            cached = cache.get_by_eid(db_session, "cache_eid")
+            assert (cached.id, cached.owner_id) == (created.id, agent_user.id)
+        assert cache.get_by_id(db_session, created.id) == cached
+        assert cache.get_by_eid(db_session, "unknown_eid") is None
+
+        token = security.create_access_token(data={"sub": admin_user.email, "role": admin_user.role})
+        stats = test_client.get("/api/admin/cache/templates", headers={"Authorization": f"Bearer {token}"}).json()
+        assert (stats["hits"], stats["misses"], stats["hit_rate"]) == (4, 1, 0.8)
+
+    def test_changes_from_other_workers_invalidate(self, db_session, template_fixture):
+        other_worker = template_cache.TemplateCache(max_size=10, check_interval=0)
+        other_worker.warm(db_session)
+        assert other_worker.get_by_eid(db_session, template_fixture.anvil_template_eid).field_info is None
+
+        crud.update_template_field_info(db_session, template_fixture, {"fields": [{"id": "new"}]})
+
+        refreshed = other_worker.get_by_eid(db_session, template_fixture.anvil_template_eid)
+        assert refreshed.field_info == {"fields": [{"id": "new"}]}
+        assert other_worker.stats()["invalidations"] == 1
+
+    def test_cache_is_bounded(self, db_session, agent_user):
+        cache = template_cache.TemplateCache(max_size=2, check_interval=60)
+        for n in range(3):
+            crud.create_template(db_session, f"t{n}.pdf", agent_user.id, f"bounded_{n}")
+        cache.warm(db_session)
+        assert cache.stats()["size"] == 2
+        assert cache.get_by_eid(db_session, "bounded_0").title == "t0.pdf"
+        assert cache.stats()["evictions"] == 1
+
+
+class TestFormDrafts:
+    def _headers(self, user, **extra):
+        token = security.create_access_token(data={"sub": user.email, "role": user.role})
+        return {"Authorization": f"Bearer {token}", **extra}
+
+    def test_merge_patch(self):
+        target = {"name": {"first": "Jane", "last": "Doe"}, "city": "Paris"}
+        patched = crud.apply_merge_patch(target, {"name": {"last": "Roe"}, "city": None, "zip": "75001"})
+        assert patched == {"name": {"first": "Jane", "last": "Roe"}, "zip": "75001"}
+        assert target["city"] == "Paris"
+
+    def test_autosave_and_resume(self, test_client, buyer_user, template_fixture):
+        url = f"/api/templates/{template_fixture.anvil_template_eid}/draft"
+        response = test_client.patch(url, headers=self._headers(buyer_user), json={"name": "Jane", "city": "Paris"})
+        assert response.json()["version"] == 1
+        response = test_client.patch(url, headers=self._headers(buyer_user, **{"If-Match": "1"}), json={"city": None})
+        assert response.json()["version"] == 2
+
+        stale = test_client.patch(url, headers=self._headers(buyer_user, **{"If-Match": "1"}), json={"name": "X"})
+        assert stale.status_code == 412
+
+        response = test_client.get(url, headers=self._headers(buyer_user))
+        assert response.json()["data"] == {"name": "Jane"}
+        assert response.json()["version"] == 2
+
+    def test_compaction_folds_deltas(self, db_session, buyer_user, template_fixture, monkeypatch):
+        monkeypatch.setattr(config, "DRAFT_COMPACTION_THRESHOLD", 3)
+        draft = crud.get_or_create_draft(db_session, buyer_user.id, template_fixture.anvil_template_eid)
+        for i in range(4):
+            crud.append_draft_delta(db_session, draft, {f"field{i}": i})
+        assert draft.compacted_version == 3
+        assert draft.data == {"field0": 0, "field1": 1, "field2": 2}
+        assert db_session.query(models.FormDraftDelta).count() == 1
+        assert crud.materialize_draft(db_session, draft) == {"field0": 0, "field1": 1, "field2": 2, "field3": 3}
+
+    @patch('app.main.upload_pdf')
+    @patch('app.main.create_etch_packet')
+    @patch('app.main.submit_filled_pdf')
+    def test_submit_from_draft(self, mock_submit, mock_etch, mock_upload, test_client, db_session, buyer_user, template_fixture):
+        mock_submit.return_value = b"filled content"
+        mock_etch.return_value = {"createEtchPacket": {"eid": "etch_draft", "detailsURL": "url"}}
+        url = f"/api/templates/{template_fixture.anvil_template_eid}"
+        draft_id = test_client.patch(f"{url}/draft", headers=self._headers(buyer_user), json={"field1": "value1"}).json()["id"]
+
+        response = test_client.post(
+            f"{url}/submissions", params={"draft_id": draft_id}, headers=self._headers(buyer_user), json={"field2": "value2"}
+        )
+        assert response.status_code == 201
+        assert mock_submit.call_args[0][0] == {"field1": "value1", "field2": "value2"}
+        assert test_client.get(f"{url}/draft", headers=self._headers(buyer_user)).status_code == 404
+
+    def test_concurrent_first_autosaves_share_one_draft(self, db_session, buyer_user, template_fixture):
+        eid = template_fixture.anvil_template_eid
+        winner = crud.get_or_create_draft(db_session, buyer_user.id, eid)
+        real_get_draft = crud.get_draft
+        # The loser's first lookup ran before the winner committed.
+        with patch.object(crud, "get_draft", side_effect=[None, real_get_draft(db_session, buyer_user.id, eid)]):
+            loser = crud.get_or_create_draft(db_session, buyer_user.id, eid)
+        assert loser.id == winner.id
+        assert db_session.query(models.FormDraft).count() == 1
+        assert crud.append_draft_delta(db_session, loser, {"field1": "value1"}) == 1
+
+    def test_submit_requires_own_draft(self, test_client, db_session, buyer_user, template_fixture):
+        other = crud.create_user(db_session, schemas.UserCreate(email="other@test.io", role="Buyer", password="pw"))
+        draft = crud.get_or_create_draft(db_session, other.id, template_fixture.anvil_template_eid)
+        response = test_client.post(
+            f"/api/templates/{template_fixture.anvil_template_eid}/submissions",
+            params={"draft_id": draft.id},
+            headers=self._headers(buyer_user),
+        )
+        assert response.status_code == 404
+
+
+class TestAdmissionControl:
+    def test_token_bucket(self):
+        buckets = admission.InMemoryBucketBackend()
+        rate = admission.Rate(per_second=1, burst=2)
+        assert buckets.take("k", rate, now=0) == 0
+        assert buckets.take("k", rate, now=0) == 0
+        assert buckets.take("k", rate, now=0) == pytest.approx(1.0)
+        assert buckets.take("k", rate, now=1.0) == 0
+        assert buckets.take("other", rate, now=1.0) == 0
+
+    def test_concurrency_limiter_queue(self):
+        async def scenario():
+            limiter = admission.ConcurrencyLimiter(limit=1, max_queue=1, max_wait=0.05)
+            assert await limiter.acquire()
+            waiter = asyncio.create_task(limiter.acquire())
+            await asyncio.sleep(0)
+            # The single queue slot is taken by `waiter`, so this one is shed at once.
+            assert not await limiter.acquire()
+            await limiter.release()
+            assert await waiter
+            # Nobody releases now, so a queued request times out.
+            assert not await limiter.acquire()
+
+        asyncio.run(scenario())
+
+    def test_concurrency_limiter_is_first_come_first_served(self):
+        async def scenario():
+            limiter = admission.ConcurrencyLimiter(limit=1, max_queue=2, max_wait=1)
+            assert await limiter.acquire()
+            first = asyncio.create_task(limiter.acquire())
+            await asyncio.sleep(0)
+            await limiter.release()
+            # The freed slot already belongs to `first`; a new arrival queues behind it.
+            late = asyncio.create_task(limiter.acquire())
+            assert await first
+            await asyncio.sleep(0)
+            assert not late.done()
+            await limiter.release()
+            assert await late
+            await limiter.release()
+            assert limiter._running == 0
+
+        asyncio.run(scenario())
+
+    def test_submissions_are_rate_limited_per_user(self, test_client, buyer_user, template_fixture):
+        rate = admission.Rate(*config.ADMISSION_RATES["submit"]["Buyer"])
+        for _ in range(rate.burst):
+            admission.bucket_backend.take(f"submit:user:{buyer_user.email}", rate)
+        token = security.create_access_token(data={"sub": buyer_user.email, "role": buyer_user.role})
+        with patch('app.main.submit_filled_pdf') as mock_submit:
+            response = test_client.post(
+                f"/api/templates/{template_fixture.anvil_template_eid}/submissions",
+                headers={"Authorization": f"Bearer {token}"},
+                json={"field1": "value1"},
+            )
+            mock_submit.assert_not_called()
+        assert response.status_code == 429
+        assert int(response.headers["retry-after"]) >= 1
+
+
+class TestRetention:
+    LATER = datetime.now(timezone.utc) + timedelta(days=365)
+
+    @pytest.fixture
+    def storage(self, tmp_path, monkeypatch):
+        packs = tmp_path / "packs"
+        packs.mkdir()
+        monkeypatch.setattr(file_service, "STORAGE_PATH", str(tmp_path))
+        monkeypatch.setattr(file_service, "PACK_STORAGE_PATH", str(packs))
+        return tmp_path
+
+    def _submit(self, db_session, template_fixture, buyer_user, eid, content):
+        crud.create_submission(db_session, template_fixture.anvil_template_eid, buyer_user.id, eid, "url")
+        file_service.upload_pdf(f"{eid}.pdf", content)
+
+    def test_cold_pdfs_are_packed_and_restored(self, storage, db_session, template_fixture, buyer_user):
+        self._submit(db_session, template_fixture, buyer_user, "cold_a", b"%PDF a" * 1000)
+        self._submit(db_session, template_fixture, buyer_user, "cold_b", b"%PDF b" * 1000)
+
+        report = retention.sweep(db_session, now=self.LATER, bytes_per_second=0)
+        assert (report.packs_written, report.packed_files, report.packed_bytes) == (1, 2, 12000)
+        assert 0 < report.pack_bytes < report.packed_bytes
+        assert report.reclaimed_bytes == report.packed_bytes - report.pack_bytes
+        assert not (storage / "cold_a.pdf").exists()
+
+        # Reads stream from the pack without extracting anything.
+        source, size = file_service.open_pdf("cold_a")
+        with source:
+            assert (source.read(), size) == (b"%PDF a" * 1000, 6000)
+        assert not (storage / "cold_a.pdf").exists()
+        with pytest.raises(FileNotFoundError):
+            file_service.open_pdf("never_stored")
+
+        # Only the X-Accel-Redirect path puts a loose copy back.
+        assert file_service.restore_packed_pdf("cold_a")
+        assert (storage / "cold_a.pdf").read_bytes() == b"%PDF a" * 1000
+        assert not file_service.restore_packed_pdf("never_stored")
+
+        # The restored copy is dropped again by a later sweep.
+        report = retention.sweep(db_session, now=self.LATER, bytes_per_second=0)
+        assert report.restored_copies_removed == 1
+        assert not (storage / "cold_a.pdf").exists()
+
+    def test_packed_pdfs_are_served_from_the_pack(self, storage, test_client, db_session, template_fixture, buyer_user):
+        self._submit(db_session, template_fixture, buyer_user, "cold_a", b"%PDF a" * 1000)
+        retention.sweep(db_session, now=self.LATER, bytes_per_second=0)
+        token = security.create_access_token(data={"sub": buyer_user.email, "role": buyer_user.role})
+        headers = {"Authorization": f"Bearer {token}"}
+
+        response = test_client.get("/api/submissions/cold_a/download", headers=headers)
+        assert response.status_code == 200
+        assert response.content == b"%PDF a" * 1000
+        response = test_client.get("/api/submissions/archive", headers=headers)
+        with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
+            assert archive.read("cold_a.pdf") == b"%PDF a" * 1000
+        assert sorted(os.listdir(storage)) == ["packs"]
+
+    def test_legacy_json_index_is_imported(self, storage):
+        (storage / "packs" / "index.json").write_text('{"old_a": "pack-old.zip"}')
+        assert file_service.find_pack("old_a") == "pack-old.zip"
+        assert not (storage / "packs" / "index.json").exists()
+        assert file_service.read_pack_index() == {"old_a": "pack-old.zip"}
+
+    def test_recent_and_excluded_templates_stay_loose(self, storage, db_session, template_fixture, buyer_user, monkeypatch):
+        self._submit(db_session, template_fixture, buyer_user, "recent", b"%PDF")
+        assert retention.sweep(db_session, bytes_per_second=0).packed_files == 0
+
+        monkeypatch.setitem(config.RETENTION_TEMPLATE_POLICIES, template_fixture.anvil_template_eid, None)
+        assert retention.sweep(db_session, now=self.LATER, bytes_per_second=0).packed_files == 0
+        assert (storage / "recent.pdf").exists()
+
+    def test_orphans_are_deleted_after_grace_period(self, storage, db_session):
+        file_service.upload_pdf("orphan.pdf", b"%PDF orphan")
+        assert retention.sweep(db_session, bytes_per_second=0).orphans_deleted == 0
+
+        report = retention.sweep(db_session, now=self.LATER, bytes_per_second=0)
+        assert (report.orphans_deleted, report.orphan_bytes) == (1, 11)
+        assert not (storage / "orphan.pdf").exists()
+
+    def test_one_sweep_at_a_time_across_workers(self, storage, db_session):
+        # flock locks held through separate opens conflict even within one process, as between workers.
+        with file_service.storage_lock("retention"):
+            with pytest.raises(RuntimeError):
+                retention.sweep(db_session, bytes_per_second=0)
+        assert retention.sweep(db_session, bytes_per_second=0).scanned_files == 0
+
+    def test_packs_of_deleted_submissions_are_removed(self, storage, db_session, template_fixture, buyer_user):
+        self._submit(db_session, template_fixture, buyer_user, "gone", b"%PDF gone")
+        retention.sweep(db_session, now=self.LATER, bytes_per_second=0)
+        db_session.delete(crud.get_submission_by_id(db_session, "gone"))
+        db_session.commit()
+
+        report = retention.sweep(db_session, now=self.LATER, bytes_per_second=0)
+        assert (report.stale_index_entries, report.packs_deleted) == (1, 1)
+        assert file_service.read_pack_index() == {}
+        assert file_service.list_packs() == {}
+
+    def test_sweep_endpoint_dry_run(self, storage, test_client, db_session, admin_user, buyer_user):
+        file_service.upload_pdf("orphan.pdf", b"%PDF orphan")
+        os.utime(storage / "orphan.pdf", (0, 0))
+        admin_token = security.create_access_token(data={"sub": admin_user.email, "role": admin_user.role})
+        response = test_client.post(
+            "/api/admin/retention/sweep", params={"dry_run": True}, headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert response.status_code == 200
+        assert response.json()["orphans_deleted"] == 1
+        assert response.json()["reclaimed_bytes"] == 11
+        assert (storage / "orphan.pdf").exists()
+
+        buyer_token = security.create_access_token(data={"sub": buyer_user.email, "role": buyer_user.role})
+        response = test_client.post("/api/admin/retention/sweep", headers={"Authorization": f"Bearer {buyer_token}"})
+        assert response.status_code == 403
+
+
+class TestSubmissionPartitions:
+    LATER = datetime.now(timezone.utc) + timedelta(days=365)
+
+    def _submit(self, db_session, template_fixture, buyer_user, count=3):
+        for n in range(1, count + 1):
+            crud.create_submission(db_session, template_fixture.anvil_template_eid, buyer_user.id, f"sub_{n}", "url")
+
+    def test_rollover_archives_all_but_latest(self, db_session, template_fixture, buyer_user, admin_user):
+        self._submit(db_session, template_fixture, buyer_user)
+        report = partitions.rollover(db_session, now=self.LATER, batch_size=1)
+        assert (report.moved, report.kept_latest, report.batches) == (2, 1, 2)
+        assert sum(report.months.values()) == 2
+
+        # Recent-data paths read only the hot table.
+        assert [s.anvil_submission_eid for s in crud.get_submissions_by_user(db_session, buyer_user.id)] == ["sub_3"]
+        assert crud.get_latest_submission(db_session, template_fixture.anvil_template_eid).anvil_submission_eid == "sub_3"
+        # Everything else still sees archived submissions.
+        assert isinstance(crud.get_submission_by_id(db_session, "sub_1"), models.ArchivedSubmission)
+        assert crud.get_downloadable_submission_eids(db_session, buyer_user) == ["sub_1", "sub_2", "sub_3"]
+        assert set(retention._submission_created_at(db_session, ["sub_1", "sub_3"])) == {"sub_1", "sub_3"}
+        crud.rebuild_submission_rollups(db_session)
+        stats = db_session.get(models.TemplateSubmissionStats, template_fixture.anvil_template_eid)
+        assert (stats.total, stats.last_submission_id) == (3, crud.get_submission_by_id(db_session, "sub_3").id)
+        search.rebuild_search_index(db_session)
+        rows, _ = search.search(db_session, "sub_1", admin_user, kind="submission")
+        assert [r["ref"] for r in rows] == ["sub_1"]
+
+        # Nothing is left to move, and recent submissions are never moved.
+        assert partitions.rollover(db_session, now=self.LATER).moved == 0
+        assert partitions.rollover(db_session).moved == 0
+
+    def test_rebuild_points_rollups_at_hot_rows(self, db_session, template_fixture, buyer_user):
+        self._submit(db_session, template_fixture, buyer_user)
+        partitions.rollover(db_session, now=self.LATER)
+        # An archived row newer than anything hot, e.g. after the hot latest was deleted.
+        db_session.add(models.ArchivedSubmission(id=999, template_id=template_fixture.anvil_template_eid,
+                                                 buyer_id=buyer_user.id, anvil_submission_eid="sub_old",
+                                                 created_at=datetime(2020, 1, 15)))
+        db_session.commit()
+        crud.rebuild_submission_rollups(db_session)
+        latest = crud.get_submission_by_id(db_session, "sub_3").id
+        stats = db_session.get(models.TemplateSubmissionStats, template_fixture.anvil_template_eid)
+        assert (stats.total, stats.last_submission_id) == (4, latest)
+        stats = db_session.get(models.BuyerSubmissionStats, buyer_user.id)
+        assert (stats.total, stats.last_submission_id) == (4, latest)
+
+        db_session.query(models.Submission).delete()
+        db_session.commit()
+        crud.rebuild_submission_rollups(db_session)
+        stats = db_session.get(models.TemplateSubmissionStats, template_fixture.anvil_template_eid)
+        assert (stats.total, stats.last_submission_id) == (3, None)
+
+    def test_latest_stays_hot_without_rollups(self, db_session, template_fixture, buyer_user):
+        for n in range(1, 4):
+            db_session.add(models.Submission(template_id=template_fixture.anvil_template_eid, buyer_id=buyer_user.id,
+                                             anvil_submission_eid=f"raw_{n}"))
+        db_session.commit()
+        assert db_session.query(models.TemplateSubmissionStats).count() == 0
+
+        report = partitions.rollover(db_session, now=self.LATER)
+        assert (report.moved, report.kept_latest) == (2, 1)
+        assert crud.get_latest_submission(db_session, template_fixture.anvil_template_eid).anvil_submission_eid == "raw_3"
+
+    def test_dry_run_moves_nothing(self, db_session, template_fixture, buyer_user):
+        self._submit(db_session, template_fixture, buyer_user)
+        with file_service.storage_lock("rollover"):
+            with pytest.raises(RuntimeError):
+                partitions.rollover(db_session, now=self.LATER, dry_run=True)
+        report = partitions.rollover(db_session, now=self.LATER, dry_run=True)
+        assert (report.dry_run, report.moved) == (True, 2)
+        assert db_session.query(models.ArchivedSubmission).count() == 0
+        assert db_session.query(models.Submission).count() == 3
+
+    def test_history_pages_across_hot_and_archive(self, test_client, db_session, template_fixture, buyer_user, admin_user):
+        self._submit(db_session, template_fixture, buyer_user)
+        admin_headers = {"Authorization": f"Bearer {security.create_access_token(data={'sub': admin_user.email, 'role': admin_user.role})}"}
+        db_session.query(models.Submission).update({models.Submission.created_at: datetime(2020, 1, 15)})
+        db_session.commit()
+        response = test_client.post("/api/admin/submissions/rollover", headers=admin_headers)
+        assert response.status_code == 200
+        assert (response.json()["moved"], response.json()["months"]) == (2, {"2020-01": 2})
+
+        headers = {"Authorization": f"Bearer {security.create_access_token(data={'sub': buyer_user.email, 'role': buyer_user.role})}"}
+        first = test_client.get("/api/submissions/history", params={"limit": 2}, headers=headers).json()
+        assert [s["anvil_submission_eid"] for s in first["submissions"]] == ["sub_3", "sub_2"]
+        assert first["submissions"][1]["template"]["title"] == template_fixture.title
+        second = test_client.get(
+            "/api/submissions/history", params={"limit": 2, "before_id": first["next_before_id"]}, headers=headers
+        ).json()
+        assert [s["anvil_submission_eid"] for s in second["submissions"]] == ["sub_1"]
+        assert second["next_before_id"] is None
+
+
+class TestEvents:
+    def test_crud_publishes_events(self, db_session, template_fixture, buyer_user):
+        crud.create_submission(db_session, template_fixture.anvil_template_eid, buyer_user.id, "evt_sub", "url")
+        template_event, submission_event = list(events.bus._history)[-2:]
+        assert template_event.type == "template.created"
+        assert template_event.data["anvil_template_eid"] == template_fixture.anvil_template_eid
+        assert submission_event.type == "submission.created"
+        assert (submission_event.owner_id, submission_event.buyer_id) == (template_fixture.owner_id, buyer_user.id)
+
+    def test_visibility_by_role(self):
+        event = events.Event(1, "b-1", "submission.created", {}, owner_id=1, buyer_id=2)
+        assert event.visible_to(99, "Admin")
+        assert event.visible_to(1, "Agent") and not event.visible_to(3, "Agent")
+        assert event.visible_to(2, "Buyer") and not event.visible_to(3, "Buyer")
+        assert events.Event(2, "b-2", "template.created", {}, owner_id=1).visible_to(3, "Buyer")
+
+    def test_stream_filters_and_resumes(self):
+        bus = events.EventBus(history_size=10)
+        agent = models.User(id=1, role="Agent")
+
+        async def scenario():
+            first = bus.publish("template.created", {"n": 1}, owner_id=1)
+            bus.publish("template.created", {"n": 2}, owner_id=5)
+            bus.publish("template.created", {"n": 3}, owner_id=1)
+            stream = events.event_stream(agent, last_event_id=first.id, heartbeat=0.05, event_bus=bus)
+            received = [await anext(stream) for _ in range(2)]
+            received.append(await anext(stream))  # Idle: heartbeat
+            bus.publish("template.created", {"n": 4}, owner_id=1)
+            received.append(await anext(stream))
+            await stream.aclose()
+            return received
+
+        retry, replayed, keepalive, live = asyncio.run(scenario())
+        assert retry.startswith("retry:")
+        assert replayed == f'id: {bus.boot}-3\nevent: template.created\ndata: {{"n": 3}}\n\n'
+        assert keepalive == ": keepalive\n\n"
+        assert '"n": 4' in live
+        assert not bus._subscribers
+
+    def test_unknown_or_expired_id_resets(self):
+        bus = events.EventBus(history_size=2)
+        for n in range(5):
+            bus.publish("template.created", {"n": n})
+
+        async def first_events(last_event_id):
+            stream = events.event_stream(models.User(id=1, role="Admin"), last_event_id, event_bus=bus)
+            received = [await anext(stream) for _ in range(2)]
+            await stream.aclose()
+            return received
+
+        for last_event_id in (f"{bus.boot}-1", "oldboot-4"):
+            _, reset = asyncio.run(first_events(last_event_id))
+            assert reset == f"id: {bus.boot}-5\nevent: reset\ndata: {{}}\n\n"
+
+    def test_slow_subscriber_is_disconnected(self):
+        bus = events.EventBus(history_size=10)
+
+        async def scenario():
+            subscription, _, _ = bus.subscribe(queue_size=1)
+            bus.publish("template.created", {})
+            bus.publish("template.created", {})
+            await asyncio.sleep(0)
+            return subscription.queue.get_nowait()
+
+        assert asyncio.run(scenario()) is None
+
+    def test_stream_requires_token(self, test_client):
+        assert test_client.get("/api/events").status_code == 401
+        assert test_client.get("/api/events", params={"access_token": "bad"}).status_code == 401
+
+
+class TestSignedDownloads:
+    def _download_url(self, user, submission_eid):
+        token = security.create_access_token(data={"sub": user.email, "role": user.role})
+        return client.post(f"/api/submissions/{submission_eid}/download-url", headers={"Authorization": f"Bearer {token}"})
+
+    def test_signed_url_serves_pdf_without_token(self, test_client, buyer_user, submission_fixture):
+        file_service.upload_pdf(f"{submission_fixture.anvil_submission_eid}.pdf", b"%PDF signed")
+        try:
+            response = self._download_url(buyer_user, submission_fixture.anvil_submission_eid)
+            assert response.status_code == 200
+            url = response.json()["url"]
+            assert url.startswith(f"/api/files/submissions/{submission_fixture.anvil_submission_eid}.pdf?expires=")
+
+            response = test_client.get(url)
+            assert response.status_code == 200
+            assert response.content == b"%PDF signed"
+
+            assert test_client.get(url.replace("signature=", "signature=x")).status_code == 403
+        finally:
+            os.remove(file_service.get_pdf_path(submission_fixture.anvil_submission_eid))
+
+    def test_signature_is_bound_to_submission_and_expiry(self):
+        expires = int(datetime.now(timezone.utc).timestamp()) + 60
+        signature = security.sign_download("eid_a", expires)
+        assert security.verify_download_signature("eid_a", expires, signature)
+        assert not security.verify_download_signature("eid_b", expires, signature)
+        assert not security.verify_download_signature("eid_a", expires + 1, signature)
+        past = expires - 120
+        assert not security.verify_download_signature("eid_a", past, security.sign_download("eid_a", past))
+
+    def test_no_signing_without_a_configured_secret(self, test_client, monkeypatch):
+        monkeypatch.setattr(security, "DOWNLOAD_URL_SECRET", None)
+        with pytest.raises(RuntimeError):
+            security.sign_download("eid_a", 0)
+        with pytest.raises(RuntimeError):
+            security.verify_download_signature("eid_a", 0, "x")
+        with pytest.raises(RuntimeError):
+            with TestClient(app):
+                pass
+
+    def test_signed_url_requires_authorisation(self, test_client, db_session, submission_fixture):
+        other = crud.create_user(db_session, schemas.UserCreate(email="other@test.io", role="Buyer", password="pw"))
+        assert self._download_url(other, submission_fixture.anvil_submission_eid).status_code == 403
+
+    def test_offload_mode_hands_file_to_nginx(self, test_client, admin_user, submission_fixture, monkeypatch):
+        monkeypatch.setattr(config, "DOWNLOAD_OFFLOAD", "x-accel")
+        eid = submission_fixture.anvil_submission_eid
+        file_service.upload_pdf(f"{eid}.pdf", b"%PDF offloaded")
+        try:
+            token = security.create_access_token(data={"sub": admin_user.email, "role": admin_user.role})
+            response = test_client.get(f"/api/submissions/{eid}/download", headers={"Authorization": f"Bearer {token}"})
+            assert response.status_code == 200
+            assert response.headers["x-accel-redirect"] == f"/protected-pdfs/{eid}.pdf"
+            assert response.headers["content-type"] == "application/pdf"
+            assert response.content == b""
+        finally:
+            os.remove(file_service.get_pdf_path(eid))
+
+
+class TestProfiler:
+    def _headers(self, user):
+        token = security.create_access_token(data={"sub": user.email, "role": user.role})
+        return {"Authorization": f"Bearer {token}"}
+
+    def test_slow_request_capture(self, test_client, admin_user, buyer_user, template_fixture):
+        response = test_client.put(
+            "/api/admin/profiler/slow-requests/capture",
+            headers=self._headers(admin_user),
+            json={"enabled": True, "threshold_ms": 0},
+        )
+        assert response.json() == {"enabled": True, "threshold_ms": 0}
+        try:
+            test_client.get("/api/templates/available", headers=self._headers(buyer_user))
+            captured = test_client.get("/api/admin/profiler/slow-requests", headers=self._headers(admin_user)).json()
+            trace = next(t for t in captured if t["path"] == "/api/templates/available")
+            assert trace["status_code"] == 200
+            assert trace["statement_count"] >= 2
+
+            detail = test_client.get(f"/api/admin/profiler/slow-requests/{trace['id']}", headers=self._headers(admin_user))
+            assert any("FROM templates" in s["sql"] for s in detail.json()["statements"])
+            flamegraph = test_client.get(
+                f"/api/admin/profiler/slow-requests/{trace['id']}/flamegraph", headers=self._headers(admin_user)
+            )
+            assert flamegraph.status_code == 200
+            assert flamegraph.headers["content-type"].startswith("text/plain")
+        finally:
+            profiling.configure_slow_capture(None)
+
+    def test_slow_log_keeps_the_most_recent_requests(self):
+        log = profiling.SlowRequestLog(size=2)
+        traces = [profiling.RequestTrace("GET", f"/{n}") for n in range(3)]
+        for trace, duration_ms in zip(traces, (900, 50, 10)):
+            trace.duration_ms = duration_ms
+            log.add(trace)
+        # The old slow request ages out; newer, faster ones are not dropped.
+        assert [t.path for t in log.all()] == ["/2", "/1"]
+        assert log.get(traces[0].id) is None
+
+    def test_failed_statement_does_not_leak_its_start_time(self, db_session):
+        trace = profiling.RequestTrace("GET", "/test")
+        token = profiling._current_trace.set(trace)
+        try:
+            with engine.connect() as connection:
+                with pytest.raises(Exception):
+                    connection.exec_driver_sql("SELECT * FROM no_such_table")
+                assert connection.info.get("profiler_started") == []
+                connection.exec_driver_sql("SELECT 1")
+        finally:
+            profiling._current_trace.reset(token)
+        assert trace.statements[0]["error"] == "OperationalError"
+        assert "error" not in trace.statements[1]
+
+    def test_traced_records_external_calls(self):
+        @profiling.traced("anvil.test")
+        def call_anvil():
+            return "ok"
+
+        trace = profiling.RequestTrace("GET", "/test")
+        token = profiling._current_trace.set(trace)
+        try:
+            assert call_anvil() == "ok"
+        finally:
+            profiling._current_trace.reset(token)
+        assert [c["name"] for c in trace.external_calls] == ["anvil.test"]
+        assert call_anvil() == "ok"  # No active trace: nothing recorded, nothing fails.
+
+    def test_sampling_session_returns_folded_stacks(self, test_client, admin_user):
+        response = test_client.post(
+            "/api/admin/profiler/sample", params={"seconds": 0.1}, headers=self._headers(admin_user)
+        )
+        assert response.status_code == 200
+        lines = response.text.strip().splitlines()
+        assert lines
+        assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+
+    def test_profiler_is_admin_only(self, test_client, buyer_user):
+        response = test_client.get("/api/admin/profiler/slow-requests", headers=self._headers(buyer_user))
+        assert response.status_code == 403
+
+
+class TestPasswordHashing:
+    def test_test_profile_is_active(self):
+        assert security.pwd_context.to_dict()["bcrypt__rounds"] == 4
+
+    def test_login_rehashes_outdated_hash(self, test_client, db_session, buyer_user):
+        old_context = security.build_password_context(["bcrypt"], "test", bcrypt__rounds=5)
+        crud.update_user_password_hash(db_session, buyer_user, old_context.hash("password123"))
+        assert security.password_needs_rehash(buyer_user.hashed_password)
+
+        response = test_client.post("/api/token", data={"username": buyer_user.email, "password": "password123"})
+        assert response.status_code == 200
+
+        db_session.refresh(buyer_user)
+        assert buyer_user.hashed_password.startswith("$2b$04$")
+        assert not security.password_needs_rehash(buyer_user.hashed_password)
+
+    @pytest.mark.parametrize("scheme", ["bcrypt", "pbkdf2_sha256", "argon2"])
+    def test_every_scheme_builds_with_each_profile(self, scheme):
+        for profile in security.PASSWORD_HASH_PROFILES:
+            context = security.build_password_context([scheme], profile)
+            if profile == "test":
+                assert context.verify("password123", context.hash("password123"))
+
+    def test_build_password_context_rejects_unknown_profile(self):
+        with pytest.raises(ValueError):
+            security.build_password_context(["bcrypt"], "unknown")
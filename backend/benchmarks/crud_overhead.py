@@ -0,0 +1,97 @@
+"""
+Measures the per-call cost of the hot crud functions, and per-row against bulk
+inserts of submissions and templates.
+
+Lookups run against a seeded temporary SQLite database (or `--database-url`),
+so the numbers are mostly ORM and statement-building overhead rather than
+database time. Passwords are hashed with the minimum-cost 'test' profile so
+create_user measures the insert, not bcrypt.
+
+Usage:
+    python benchmarks/crud_overhead.py --iterations 2000 --rows 500
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+os.environ.setdefault("PASSWORD_HASH_PROFILE", "test")
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app import crud, models, schemas
+
+
+def timed(label: str, calls: int, fn, units: int = 0) -> float:
+    """Calls `fn` `calls` times; prints and returns the microseconds per unit (default: per call)."""
+    units = units or calls
+    started = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    per_unit = (time.perf_counter() - started) / units * 1e6
+    print(f"{label:<32} {units:>7} {per_unit:>10.1f}")
+    return per_unit
+
+
+def seed(db, templates: int, submissions: int):
+    agent = crud.create_user(db, schemas.UserCreate(email="agent@bench.io", role="Agent", password="password123"))
+    buyer = crud.create_user(db, schemas.UserCreate(email="buyer@bench.io", role="Buyer", password="password123"))
+    rows = crud.bulk_create_templates(db, [
+        {"title": f"Template {i}", "owner_id": agent.id, "anvil_template_eid": f"tpl-{i}"} for i in range(templates)
+    ])
+    crud.bulk_create_submissions(db, [
+        {"template_id": rows[i % templates].anvil_template_eid, "buyer_id": buyer.id, "anvil_submission_eid": f"sub-{i}"}
+        for i in range(submissions)
+    ])
+    return agent, buyer, rows[0].anvil_template_eid
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=None, help="sync SQLAlchemy URL (default: temp SQLite file)")
+    parser.add_argument("--iterations", type=int, default=2000, help="calls per lookup")
+    parser.add_argument("--rows", type=int, default=500, help="rows inserted by each create comparison")
+    args = parser.parse_args()
+
+    database_url = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    engine = create_engine(database_url)
+    models.Base.metadata.create_all(bind=engine)
+    SessionLocal = sessionmaker(bind=engine, autoflush=False)
+
+    with SessionLocal() as db:
+        agent, buyer, template_eid = seed(db, templates=50, submissions=200)
+        n = args.iterations
+
+        print(f"{'call':<32} {'calls':>7} {'µs/call':>10}")
+        timed("get_user_by_email", n, lambda: crud.get_user_by_email(db, "buyer@bench.io"))
+        timed("get_template", n, lambda: crud.get_template(db, template_eid))
+        timed("get_templates_by_user", n // 10, lambda: crud.get_templates_by_user(db, agent.id))
+        timed("get_submissions_by_user", n // 10, lambda: crud.get_submissions_by_user(db, buyer.id))
+        timed("get_submission_by_id", n, lambda: crud.get_submission_by_id(db, "sub-0"))
+        timed("get_latest_submission", n, lambda: crud.get_latest_submission(db, template_eid))
+        timed("create_user", n // 10, lambda: crud.create_user(
+            db, schemas.UserCreate(email=f"{uuid.uuid4().hex}@bench.io", role="Buyer", password="password123")))
+
+        print(f"\n{'create':<32} {'rows':>7} {'µs/row':>10}")
+        per_row = timed("create_submission", args.rows, lambda: crud.create_submission(
+            db, template_eid, buyer.id, uuid.uuid4().hex, None))
+        bulk = timed("bulk_create_submissions", 1, lambda: crud.bulk_create_submissions(db, [
+            {"template_id": template_eid, "buyer_id": buyer.id, "anvil_submission_eid": uuid.uuid4().hex}
+            for _ in range(args.rows)
+        ]), units=args.rows)
+        print(f"  bulk is {per_row / bulk:.1f}x faster per row")
+        per_row = timed("create_template", args.rows, lambda: crud.create_template(
+            db, "Template", agent.id, uuid.uuid4().hex))
+        bulk = timed("bulk_create_templates", 1, lambda: crud.bulk_create_templates(db, [
+            {"title": "Template", "owner_id": agent.id, "anvil_template_eid": uuid.uuid4().hex}
+            for _ in range(args.rows)
+        ]), units=args.rows)
+        print(f"  bulk is {per_row / bulk:.1f}x faster per row")
+
+
+if __name__ == "__main__":
+    main()
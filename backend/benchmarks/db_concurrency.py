@@ -0,0 +1,114 @@
+"""
+Compares how many concurrent requests one worker sustains on the sync
+(Session + threadpool) and async (AsyncSession) data layers.
+
+Each request looks a user up by email and lists templates, the same work as an
+authenticated list endpoint. `--latency-ms` adds a simulated database round-trip
+to every request (time.sleep on the sync stack, asyncio.sleep on the async one)
+to approximate a networked database; pass `--database-url` to use a real one.
+
+Usage:
+    python benchmarks/db_concurrency.py --latency-ms 5 --levels 1,10,50,100,200
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import httpx
+from fastapi import FastAPI
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from app import async_crud, crud, models, schemas
+from app.database import get_async_database_url
+
+EMAIL = "bench@test.io"
+
+
+def build_app(database_url: str, latency: float):
+    engine = create_engine(database_url)
+    async_engine = create_async_engine(get_async_database_url(database_url))
+    SessionLocal = sessionmaker(bind=engine, autoflush=False)
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+    models.Base.metadata.create_all(bind=engine)
+    with SessionLocal() as db:
+        if not crud.get_user_by_email(db, EMAIL):
+            crud.create_user(db, schemas.UserCreate(email=EMAIL, role="Agent", password="password123"))
+
+    app = FastAPI()
+
+    @app.get("/sync")
+    def sync_endpoint():
+        with SessionLocal() as db:
+            if latency:
+                time.sleep(latency)
+            user = crud.get_user_by_email(db, EMAIL)
+            return {"user": user.id, "templates": len(crud.get_templates_by_user(db, user.id))}
+
+    @app.get("/async")
+    async def async_endpoint():
+        async with AsyncSessionLocal() as db:
+            if latency:
+                await asyncio.sleep(latency)
+            user = await async_crud.get_user_by_email(db, EMAIL)
+            return {"user": user.id, "templates": len(await async_crud.get_templates_by_user(db, user.id))}
+
+    return app, async_engine
+
+
+async def run_level(client: httpx.AsyncClient, path: str, concurrency: int, requests_per_client: int):
+    latencies = []
+
+    async def worker():
+        for _ in range(requests_per_client):
+            started = time.perf_counter()
+            response = await client.get(path)
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1] if len(latencies) > 1 else latencies[0]
+    return len(latencies) / elapsed, statistics.median(latencies), p95
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=None, help="sync SQLAlchemy URL (default: temp SQLite file)")
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="simulated DB round-trip per request")
+    parser.add_argument("--levels", default="1,10,50,100,200", help="comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=20, help="requests per concurrent client")
+    parser.add_argument("--slo-ms", type=float, default=250.0, help="p95 latency budget for 'sustained'")
+    args = parser.parse_args()
+
+    database_url = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    app, async_engine = build_app(database_url, args.latency_ms / 1000)
+    levels = [int(level) for level in args.levels.split(",")]
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        print(f"{'stack':<6} {'concurrency':>11} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8}")
+        for path in ("/sync", "/async"):
+            sustained = 0
+            for level in levels:
+                throughput, p50, p95 = await run_level(client, path, level, args.requests)
+                print(f"{path[1:]:<6} {level:>11} {throughput:>9.0f} {p50 * 1000:>8.1f} {p95 * 1000:>8.1f}")
+                if p95 * 1000 <= args.slo_ms:
+                    sustained = level
+            print(f"{path[1:]}: sustains {sustained} concurrent requests within a p95 of {args.slo_ms:.0f} ms\n")
+    # aiosqlite connections run on worker threads that keep the process alive until disposed.
+    await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,58 @@
+"""
+Measures password hashing throughput for each scheme and cost profile, so the
+login cost can be sized against the number of cores a worker has.
+
+Reports single-core hashes/second (one process hashing back to back) and the
+aggregate rate with one process per core, which is the ceiling for logins
+per second on this host. Schemes whose backend is not installed are skipped.
+
+Usage:
+    python benchmarks/password_hashing.py --schemes bcrypt,pbkdf2_sha256 --profiles default,fast
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from passlib.exc import MissingBackendError
+
+from app.security import PASSWORD_HASH_PROFILES, build_password_context
+
+
+def hash_for(scheme: str, profile: str, seconds: float) -> int:
+    context = build_password_context([scheme], profile)
+    hashed = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        context.hash("correct horse battery staple")
+        hashed += 1
+    return hashed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--schemes", default="bcrypt,pbkdf2_sha256,argon2")
+    parser.add_argument("--profiles", default=",".join(p for p in PASSWORD_HASH_PROFILES if p != "test"))
+    parser.add_argument("--seconds", type=float, default=3.0)
+    parser.add_argument("--cores", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    print(f"{'scheme':<15} {'profile':<8} {'ms/hash':>9} {'hash/s/core':>12} {f'hash/s x{args.cores}':>12}")
+    for scheme in args.schemes.split(","):
+        for profile in args.profiles.split(","):
+            try:
+                single = hash_for(scheme, profile, args.seconds) / args.seconds
+            except (MissingBackendError, KeyError, ValueError) as e:
+                print(f"{scheme:<15} {profile:<8} skipped: {e}")
+                break
+            with ProcessPoolExecutor(args.cores) as pool:
+                counts = pool.map(hash_for, [scheme] * args.cores, [profile] * args.cores, [args.seconds] * args.cores)
+                aggregate = sum(counts) / args.seconds
+            print(f"{scheme:<15} {profile:<8} {1000 / single:>9.1f} {single:>12.1f} {aggregate:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Measures the recent-data submission lookups before and after the hot/archive
+rollover, the archive history path, and the rollover itself.
+
+Seeds `--rows` submissions spread evenly over the last `--months` months, then
+times crud.get_submissions_by_user, crud.get_latest_submission and
+crud.get_submission_history against one unsplit table, runs the rollover, and
+times them again. The defaults finish in a few minutes on SQLite; for the
+50-million-row case point it at Postgres, where the archive is partitioned by
+month:
+
+Usage:
+    python benchmarks/submission_partitions.py --rows 1000000
+    python benchmarks/submission_partitions.py --database-url postgresql://... --rows 50000000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+
+from app import config, crud, models, partitions
+
+INSERT_CHUNK = 50_000
+
+
+def seed(db, rows: int, months: int, buyers: int, templates: int, now: datetime):
+    db.execute(insert(models.User), [
+        {"email": f"buyer{n}@bench.io", "role": "Buyer", "hashed_password": "-"} for n in range(buyers)
+    ])
+    agent_id = db.scalar(insert(models.User).values(email="agent@bench.io", role="Agent", hashed_password="-")
+                         .returning(models.User.id))
+    db.commit()
+    buyer_ids = list(range(1, buyers + 1))
+    template_eids = [f"tpl-{n}" for n in range(templates)]
+    crud.bulk_create_templates(db, [
+        {"title": f"Template {n}", "owner_id": agent_id, "anvil_template_eid": eid} for n, eid in enumerate(template_eids)
+    ])
+
+    # Ids increase with created_at, as they do in production.
+    start = now - timedelta(days=30 * months)
+    step = (now - start) / rows
+    table = models.Submission.__table__
+    for offset in range(0, rows, INSERT_CHUNK):
+        db.execute(insert(table), [
+            {
+                "template_id": template_eids[n % templates],
+                "buyer_id": buyer_ids[n % buyers],
+                "anvil_submission_eid": f"sub-{n}",
+                "filled_pdf_url": None,
+                "created_at": start + step * n,
+            }
+            for n in range(offset, min(offset + INSERT_CHUNK, rows))
+        ])
+        db.commit()
+        print(f"\rseeded {min(offset + INSERT_CHUNK, rows):,} submissions", end="", flush=True)
+    print()
+    crud.rebuild_submission_rollups(db)
+    return buyer_ids, template_eids
+
+
+def measure(label: str, iterations: int, fn):
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    p95 = timings[max(int(len(timings) * 0.95) - 1, 0)]
+    print(f"{label:<28} {statistics.median(timings) * 1000:>9.2f} {p95 * 1000:>9.2f}")
+
+
+def run_queries(db, title: str, iterations: int, buyer_ids, template_eids):
+    print(f"\n{title}\n{'query':<28} {'p50 ms':>9} {'p95 ms':>9}")
+    measure("get_submissions_by_user", iterations, lambda: crud.get_submissions_by_user(db, random.choice(buyer_ids)))
+    measure("get_latest_submission", iterations, lambda: crud.get_latest_submission(db, random.choice(template_eids)))
+    measure("get_submission_history", iterations, lambda: crud.get_submission_history(db, random.choice(buyer_ids)))
+    db.expunge_all()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=None, help="sync SQLAlchemy URL (default: temp SQLite file)")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="submissions to seed")
+    parser.add_argument("--months", type=int, default=36, help="months the submissions are spread over")
+    parser.add_argument("--hot-months", type=int, default=config.SUBMISSIONS_HOT_MONTHS)
+    parser.add_argument("--buyers", type=int, default=1000)
+    parser.add_argument("--templates", type=int, default=100)
+    parser.add_argument("--iterations", type=int, default=50, help="calls per query")
+    args = parser.parse_args()
+
+    database_url = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    engine = create_engine(database_url)
+    models.Base.metadata.create_all(bind=engine)
+    SessionLocal = sessionmaker(bind=engine, autoflush=False)
+    config.SUBMISSIONS_HOT_MONTHS = args.hot_months
+    now = datetime.now(timezone.utc)
+
+    with SessionLocal() as db:
+        buyer_ids, template_eids = seed(db, args.rows, args.months, args.buyers, args.templates, now)
+        run_queries(db, f"unsplit: {args.rows:,} submissions", args.iterations, buyer_ids, template_eids)
+
+        started = time.perf_counter()
+        report = partitions.rollover(db, now=now)
+        elapsed = time.perf_counter() - started
+        print(f"\nrollover: archived {report.moved:,} submissions from {len(report.months)} months "
+              f"in {elapsed:.1f} s ({report.moved / elapsed:,.0f} rows/s), kept {report.kept_latest} latest hot")
+
+        hot = args.rows - report.moved
+        run_queries(db, f"split: {hot:,} hot, {report.moved:,} archived", args.iterations, buyer_ids, template_eids)
+
+
+if __name__ == "__main__":
+    main()
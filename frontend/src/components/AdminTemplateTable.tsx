@@ -56,24 +56,18 @@ export const TemplateTable = ({ data }: TemplateTableProps) => {
   const handleDownloadPdf = async (submission_id: string) => {
     setLoadingPdf(submission_id);
     try {
-      const response = await apiClient.get(
-        `/api/submissions/${submission_id}/download`,
-        {
-          responseType: 'blob'
-        }
+      // Authorise once, then let the browser fetch the file from the signed URL;
+      // behind nginx with DOWNLOAD_OFFLOAD=x-accel, nginx sends it directly.
+      const response = await apiClient.post<{ url: string }>(
+        `/api/submissions/${submission_id}/download-url`
       );
 
-      // --- START: PDF Download Logic ---
-      const file = new Blob([response.data], { type: 'application/pdf' });
-      const fileURL = URL.createObjectURL(file);
       const link = document.createElement('a');
-      link.href = fileURL;
+      link.href = `${apiClient.defaults.baseURL ?? ''}${response.data.url}`;
       link.setAttribute('download', `submission-${submission_id}.pdf`);
       document.body.appendChild(link);
       link.click();
       document.body.removeChild(link);
-      window.URL.revokeObjectURL(fileURL);
-      // --- END: PDF Download Logic ---
 
     } catch (error) {
       console.error("Error fetching the PDF", error);